@@ -0,0 +1,344 @@
+# app/analytics/columnar.py
+"""Columnar, memory-mapped snapshot of orders and their line items (requires numpy).
+
+A snapshot is a directory of raw little-endian column files, one per column:
+
+    orders.<column>.bin   order_id, user_id, order_date (epoch seconds, UTC), status,
+                          total_amount, payment_method       one row per order
+    items.<column>.bin    order_row (row in the orders columns), product_id, quantity,
+                          price, name                        one row per line item
+    strings.bin / strings.offsets.bin
+                          string pool: names and payment methods are stored once and
+                          columns hold their code (-1 for none)
+    meta.json             row counts, dtypes, last exported order_id, status names
+
+Exports only append, in order_id order, resuming after the last exported order_id.
+Orders placed in the last --lag-seconds are left for the next run, so an order whose
+transaction commits late is not skipped. Statuses are as of export; --refresh-statuses
+rewrites them in place. meta.json is replaced last, so an interrupted export is
+truncated away by the next one and readers never see partial rows.
+
+    python -m app.analytics.columnar --path snapshots/orders
+    python -m app.analytics.columnar --path snapshots/orders --refresh-statuses
+
+Snapshot(path) maps the files read-only, for vectorized aggregates over numpy arrays.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.db import SessionLocal
+from app.models import Order, OrderStatus
+from app.orders.backfill_items import _rows as item_rows
+
+SNAPSHOT_DIR = os.getenv("ORDERS_SNAPSHOT_DIR", "snapshots/orders")
+BATCH_SIZE = 10000
+LAG_SECONDS = 60
+FORMAT_VERSION = 1
+
+ORDER_COLUMNS = {
+    "order_id": "<i4",
+    "user_id": "<i4",
+    "order_date": "<i8",
+    "status": "u1",
+    "total_amount": "<f8",
+    "payment_method": "<i4"
+}
+ITEM_COLUMNS = {
+    "order_row": "<i4",
+    "product_id": "<i4",
+    "quantity": "<i4",
+    "price": "<f8",
+    "name": "<i4"
+}
+STATUSES = [s.value for s in OrderStatus]
+
+
+def _file(path: str, table: str, column: str) -> str:
+    return os.path.join(path, f"{table}.{column}.bin")
+
+
+def _read_meta(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _sync(f) -> None:
+    """Flush an appended file to disk, so meta.json never counts rows a crash could lose"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _map(filename: str, dtype: str, rows: int, mode: str = "r") -> np.ndarray:
+    if rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=(rows,))
+
+
+# ─────────────────────────────────────────────────────
+#  Export
+# ─────────────────────────────────────────────────────
+class SnapshotWriter:
+    """Appends orders after meta["last_order_id"] to the snapshot at `path`"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = _read_meta(path) or {
+            "version": FORMAT_VERSION,
+            "last_order_id": 0,
+            "orders": 0,
+            "items": 0,
+            "strings": 0,
+            "statuses": STATUSES,
+            "order_columns": ORDER_COLUMNS,
+            "item_columns": ITEM_COLUMNS
+        }
+        if self.meta["version"] != FORMAT_VERSION or self.meta["statuses"] != STATUSES:
+            raise ValueError(f"{path} was written by another snapshot format; export to a new directory")
+        self._truncate()
+        self._codes = {value: code for code, value in enumerate(Snapshot(path).strings(np.arange(self.meta["strings"])))}
+        self._new_strings: List[bytes] = []
+
+    def _truncate(self) -> None:
+        """Drop anything past the committed row counts (left by an interrupted export)"""
+        sizes = [(_file(self.path, "orders", c), self.meta["orders"] * np.dtype(d).itemsize) for c, d in ORDER_COLUMNS.items()]
+        sizes += [(_file(self.path, "items", c), self.meta["items"] * np.dtype(d).itemsize) for c, d in ITEM_COLUMNS.items()]
+        strings = self.meta["strings"]
+        offsets = _map(os.path.join(self.path, "strings.offsets.bin"), "<i8", strings + 1) if strings else [0]
+        sizes.append((os.path.join(self.path, "strings.offsets.bin"), (strings + 1) * 8))
+        sizes.append((os.path.join(self.path, "strings.bin"), int(offsets[-1])))
+        for filename, size in sizes:
+            with open(filename, "ab") as f:
+                f.truncate(size)
+        if strings == 0:
+            with open(os.path.join(self.path, "strings.offsets.bin"), "wb") as f:
+                np.zeros(1, dtype="<i8").tofile(f)
+        del offsets
+
+    def _code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = self.meta["strings"] + len(self._new_strings)
+            self._new_strings.append(value.encode())
+        return code
+
+    def _append(self, table: str, columns: Dict[str, str], values: Dict[str, list]) -> None:
+        for column, dtype in columns.items():
+            with open(_file(self.path, table, column), "ab") as f:
+                np.asarray(values[column], dtype=dtype).tofile(f)
+                _sync(f)
+
+    def append_batch(self, rows) -> None:
+        """Append one batch of (order_id, user_id, order_date, status, total_amount, payment_method, items)"""
+        first_row = self.meta["orders"]
+        orders = {column: [] for column in ORDER_COLUMNS}
+        items = {column: [] for column in ITEM_COLUMNS}
+        status_codes = {status: code for code, status in enumerate(OrderStatus)}
+        for offset, (order_id, user_id, order_date, status, total_amount, payment_method, order_items) in enumerate(rows):
+            orders["order_id"].append(order_id)
+            orders["user_id"].append(user_id)
+            orders["order_date"].append(order_date.replace(tzinfo=None))
+            orders["status"].append(status_codes[status])
+            orders["total_amount"].append(total_amount)
+            orders["payment_method"].append(self._code(payment_method))
+            for item in item_rows(order_id, order_items):
+                items["order_row"].append(first_row + offset)
+                items["product_id"].append(item["product_id"])
+                items["quantity"].append(item["quantity"])
+                items["price"].append(item["price"])
+                items["name"].append(self._code(item["name"]))
+        orders["order_date"] = np.array(orders["order_date"], dtype="datetime64[s]").astype("<i8")
+
+        self._append("orders", ORDER_COLUMNS, orders)
+        self._append("items", ITEM_COLUMNS, items)
+        if self._new_strings:
+            with open(os.path.join(self.path, "strings.bin"), "ab") as f:
+                f.write(b"".join(self._new_strings))
+                _sync(f)
+            end = _map(os.path.join(self.path, "strings.offsets.bin"), "<i8", self.meta["strings"] + 1)[-1]
+            with open(os.path.join(self.path, "strings.offsets.bin"), "ab") as f:
+                (end + np.cumsum([len(s) for s in self._new_strings], dtype="<i8")).tofile(f)
+                _sync(f)
+        self.meta["orders"] += len(orders["order_id"])
+        self.meta["items"] += len(items["order_row"])
+        self.meta["strings"] += len(self._new_strings)
+        self.meta["last_order_id"] = orders["order_id"][-1]
+        self._new_strings = []
+        self._commit()
+
+    def _commit(self) -> None:
+        """Publish the new row counts; the appended data is already on disk (see _sync)"""
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+
+def export(db: Session, path: str = SNAPSHOT_DIR, batch_size: int = BATCH_SIZE, lag_seconds: float = LAG_SECONDS) -> int:
+    """Append orders placed after the last export (and over lag_seconds ago); returns how many"""
+    started = time.perf_counter()
+    writer = SnapshotWriter(path)
+    after_id = writer.meta["last_order_id"]
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=lag_seconds)
+    # Stop before the first order that is too recent, so later runs resume without gaps
+    upper = db.execute(
+        select(func.min(Order.order_id)).where(Order.order_id > after_id, Order.order_date >= cutoff)
+    ).scalar()
+    exported = 0
+    while True:
+        stmt = select(Order.order_id, Order.user_id, Order.order_date, Order.status, Order.total_amount,
+                      Order.payment_method, Order.items).where(Order.order_id > after_id)
+        if upper is not None:
+            stmt = stmt.where(Order.order_id < upper)
+        rows = db.execute(stmt.order_by(Order.order_id).limit(batch_size)).all()
+        db.rollback()
+        if not rows:
+            break
+        writer.append_batch(rows)
+        after_id = rows[-1].order_id
+        exported += len(rows)
+        logging.info(f"Snapshot exported through order_id={after_id}")
+    logging.info(f"Snapshot export of {exported} order(s) finished in {time.perf_counter() - started:.1f}s")
+    return exported
+
+
+def refresh_statuses(db: Session, path: str = SNAPSHOT_DIR, batch_size: int = BATCH_SIZE) -> int:
+    """Rewrite the status column in place from the database; returns how many changed"""
+    meta = _read_meta(path)
+    if not meta or meta["orders"] == 0:
+        return 0
+    order_ids = _map(_file(path, "orders", "order_id"), ORDER_COLUMNS["order_id"], meta["orders"])
+    statuses = _map(_file(path, "orders", "status"), ORDER_COLUMNS["status"], meta["orders"], mode="r+")
+    status_codes = {status: code for code, status in enumerate(OrderStatus)}
+    changed, after_id = 0, 0
+    while True:
+        rows = db.execute(
+            select(Order.order_id, Order.status)
+            .where(Order.order_id > after_id, Order.order_id <= meta["last_order_id"])
+            .order_by(Order.order_id).limit(batch_size)
+        ).all()
+        db.rollback()
+        if not rows:
+            break
+        ids = np.array([row.order_id for row in rows], dtype=order_ids.dtype)
+        codes = np.array([status_codes[row.status] for row in rows], dtype=statuses.dtype)
+        positions = np.searchsorted(order_ids, ids)
+        found = positions < len(order_ids)
+        found[found] = order_ids[positions[found]] == ids[found]
+        positions, codes = positions[found], codes[found]
+        differs = statuses[positions] != codes
+        statuses[positions[differs]] = codes[differs]
+        changed += int(differs.sum())
+        after_id = rows[-1].order_id
+    statuses.flush()
+    return changed
+
+
+# ─────────────────────────────────────────────────────
+#  Read
+# ─────────────────────────────────────────────────────
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot directory.
+
+    `orders` and `items` map column names to numpy arrays; items["order_row"] indexes
+    the orders columns, e.g. snapshot.orders["order_date"][snapshot.items["order_row"]].
+    """
+
+    def __init__(self, path: str = SNAPSHOT_DIR):
+        self.path = path
+        self.meta = _read_meta(path) or {"orders": 0, "items": 0, "strings": 0, "statuses": STATUSES}
+        self.orders = {c: _map(_file(path, "orders", c), d, self.meta["orders"]) for c, d in ORDER_COLUMNS.items()}
+        self.items = {c: _map(_file(path, "items", c), d, self.meta["items"]) for c, d in ITEM_COLUMNS.items()}
+        self._offsets = _map(os.path.join(path, "strings.offsets.bin"), "<i8", self.meta["strings"] + 1) \
+            if self.meta["strings"] else np.zeros(1, dtype="<i8")
+        self._pool = _map(os.path.join(path, "strings.bin"), "u1", int(self._offsets[-1]))
+        self._lookup: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return self.meta["orders"]
+
+    def strings(self, codes) -> List[Optional[str]]:
+        """Decode string-pool codes (-1 decodes to None)"""
+        return [
+            None if code < 0 else self._pool[self._offsets[code]:self._offsets[code + 1]].tobytes().decode()
+            for code in np.asarray(codes).tolist()
+        ]
+
+    def code(self, value: str) -> int:
+        """String-pool code of `value` (-1 when absent), for filters like items["name"] == code"""
+        if self._lookup is None:
+            self._lookup = {s: code for code, s in enumerate(self.strings(np.arange(self.meta["strings"])))}
+        return self._lookup.get(value, -1)
+
+    def status_code(self, status: str) -> int:
+        return self.meta["statuses"].index(status)
+
+    def order_dates(self) -> np.ndarray:
+        return self.orders["order_date"].view("datetime64[s]")
+
+    def item_mask(self, exclude_canceled: bool = True, date_from: Optional[datetime] = None,
+                  date_to: Optional[datetime] = None) -> np.ndarray:
+        """Boolean mask over items whose order is in range (UTC) and, by default, not cancelled"""
+        keep = np.ones(len(self.orders["order_id"]), dtype=bool)
+        if exclude_canceled:
+            keep &= self.orders["status"] != self.status_code(OrderStatus.canceled.value)
+        if date_from is not None:
+            keep &= self.order_dates() >= np.datetime64(date_from.replace(tzinfo=None), "s")
+        if date_to is not None:
+            keep &= self.order_dates() < np.datetime64(date_to.replace(tzinfo=None), "s")
+        return keep[self.items["order_row"]]
+
+    def product_totals(self, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(product_ids, units, revenue) over the masked items, by product_id"""
+        mask = self.item_mask() if mask is None else mask
+        quantity = self.items["quantity"][mask]
+        products, inverse = np.unique(self.items["product_id"][mask], return_inverse=True)
+        units = np.bincount(inverse, weights=quantity, minlength=len(products)).astype(np.int64)
+        revenue = np.bincount(inverse, weights=quantity * self.items["price"][mask], minlength=len(products))
+        return products, units, revenue
+
+    def revenue_by_day(self, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(days as datetime64[D], revenue) over the masked items, by UTC day"""
+        mask = self.item_mask() if mask is None else mask
+        days = self.orders["order_date"][self.items["order_row"][mask]] // 86400
+        revenue = self.items["quantity"][mask] * self.items["price"][mask]
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        return unique_days.astype("datetime64[D]"), np.bincount(inverse, weights=revenue, minlength=len(unique_days))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export orders to a columnar snapshot")
+    parser.add_argument("--path", default=SNAPSHOT_DIR)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--lag-seconds", type=float, default=LAG_SECONDS, help="Leave orders this recent for the next run")
+    parser.add_argument("--refresh-statuses", action="store_true", help="Also rewrite the status of exported orders")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        export(db, args.path, args.batch_size, args.lag_seconds)
+        if args.refresh_statuses:
+            logging.info(f"Snapshot statuses refreshed ({refresh_statuses(db, args.path, args.batch_size)} changed)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# app/analytics/crud.py
+"""Dashboard queries, answered from the daily rollups instead of scanning orders.
+
+Ranges are whole UTC days, [date_from, date_to). Order counts add up across days (an
+order belongs to one day) but not across products or categories: an order with two
+products counts once for each.
+"""
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.models import SalesDailyCategory, SalesDailyProduct
+
+
+def _in_range(stmt, model, date_from: Optional[date], date_to: Optional[date]):
+    if date_from is not None:
+        stmt = stmt.where(model.day >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(model.day < date_to)
+    return stmt
+
+
+def _rows(result) -> List[dict]:
+    return [{**row, "revenue": float(row["revenue"] or 0)} for row in result.mappings()]
+
+
+def daily_sales(db: Session, date_from: Optional[date] = None, date_to: Optional[date] = None) -> List[dict]:
+    """Units and revenue per day, from the (smaller) category rollup"""
+    T = SalesDailyCategory
+    stmt = select(T.day, func.sum(T.units).label("units"), func.sum(T.revenue).label("revenue"))
+    stmt = _in_range(stmt, T, date_from, date_to).group_by(T.day).order_by(T.day)
+    return _rows(db.execute(stmt))
+
+
+def category_sales(db: Session, date_from: Optional[date] = None, date_to: Optional[date] = None) -> List[dict]:
+    T = SalesDailyCategory
+    stmt = select(
+        T.category_id,
+        func.sum(T.units).label("units"),
+        func.sum(T.revenue).label("revenue"),
+        func.sum(T.orders).label("orders")
+    )
+    stmt = _in_range(stmt, T, date_from, date_to).group_by(T.category_id).order_by(func.sum(T.revenue).desc())
+    return _rows(db.execute(stmt))
+
+
+def top_products(
+    db: Session,
+    limit: int = 20,
+    by: str = "revenue",
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+) -> List[dict]:
+    T = SalesDailyProduct
+    measures = {
+        "units": func.sum(T.units).label("units"),
+        "revenue": func.sum(T.revenue).label("revenue"),
+        "orders": func.sum(T.orders).label("orders")
+    }
+    stmt = select(T.product_id, *measures.values())
+    stmt = _in_range(stmt, T, date_from, date_to).group_by(T.product_id)\
+        .order_by(measures[by].desc(), T.product_id).limit(limit)
+    return _rows(db.execute(stmt))
+
+
+def product_daily_sales(
+    db: Session,
+    product_id: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+) -> List[dict]:
+    T = SalesDailyProduct
+    stmt = select(T.day, T.units, T.revenue, T.orders).where(T.product_id == product_id)
+    stmt = _in_range(stmt, T, date_from, date_to).order_by(T.day)
+    return _rows(db.execute(stmt))
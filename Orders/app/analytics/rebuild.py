@@ -0,0 +1,132 @@
+# app/analytics/rebuild.py
+"""Recompute the daily sales rollups from orders / order_items.
+
+The date range is cut into chunks of --days-per-chunk days that --workers threads rebuild
+in parallel, each chunk in one transaction of its own session: delete the chunk's rollup
+rows, then insert the aggregates grouped in the database. Use it after the order_items
+backfill, or to repair drift; run it while no orders are being placed in the range.
+
+    python -m app.analytics.rebuild --workers 4 --days-per-chunk 7
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, inspect, literal, select
+from sqlalchemy.orm import Session
+
+from app.analytics.rollups import UNKNOWN_CATEGORY, products_table
+from app.db import SessionLocal
+from app.models import Order, OrderItem, OrderStatus, SalesDailyCategory, SalesDailyProduct
+
+WORKERS = 4
+DAYS_PER_CHUNK = 7
+
+
+def _as_date(value) -> date:
+    # func.date() comes back as a string on SQLite
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _aggregate(db: Session, key, start: date, end: date, join_products: bool) -> List[dict]:
+    day = func.date(Order.order_date)
+    stmt = select(
+        day.label("day"),
+        key.label("key"),
+        func.sum(OrderItem.quantity).label("units"),
+        func.sum(OrderItem.quantity * OrderItem.price).label("revenue"),
+        func.count(func.distinct(OrderItem.order_id)).label("orders")
+    ).join(Order, Order.order_id == OrderItem.order_id)
+    if join_products:
+        stmt = stmt.outerjoin(products_table, products_table.c.id == OrderItem.product_id)
+    stmt = stmt.where(
+        Order.status != OrderStatus.canceled,
+        Order.order_date >= datetime.combine(start, datetime.min.time()),
+        Order.order_date < datetime.combine(end, datetime.min.time())
+    ).group_by(day, key)
+    return [
+        {"day": _as_date(row.day), "key": int(row.key), "units": int(row.units),
+         "revenue": round(float(row.revenue or 0), 2), "orders": int(row.orders)}
+        for row in db.execute(stmt)
+    ]
+
+
+def rebuild_chunk(start: date, end: date, join_products: bool) -> int:
+    """Replace the rollup rows of days [start, end); returns the rows written"""
+    db = SessionLocal()
+    try:
+        category = func.coalesce(products_table.c.category_id, UNKNOWN_CATEGORY) if join_products else literal(UNKNOWN_CATEGORY)
+        written = 0
+        for model, key, column in (
+            (SalesDailyProduct, "product_id", OrderItem.product_id),
+            (SalesDailyCategory, "category_id", category)
+        ):
+            rows = _aggregate(db, column, start, end, join_products)
+            db.execute(delete(model).where(model.day >= start, model.day < end))
+            if rows:
+                db.execute(insert(model), [{**row, key: row.pop("key")} for row in rows])
+            written += len(rows)
+        db.commit()
+        return written
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _chunks(start: date, end: date, days: int) -> List[Tuple[date, date]]:
+    chunks = []
+    while start < end:
+        chunks.append((start, min(end, start + timedelta(days=days))))
+        start += timedelta(days=days)
+    return chunks
+
+
+def rebuild(
+    workers: int = WORKERS,
+    days_per_chunk: int = DAYS_PER_CHUNK,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+) -> int:
+    """Rebuild the rollups for days in [date_from, date_to) (default: every day with orders)"""
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        first, last = db.execute(select(func.min(Order.order_date), func.max(Order.order_date))).one()
+        join_products = inspect(db.get_bind()).has_table("products")
+    finally:
+        db.close()
+    if first is None:
+        return 0
+    start = date_from or first.date()
+    end = date_to or last.date() + timedelta(days=1)
+    if not join_products:
+        logging.warning("No products table in this database; category rollups go to category 0")
+
+    chunks = _chunks(start, end, days_per_chunk)
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (chunk_start, chunk_end), rows in zip(chunks, pool.map(lambda c: rebuild_chunk(*c, join_products), chunks)):
+            written += rows
+            logging.info(f"Rollups rebuilt for {chunk_start}..{chunk_end - timedelta(days=1)} ({rows} rows)")
+    logging.info(f"Rollup rebuild of {len(chunks)} chunk(s) finished in {time.perf_counter() - started:.1f}s")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the daily sales rollups")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--days-per-chunk", type=int, default=DAYS_PER_CHUNK)
+    parser.add_argument("--date-from", type=date.fromisoformat, help="First day (YYYY-MM-DD, UTC)")
+    parser.add_argument("--date-to", type=date.fromisoformat, help="Day after the last one (YYYY-MM-DD, UTC)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    rebuild(args.workers, args.days_per_chunk, args.date_from, args.date_to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# app/analytics/rollups.py
+"""Daily sales rollups maintained by deltas inside the order transactions.
+
+Every order that is not cancelled is counted once, on the UTC day it was placed, in
+sales_daily_product (day x product) and sales_daily_category (day x category).
+create_order adds it, a cancellation subtracts it, and un-cancelling adds it back.
+Each delta is one multi-row upsert per table, in the caller's transaction, so the
+rollups commit or roll back with the order.
+
+Categories come from the Products `products` table when it shares this database; lines
+whose product is unknown are counted under category 0.
+"""
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.models import Order, OrderStatus, SalesDailyCategory, SalesDailyProduct
+
+UNKNOWN_CATEGORY = 0
+CATEGORY_CACHE_TTL = 300.0
+
+# Products' table, described here only for lookups (never created by Orders)
+products_table = Table(
+    "products", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("category_id", Integer)
+)
+
+
+class CategoryLookup:
+    """product_id -> category_id, cached for CATEGORY_CACHE_TTL seconds"""
+
+    def __init__(self, ttl: float = CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache: Dict[int, Tuple[int, float]] = {}
+
+    def resolve(self, db: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+        now = time.monotonic()
+        result: Dict[int, int] = {}
+        missing = []
+        with self._lock:
+            for product_id in set(product_ids):
+                cached = self._cache.get(product_id)
+                if cached is not None and cached[1] > now:
+                    result[product_id] = cached[0]
+                else:
+                    missing.append(product_id)
+        if missing:
+            try:
+                # A savepoint, so a missing products table cannot abort the order's transaction
+                with db.begin_nested():
+                    found = dict(db.execute(
+                        select(products_table.c.id, products_table.c.category_id).where(products_table.c.id.in_(missing))
+                    ).all())
+            except SQLAlchemyError:
+                found = {}
+            with self._lock:
+                for product_id in missing:
+                    category_id = found.get(product_id) or UNKNOWN_CATEGORY
+                    self._cache[product_id] = (category_id, now + self.ttl)
+                    result[product_id] = category_id
+        return result
+
+
+category_lookup = CategoryLookup()
+
+
+def _day(value: datetime) -> date:
+    return value.date()
+
+
+def _upsert(db: Session, model, key: str, rows: List[dict]) -> None:
+    """Add units/revenue/orders onto existing rollup rows, inserting missing ones"""
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            units=table.c.units + stmt.inserted.units,
+            revenue=table.c.revenue + stmt.inserted.revenue,
+            orders=table.c.orders + stmt.inserted.orders
+        )
+    else:
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["day", key],
+            set_={
+                "units": table.c.units + stmt.excluded.units,
+                "revenue": table.c.revenue + stmt.excluded.revenue,
+                "orders": table.c.orders + stmt.excluded.orders
+            }
+        )
+    # Sorted, so concurrent orders lock rollup rows in the same order
+    db.execute(stmt, sorted(rows, key=lambda r: (r["day"], r[key])))
+
+
+def apply_delta(db: Session, orders: Iterable[Tuple[datetime, List[dict]]], sign: int) -> None:
+    """Add (sign=1) or remove (sign=-1) orders, given as (order_date, items), from the rollups (no commit)"""
+    by_product: Dict[Tuple[date, int], List] = defaultdict(lambda: [0, Decimal(0), set()])
+    lines = []
+    for index, (order_date, items) in enumerate(orders):
+        for item in items:
+            lines.append((index, _day(order_date), int(item["product_id"]), int(item["quantity"]), Decimal(str(item["price"]))))
+    if not lines:
+        return
+    categories = category_lookup.resolve(db, [line[2] for line in lines])
+
+    by_category: Dict[Tuple[date, int], List] = defaultdict(lambda: [0, Decimal(0), set()])
+    for index, day, product_id, quantity, price in lines:
+        for bucket in (by_product[(day, product_id)], by_category[(day, categories[product_id])]):
+            bucket[0] += quantity
+            bucket[1] += quantity * price
+            bucket[2].add(index)
+
+    def rows(buckets, key: str) -> List[dict]:
+        return [
+            {"day": day, key: value, "units": sign * units, "revenue": sign * revenue, "orders": sign * len(order_set)}
+            for (day, value), (units, revenue, order_set) in buckets.items()
+        ]
+
+    _upsert(db, SalesDailyProduct, "product_id", rows(by_product, "product_id"))
+    _upsert(db, SalesDailyCategory, "category_id", rows(by_category, "category_id"))
+
+
+def on_status_change(db: Session, order: Order, old_status: OrderStatus) -> None:
+    """Keep the rollups in line with a status change of `order` (no commit)"""
+    was_counted = old_status != OrderStatus.canceled
+    is_counted = order.status != OrderStatus.canceled
+    if was_counted != is_counted:
+        apply_delta(db, [(order.order_date, order.items)], 1 if is_counted else -1)
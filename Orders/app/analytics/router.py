@@ -0,0 +1,47 @@
+from datetime import date
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from app.dependencies import get_db
+from app.analytics import crud, schemas
+
+router = APIRouter(tags=["Analytics"])
+
+# Revenue and units per UTC day
+@router.get("/sales/daily", response_model=list[schemas.DailySalesResponse])
+def daily_sales(
+    date_from: Optional[date] = Query(None, description="First day (UTC)"),
+    date_to: Optional[date] = Query(None, description="Day after the last one (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.daily_sales(db, date_from, date_to)
+
+# Revenue, units and orders per product category, best-selling first
+@router.get("/sales/categories", response_model=list[schemas.CategoryRollupResponse])
+def category_sales(
+    date_from: Optional[date] = Query(None, description="First day (UTC)"),
+    date_to: Optional[date] = Query(None, description="Day after the last one (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.category_sales(db, date_from, date_to)
+
+# Top products by revenue, units or orders
+@router.get("/sales/products/top", response_model=list[schemas.ProductRollupResponse])
+def top_products(
+    limit: int = Query(20, ge=1, le=500),
+    by: Literal["revenue", "units", "orders"] = Query("revenue"),
+    date_from: Optional[date] = Query(None, description="First day (UTC)"),
+    date_to: Optional[date] = Query(None, description="Day after the last one (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.top_products(db, limit, by, date_from, date_to)
+
+# Day-by-day sales of one product
+@router.get("/sales/products/{product_id}/daily", response_model=list[schemas.ProductDailySalesResponse])
+def product_daily_sales(
+    product_id: int,
+    date_from: Optional[date] = Query(None, description="First day (UTC)"),
+    date_to: Optional[date] = Query(None, description="Day after the last one (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.product_daily_sales(db, product_id, date_from, date_to)
@@ -0,0 +1,30 @@
+from datetime import date
+from pydantic import BaseModel
+
+
+# --- Revenue and units of one UTC day ---
+class DailySalesResponse(BaseModel):
+    day: date
+    units: int
+    revenue: float
+
+
+# --- One product on one day ---
+class ProductDailySalesResponse(DailySalesResponse):
+    orders: int
+
+
+# --- Totals per product over a date range ---
+class ProductRollupResponse(BaseModel):
+    product_id: int
+    units: int
+    revenue: float
+    orders: int
+
+
+# --- Totals per category over a date range (category 0: unknown) ---
+class CategoryRollupResponse(BaseModel):
+    category_id: int
+    units: int
+    revenue: float
+    orders: int
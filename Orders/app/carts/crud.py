@@ -1,8 +1,12 @@
+import uuid
+from typing import List
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 
 from app.models import Cart, CartItem
 from app.carts.schemas import CartCreate, CartItemCreate
+from app.inventory_client import InventoryError, InventoryUnavailableError
+from app.inventory_gateway import coalesce, get_inventory_gateway
 
 def create_cart(db: Session, cart_in: CartCreate) -> Cart:
     cart = Cart(customer_id=cart_in.customer_id)
@@ -17,34 +21,61 @@ def get_cart(db: Session, cart_id: int) -> Cart:
         raise HTTPException(status.HTTP_404_NOT_FOUND, f"Cart {cart_id} not found")
     return cart
 
-from Products.routers.product_router import reserve_products
-from fastapi import Request
-
-def add_item(db: Session, cart_id: int, item_in: CartItemCreate) -> CartItem:
-    # Reserve product
-    reserve_products(
-        reservations={"product_id": item_in.product_id, "quantity": item_in.quantity},
-        order_id=f"cart_{cart_id}",
-        db=db
+def _inventory_call(fn, *args, **kwargs):
+    """Run a gateway call under an Idempotency-Key of its own, turning inventory failures into HTTP errors.
+
+    The key lets the client retry a call whose response was lost without applying it twice.
+    """
+    key = f"cart-{kwargs.get('cart_id')}-{fn.__name__}-{uuid.uuid4().hex}"
+    try:
+        return fn(*args, idempotency_key=key, **kwargs)
+    except InventoryUnavailableError as e:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, f"Inventory unavailable: {e.detail}")
+    except InventoryError as e:
+        raise HTTPException(e.status_code if e.status_code == 409 else status.HTTP_400_BAD_REQUEST, e.detail)
+
+
+def add_items(db: Session, cart_id: int, items_in: List[CartItemCreate]) -> List[CartItem]:
+    """Add several products with one batched reservation (all or nothing)"""
+    get_cart(db, cart_id)
+    reserved = _inventory_call(
+        get_inventory_gateway().reserve,
+        coalesce([item_in.model_dump() for item_in in items_in]),
+        cart_id=cart_id
     )
+    remaining = {r["product_id"]: r.get("remaining_available") for r in reserved}
 
-    item = db.query(CartItem).filter_by(cart_id=cart_id, product_id=item_in.product_id).first()
-    if item:
-        item.quantity += item_in.quantity
-    else:
-        item = CartItem(cart_id=cart_id, **item_in.dict())
-        db.add(item)
+    existing = {
+        item.product_id: item
+        for item in db.query(CartItem).filter(
+            CartItem.cart_id == cart_id,
+            CartItem.product_id.in_([item_in.product_id for item_in in items_in])
+        )
+    }
+    for item_in in items_in:
+        item = existing.get(item_in.product_id)
+        if item:
+            item.quantity += item_in.quantity
+        else:
+            item = existing[item_in.product_id] = CartItem(cart_id=cart_id, **item_in.model_dump())
+            db.add(item)
 
     db.commit()
-    db.refresh(item)
-    return item
+    items = list(existing.values())
+    for item in items:
+        db.refresh(item)
+        item.remaining_available = remaining.get(item.product_id)
+    return items
+
+
+def add_item(db: Session, cart_id: int, item_in: CartItemCreate) -> CartItem:
+    return add_items(db, cart_id, [item_in])[0]
 
 
 def list_cart_items(db: Session, cart_id: int):
     cart = get_cart(db, cart_id)
     return cart.items
 
-from Products.routers.product_router import reserve_products, release_products
 
 def update_item_quantity(db: Session, cart_id: int, product_id: int, quantity: int):
     item = db.query(CartItem).filter_by(cart_id=cart_id, product_id=product_id).first()
@@ -52,20 +83,13 @@ def update_item_quantity(db: Session, cart_id: int, product_id: int, quantity: i
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Item not found in cart")
 
     quantity_diff = quantity - item.quantity
+    gateway = get_inventory_gateway()
     if quantity_diff > 0:
         # Increase reserve
-        reserve_products(
-            reservations={"product_id": product_id, "quantity": quantity_diff},
-            order_id=f"cart_{cart_id}",
-            db=db
-        )
+        _inventory_call(gateway.reserve, [{"product_id": product_id, "quantity": quantity_diff}], cart_id=cart_id)
     elif quantity_diff < 0:
         # Release reserve
-        release_products(
-            reservations={"product_id": product_id, "quantity": abs(quantity_diff)},
-            order_id=f"cart_{cart_id}",
-            db=db
-        )
+        _inventory_call(gateway.release, [{"product_id": product_id, "quantity": -quantity_diff}], cart_id=cart_id)
 
     item.quantity = quantity
     db.commit()
@@ -78,11 +102,10 @@ def remove_item(db: Session, item_id: int):
     if not item:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Cart item not found")
 
-    # Use your product release endpoint logic
-    release_products(
-        reservations={"product_id": item.product_id, "quantity": item.quantity},
-        order_id=f"cart_{item.cart_id}",
-        db=db
+    _inventory_call(
+        get_inventory_gateway().release,
+        [{"product_id": item.product_id, "quantity": item.quantity}],
+        cart_id=item.cart_id
     )
 
     db.delete(item)
@@ -90,11 +113,13 @@ def remove_item(db: Session, item_id: int):
 
 def clear_cart(db: Session, cart_id: int):
     items = db.query(CartItem).filter_by(cart_id=cart_id).all()
-    for item in items:
-        release_products(
-            reservations={"product_id": item.product_id, "quantity": item.quantity},
-            order_id=f"cart_{cart_id}",
-            db=db
+    if items:
+        # Every line released in one call
+        _inventory_call(
+            get_inventory_gateway().release,
+            coalesce([{"product_id": item.product_id, "quantity": item.quantity} for item in items]),
+            cart_id=cart_id
         )
+    for item in items:
         db.delete(item)
-    db.commit()
\ No newline at end of file
+    db.commit()
@@ -20,6 +20,11 @@ def get_cart(cart_id: int, db: Session = Depends(get_db)):
 def add_item_to_cart(cart_id: int, item_in: schemas.CartItemCreate, db: Session = Depends(get_db)):
     return crud.add_item(db, cart_id, item_in)
 
+# Add several items at once — one batched reservation for all of them
+@router.post("/{cart_id}/items/batch", response_model=list[schemas.CartItemResponse])
+def add_items_to_cart(cart_id: int, items_in: list[schemas.CartItemCreate], db: Session = Depends(get_db)):
+    return crud.add_items(db, cart_id, items_in)
+
 # List all items in a cart
 @router.get("/{cart_id}/items", response_model=list[schemas.CartItemResponse])
 def list_items(cart_id: int, db: Session = Depends(get_db)):
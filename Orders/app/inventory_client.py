@@ -0,0 +1,331 @@
+# app/inventory_client.py
+"""HTTP client for the Products inventory endpoints (reserve / release / finalize).
+
+One pooled keep-alive session per process (requests for sync code, httpx for async
+code), explicit connect/read timeouts, retries with jittered exponential backoff under
+a single Idempotency-Key (without one, only attempts Products cannot have applied are
+retried), and a circuit breaker so a sick Products instance fails
+orders fast instead of tying up every worker for the full timeout.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+INVENTORY_BASE_URL = os.getenv("INVENTORY_BASE_URL", "http://localhost:8000")
+INVENTORY_CONNECT_TIMEOUT = float(os.getenv("INVENTORY_CONNECT_TIMEOUT", "2"))
+INVENTORY_READ_TIMEOUT = float(os.getenv("INVENTORY_READ_TIMEOUT", "10"))
+INVENTORY_RETRIES = int(os.getenv("INVENTORY_RETRIES", "3"))           # attempts per call
+INVENTORY_BACKOFF_MS = float(os.getenv("INVENTORY_BACKOFF_MS", "200"))  # doubles per retry
+INVENTORY_POOL_SIZE = int(os.getenv("INVENTORY_POOL_SIZE", "20"))       # keep-alive connections
+INVENTORY_BREAKER_FAILURES = int(os.getenv("INVENTORY_BREAKER_FAILURES", "5"))
+INVENTORY_BREAKER_RESET = float(os.getenv("INVENTORY_BREAKER_RESET_SECONDS", "30"))
+
+# 409: a concurrent request holds the same rows or Idempotency-Key; 5xx: transient
+RETRY_STATUSES = {409, 500, 502, 503, 504}
+# A 5xx or a lost response may come after Products committed: without an Idempotency-Key
+# only a 409 (nothing applied) or a request that never got sent is retried
+UNKEYED_RETRY_STATUSES = {409}
+
+
+class InventoryError(Exception):
+    """Products answered with an error (or could not be reached)"""
+
+    def __init__(self, detail: str, status_code: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+class InventoryUnavailableError(InventoryError):
+    """Products is down, timing out, or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` consecutive failures; after `reset_after` seconds
+    one trial call is let through (half-open) and its outcome closes or re-opens it.
+    Callers must report every allowed call: a trial never reported keeps it open."""
+
+    def __init__(self, failures: int = INVENTORY_BREAKER_FAILURES, reset_after: float = INVENTORY_BREAKER_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.reset_after else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or self._consecutive >= self.failures:
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class ClientMetrics:
+    """Per-operation call, error and retry counts plus latency percentiles of recent calls"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._ops: Dict[str, Dict[str, Any]] = {}
+
+    def _op(self, name: str) -> Dict[str, Any]:
+        op = self._ops.get(name)
+        if op is None:
+            op = self._ops[name] = {
+                "calls": 0, "errors": 0, "retries": 0, "short_circuited": 0,
+                "latencies": deque(maxlen=self._window)
+            }
+        return op
+
+    def incr(self, name: str, counter: str) -> None:
+        with self._lock:
+            self._op(name)[counter] += 1
+
+    def observe(self, name: str, latency_ms: float, ok: bool) -> None:
+        with self._lock:
+            op = self._op(name)
+            op["calls"] += 1
+            op["errors"] += 0 if ok else 1
+            op["latencies"].append(latency_ms)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for name, op in self._ops.items():
+                latencies = sorted(op["latencies"])
+                def pct(p: float) -> Optional[float]:
+                    return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 3) if latencies else None
+                result[name] = {
+                    **{k: v for k, v in op.items() if k != "latencies"},
+                    "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99)
+                }
+            return result
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, INVENTORY_BACKOFF_MS * 2 ** attempt) / 1000
+
+
+def _detail(response) -> str:
+    try:
+        return str(response.json().get("detail", response.text))
+    except ValueError:
+        return response.text or f"HTTP {response.status_code}"
+
+
+class InventoryClient:
+    """Blocking client; share the module-level `inventory_client` so connections are reused"""
+
+    def __init__(self, base_url: str = INVENTORY_BASE_URL, breaker: Optional[CircuitBreaker] = None, metrics: Optional[ClientMetrics] = None):
+        self.base_url = base_url.rstrip("/")
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or ClientMetrics()
+        self.timeout = (INVENTORY_CONNECT_TIMEOUT, INVENTORY_READ_TIMEOUT)
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    # Retries are ours (they must keep the Idempotency-Key and feed the breaker)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=INVENTORY_POOL_SIZE, max_retries=0)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def post(self, op: str, path: str, payload: Any, params: Optional[dict] = None, idempotency_key: Optional[str] = None) -> dict:
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+        for attempt in range(INVENTORY_RETRIES):
+            if not self.breaker.allow():
+                self.metrics.incr(op, "short_circuited")
+                raise InventoryUnavailableError("Inventory service unavailable (circuit open)", 503)
+            started = time.perf_counter()
+            recorded = False
+            try:
+                try:
+                    response = self.session.post(
+                        f"{self.base_url}{path}", json=payload, params=params, headers=headers, timeout=self.timeout
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = InventoryUnavailableError(f"Inventory service unreachable: {e}", 503)
+                    sent = not _unsent(e)
+                else:
+                    error = _classify(response)
+                    if error is None:
+                        self.breaker.success()
+                        recorded = True
+                        self.metrics.observe(op, (time.perf_counter() - started) * 1000, ok=True)
+                        return response.json()
+                    sent = True
+                recorded = True
+                if _settle(self, op, started, error, attempt, keyed=bool(idempotency_key), sent=sent):
+                    raise error
+            finally:
+                if not recorded:
+                    # Any other exception (a broken body, ...) still counts, and ends a half-open trial
+                    self.breaker.failure()
+            time.sleep(_backoff(attempt))
+
+    def reserve(self, reservations: List[dict], cart_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> dict:
+        return self.post("reserve", "/products/reserve", reservations, {"cart_id": cart_id} if cart_id else None, idempotency_key)
+
+    def release(self, reservations: List[dict], cart_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> dict:
+        return self.post("release", "/products/release", reservations, {"cart_id": cart_id} if cart_id else None, idempotency_key)
+
+    def finalize(self, reservations: List[dict], order_id: str, cart_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> dict:
+        params = {"order_id": order_id, **({"cart_id": cart_id} if cart_id else {})}
+        return self.post("finalize", "/products/finalize", reservations, params, idempotency_key)
+
+    def restock(self, reservations: List[dict], order_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> dict:
+        return self.post("restock", "/products/restock", reservations, {"order_id": order_id} if order_id else None, idempotency_key)
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class AsyncInventoryClient(InventoryClient):
+    """Same calls as coroutines over an httpx connection pool (created on first use, so
+    inside the event loop that will use it)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(INVENTORY_READ_TIMEOUT, connect=INVENTORY_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=INVENTORY_POOL_SIZE, max_keepalive_connections=INVENTORY_POOL_SIZE)
+            )
+        return self._client
+
+    async def post(self, op: str, path: str, payload: Any, params: Optional[dict] = None, idempotency_key: Optional[str] = None) -> dict:
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+        for attempt in range(INVENTORY_RETRIES):
+            if not self.breaker.allow():
+                self.metrics.incr(op, "short_circuited")
+                raise InventoryUnavailableError("Inventory service unavailable (circuit open)", 503)
+            started = time.perf_counter()
+            recorded = False
+            try:
+                try:
+                    response = await self.client.post(path, json=payload, params=params, headers=headers)
+                except httpx.TransportError as e:
+                    error = InventoryUnavailableError(f"Inventory service unreachable: {e}", 503)
+                    sent = not _unsent(e)
+                else:
+                    error = _classify(response)
+                    if error is None:
+                        self.breaker.success()
+                        recorded = True
+                        self.metrics.observe(op, (time.perf_counter() - started) * 1000, ok=True)
+                        return response.json()
+                    sent = True
+                recorded = True
+                if _settle(self, op, started, error, attempt, keyed=bool(idempotency_key), sent=sent):
+                    raise error
+            finally:
+                if not recorded:
+                    # Cancellation, httpx.DecodingError, ...: still ends a half-open trial
+                    self.breaker.failure()
+            await asyncio.sleep(_backoff(attempt))
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def _classify(response) -> Optional[InventoryError]:
+    """None for a 200; otherwise the error to raise (or retry)"""
+    if response.status_code == 200:
+        return None
+    if response.status_code >= 500:
+        return InventoryUnavailableError(_detail(response), response.status_code)
+    return InventoryError(_detail(response), response.status_code)
+
+
+def _unsent(error: Exception) -> bool:
+    """True when the request failed before reaching Products (connecting or waiting for the pool)"""
+    if isinstance(error, (requests.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    # requests wraps a refused / unresolvable connection as MaxRetryError(reason=NewConnectionError)
+    cause = error.args[0] if isinstance(error, requests.ConnectionError) and error.args else None
+    return isinstance(getattr(cause, "reason", None), NewConnectionError)
+
+
+def _settle(client: InventoryClient, op: str, started: float, error: InventoryError, attempt: int, keyed: bool, sent: bool) -> bool:
+    """Record a failed attempt; True when it should be raised rather than retried"""
+    client.metrics.observe(op, (time.perf_counter() - started) * 1000, ok=False)
+    if isinstance(error, InventoryUnavailableError):
+        client.breaker.failure()
+    else:
+        # Products is answering; a 4xx says nothing about its health
+        client.breaker.success()
+    if attempt == INVENTORY_RETRIES - 1 or error.status_code not in RETRY_STATUSES:
+        return True
+    if sent and not keyed and error.status_code not in UNKEYED_RETRY_STATUSES:
+        # Products may have applied it; a retry without a key would apply it again
+        return True
+    client.metrics.incr(op, "retries")
+    logging.warning(f"Inventory {op} failed ({error.detail}), retrying")
+    return False
+
+
+# One breaker and one set of metrics per Products deployment, shared by both clients
+_breaker = CircuitBreaker()
+_metrics = ClientMetrics()
+inventory_client = InventoryClient(breaker=_breaker, metrics=_metrics)
+async_inventory_client = AsyncInventoryClient(breaker=_breaker, metrics=_metrics)
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "base_url": INVENTORY_BASE_URL,
+        "breaker": {"state": _breaker.state, "opened": _breaker.opened},
+        "operations": _metrics.stats()
+    }
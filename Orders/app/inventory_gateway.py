@@ -0,0 +1,120 @@
+# app/inventory_gateway.py
+"""Where cart and order code reserves, releases, finalizes and restocks stock.
+
+INVENTORY_TRANSPORT picks how the Products inventory is reached:
+
+- remote (default): one batched HTTP call per operation through the pooled
+  inventory_client (Products deployed as its own service)
+- inprocess: Products.crud is called directly with a Products session, for
+  deployments that run both services in one process against the same database.
+  No HTTP hop and no JSON round trip; Products keeps its own transaction.
+
+Every method takes all line items of one cart/order operation, so a cart change on
+several products costs one call (and one inventory transaction) either way.
+"""
+import json
+import os
+from typing import Dict, List, Optional
+
+from app.inventory_client import InventoryError, inventory_client
+
+INVENTORY_TRANSPORT = os.getenv("INVENTORY_TRANSPORT", "remote")
+
+
+class RemoteTransport:
+    name = "remote"
+
+    def reserve(self, items: List[dict], cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        return inventory_client.reserve(items, _cart(cart_id), idempotency_key)["reserved_items"]
+
+    def release(self, items: List[dict], cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        return inventory_client.release(items, _cart(cart_id), idempotency_key)["released_items"]
+
+    def finalize(self, items: List[dict], order_id: str, cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        return inventory_client.finalize(items, order_id, _cart(cart_id), idempotency_key)["finalized_items"]
+
+    def restock(self, items: List[dict], order_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        return inventory_client.restock(items, order_id, idempotency_key)["restocked_items"]
+
+
+class InProcessTransport:
+    name = "inprocess"
+
+    def __init__(self):
+        # Imported here so remote deployments never load the Products package
+        import Products.crud
+        from Products.database import SessionLocal
+        from Products.exceptions import InventoryConflictError
+        from Products.idempotency import idempotent, fingerprint
+        self._crud = Products.crud
+        self._session_factory = SessionLocal
+        self._conflict = InventoryConflictError
+        self._idempotent = idempotent
+        self._fingerprint = fingerprint
+
+    def _call(self, scope: str, call, idempotency_key: Optional[str], request: tuple) -> List[dict]:
+        def run():
+            db = self._session_factory()
+            try:
+                return call(db)
+            except self._conflict as e:
+                raise InventoryError(str(e), 409)
+            except ValueError as e:
+                raise InventoryError(str(e), 400)
+            finally:
+                db.close()
+
+        if not idempotency_key:
+            return run()
+        # The Products idempotency store, under scopes of its own (stored bodies differ from HTTP ones)
+        result = self._idempotent(
+            f"inprocess-{scope}", idempotency_key, self._fingerprint(*request), run, respond=lambda items: {"items": items}
+        )
+        if hasattr(result, "body"):
+            result = json.loads(result.body)
+        return result["items"]
+
+    def reserve(self, items: List[dict], cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        cart = _cart(cart_id)
+        return self._call("reserve", lambda db: self._crud.reserve_items(db, items, cart), idempotency_key, (items, cart))
+
+    def release(self, items: List[dict], cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        cart = _cart(cart_id)
+        return self._call("release", lambda db: self._crud.release_items(db, items, cart), idempotency_key, (items, cart))
+
+    def finalize(self, items: List[dict], order_id: str, cart_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        cart = _cart(cart_id)
+        return self._call(
+            "finalize", lambda db: self._crud.finalize_items(db, items, order_id, cart), idempotency_key, (items, order_id, cart)
+        )
+
+    def restock(self, items: List[dict], order_id: Optional[str] = None, idempotency_key: Optional[str] = None) -> List[dict]:
+        return self._call("restock", lambda db: self._crud.restock_items(db, items, order_id), idempotency_key, (items, order_id))
+
+
+TRANSPORTS = {"remote": RemoteTransport, "inprocess": InProcessTransport}
+
+
+def _cart(cart_id: Optional[int]) -> Optional[str]:
+    return str(cart_id) if cart_id is not None else None
+
+
+def coalesce(items: List[dict]) -> List[dict]:
+    """One line per product, quantities summed, zero quantities dropped"""
+    quantities: Dict[int, int] = {}
+    for item in items:
+        quantities[int(item["product_id"])] = quantities.get(int(item["product_id"]), 0) + int(item["quantity"])
+    return [{"product_id": pid, "quantity": q} for pid, q in quantities.items() if q > 0]
+
+
+_gateway = None
+
+
+def get_inventory_gateway():
+    """The configured transport, created on first use"""
+    global _gateway
+    if _gateway is None:
+        if INVENTORY_TRANSPORT not in TRANSPORTS:
+            raise ValueError(f"INVENTORY_TRANSPORT must be one of {', '.join(TRANSPORTS)}")
+        _gateway = TRANSPORTS[INVENTORY_TRANSPORT]()
+    return _gateway
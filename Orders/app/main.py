@@ -1,20 +1,38 @@
 # app/main.py
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import inspect, text
 
-from app.db import engine
+from app.db import engine, SessionLocal
 from app.models import Base                       # Contains all models (Order, Inventory, Cart, etc.)
 from app.carts.router import router as carts_router
 from app.orders.router import router as orders_router 
+from app.analytics.router import router as analytics_router
+from app import inventory_client
+from app.inventory_gateway import INVENTORY_TRANSPORT
+from app.outbox import OUTBOX_DISPATCHER, outbox_dispatcher
 
 # 1️⃣ Load environment variables (e.g. DATABASE_URL)
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if OUTBOX_DISPATCHER:
+        # Delivers order finalize/release messages, including any left by a previous run
+        outbox_dispatcher.start(SessionLocal)
+    yield
+    outbox_dispatcher.stop()
+    # Close the pooled keep-alive connections to Products
+    inventory_client.inventory_client.close()
+    await inventory_client.async_inventory_client.close()
+
 # 2️⃣ Create FastAPI instance with metadata
 app = FastAPI(
+    lifespan=lifespan,
     title="E-commerce Management API",
     version="1.0.0",
     description="Carts ↔ Orders",
@@ -33,7 +51,38 @@ app.add_middleware(
 
 # 4️⃣ Create all tables in DB if not exists
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist; add the nullable columns and the indexes
+# introduced since then (existing rows get NULL)
+quote = engine.dialect.identifier_preparer.quote
+with engine.begin() as conn:
+    for table in Base.metadata.sorted_tables:
+        present = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present and column.nullable:
+                conn.execute(text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                ))
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # 5️⃣ Mount routers with prefixes and tags
 app.include_router(carts_router, prefix="/carts", tags=["Carts"])
 app.include_router(orders_router, prefix="/orders", tags=["Orders"])
+app.include_router(analytics_router, prefix="/analytics", tags=["Analytics"])
+
+
+# 6️⃣ Latency, errors, retries and circuit state of the Products inventory client
+@app.get("/inventory-client/stats", tags=["Monitoring"])
+def inventory_client_stats():
+    return {"transport": INVENTORY_TRANSPORT, **inventory_client.stats()}
+
+
+# 7️⃣ Outbox backlog: pending / done / failed finalize and release messages
+@app.get("/outbox/stats", tags=["Monitoring"])
+def outbox_stats():
+    db = SessionLocal()
+    try:
+        return outbox_dispatcher.stats(db)
+    finally:
+        db.close()
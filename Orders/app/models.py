@@ -1,8 +1,8 @@
 import enum
 from datetime import datetime, timezone
 from sqlalchemy import (
-    Column, Integer, String, Float, DateTime, ForeignKey, Enum,
-    JSON, Numeric
+    Column, Integer, String, Float, Date, DateTime, ForeignKey, Enum,
+    JSON, Numeric, Index
 )
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.sql import func
@@ -56,4 +56,80 @@ class Order(Base):
     total_amount = Column(Float, nullable=False)
     status = Column(Enum(OrderStatus), default=OrderStatus.pending, nullable=False)
     payment_method = Column(String(50), nullable=True)
-    shipping_address = Column(String(255), nullable=False)
\ No newline at end of file
+    shipping_address = Column(String(255), nullable=False)
+    cart_id = Column(Integer, nullable=True)  # cart whose reservations the order takes over
+
+    # Same lines as `items`, one row each, for per-product SQL
+    line_items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan", passive_deletes=True)
+
+    # Keyset pages walk (order_date, order_id) newest first, optionally within one user or status
+    __table_args__ = (
+        Index("ix_orders_date_id", "order_date", "order_id"),
+        Index("ix_orders_user_date_id", "user_id", "order_date", "order_id"),
+        Index("ix_orders_status_date_id", "status", "order_date", "order_id"),
+    )
+
+class OrderItem(Base):
+    """One line of an order, written with it (Order.items keeps the JSON snapshot)"""
+    __tablename__ = "order_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    order_id = Column(Integer, ForeignKey("orders.order_id", ondelete="CASCADE"), nullable=False, index=True)
+    product_id = Column(Integer, nullable=False)
+    name = Column(String(100), nullable=True)
+    quantity = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)
+
+    order = relationship("Order", back_populates="line_items")
+
+    __table_args__ = (
+        # Per-product aggregates and "orders containing X" read only this index
+        Index("ix_order_items_product_order", "product_id", "order_id", "quantity", "price"),
+    )
+
+# ─────────────────────────────────────────────────────
+#  Outbox (inventory calls owed to Products)
+# ─────────────────────────────────────────────────────
+class OutboxMessage(Base):
+    """A finalize/release/restock for one order, committed with the order and delivered by app.outbox"""
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(20), nullable=False)           # finalize | release | restock
+    order_id = Column(Integer, nullable=False, index=True)
+    items = Column(JSON, nullable=False)                # [{"product_id", "quantity", "cart_id"?}]
+    status = Column(String(20), nullable=False, default="pending")  # pending | done | failed | canceled
+    batch_key = Column(String(64), nullable=True, index=True)       # Idempotency-Key of the delivery
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=utc_now)
+    last_error = Column(String(500), nullable=True)
+    created_at = Column(DateTime, nullable=False, default=utc_now)
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+
+# ─────────────────────────────────────────────────────
+#  Sales rollups (kept current by app.analytics.rollups)
+# ─────────────────────────────────────────────────────
+class SalesDailyProduct(Base):
+    """Units, revenue and order count per UTC day and product, cancelled orders excluded"""
+    __tablename__ = "sales_daily_product"
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True, index=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)
+    orders = Column(Integer, nullable=False, default=0)
+
+class SalesDailyCategory(Base):
+    """Same measures per UTC day and product category (0 when the category is unknown)"""
+    __tablename__ = "sales_daily_category"
+
+    day = Column(Date, primary_key=True)
+    category_id = Column(Integer, primary_key=True, index=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)
+    orders = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,85 @@
+# app/orders/backfill_items.py
+"""Copy the JSON `items` of existing orders into order_items.
+
+Walks orders by order_id in batches and commits after each one, so it can run against a
+live database and be stopped and resumed (--start-after the last id it logged). Orders
+that already have order_items rows are skipped, including ones create_order wrote.
+
+    python -m app.orders.backfill_items --batch-size 2000
+"""
+import argparse
+import logging
+import time
+from typing import List, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from app.db import SessionLocal
+from app.models import Order, OrderItem
+
+BATCH_SIZE = 1000
+
+
+def _rows(order_id: int, items) -> List[dict]:
+    rows = []
+    for item in items or []:
+        try:
+            rows.append({
+                "order_id": order_id,
+                "product_id": int(item["product_id"]),
+                "name": str(item["name"])[:100] if item.get("name") else None,
+                "quantity": int(item["quantity"]),
+                "price": float(item["price"])
+            })
+        except (KeyError, TypeError, ValueError):
+            logging.warning(f"Order {order_id}: skipping malformed item {item!r}")
+    return rows
+
+
+def backfill_batch(db: Session, after_id: int, batch_size: int = BATCH_SIZE) -> Optional[int]:
+    """Backfill the next batch_size orders after `after_id`; returns the last id seen (None when done)"""
+    orders = db.execute(
+        select(Order.order_id, Order.items).where(Order.order_id > after_id).order_by(Order.order_id).limit(batch_size)
+    ).all()
+    if not orders:
+        return None
+    ids = [order_id for order_id, _ in orders]
+    done = set(db.execute(select(OrderItem.order_id).where(OrderItem.order_id.in_(ids)).distinct()).scalars())
+    rows = [row for order_id, items in orders if order_id not in done for row in _rows(order_id, items)]
+    if rows:
+        db.execute(insert(OrderItem), rows)
+    db.commit()
+    return ids[-1]
+
+
+def backfill(db: Session, batch_size: int = BATCH_SIZE, start_after: int = 0) -> int:
+    """Run batches until every order is covered; returns the last order_id seen"""
+    started = time.perf_counter()
+    last_id = start_after
+    while True:
+        next_id = backfill_batch(db, last_id, batch_size)
+        if next_id is None:
+            break
+        last_id = next_id
+        logging.info(f"order_items backfilled through order_id={last_id}")
+    logging.info(f"order_items backfill finished in {time.perf_counter() - started:.1f}s")
+    return last_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill order_items from orders.items")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--start-after", type=int, default=0, help="Resume after this order_id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        backfill(db, args.batch_size, args.start_after)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
-from typing import List
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from app import models
+from app.db import SessionLocal
 from app.orders import schemas  
+from app import outbox
+from app.analytics import rollups
 
 def create_order(db: Session, order_in: schemas.OrderCreate) -> models.Order:
     total = sum(item.quantity * item.price for item in order_in.items)
@@ -11,23 +19,25 @@ def create_order(db: Session, order_in: schemas.OrderCreate) -> models.Order:
         items            = [item.model_dump() for item in order_in.items],
         total_amount     = total,
         payment_method   = order_in.payment_method,
-        shipping_address = order_in.shipping_address
+        shipping_address = order_in.shipping_address,
+        cart_id          = order_in.cart_id,
+        line_items       = [
+            models.OrderItem(product_id=item.product_id, name=item.name, quantity=item.quantity, price=item.price)
+            for item in order_in.items
+        ]
     )
     db.add(db_order)
+    db.flush()
+
+    # Finalize reserved stock: queued in this transaction, delivered by the outbox dispatcher
+    outbox.enqueue(db, "finalize", db_order.order_id, [
+        {"product_id": item.product_id, "quantity": item.quantity, "cart_id": order_in.cart_id}
+        for item in order_in.items
+    ])
+    # Count the order in the daily sales rollups, in the same transaction
+    rollups.apply_delta(db, [(db_order.order_date, db_order.items)], 1)
     db.commit()
     db.refresh(db_order)
-
-    # Finalize reserved stock
-    try:
-        reservations = [
-            {"product_id": item.product_id, "quantity": item.quantity}
-            for item in order_in.items
-        ]
-        finalize_reserved_products(reservations, order_id=str(db_order.id))
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=f"Order created but finalization failed: {str(e)}")
-
     return db_order
 
 
@@ -38,16 +48,152 @@ def get_order(db: Session, order_id: int) -> models.Order:
                             detail=f"Order {order_id} not found")
     return order
 
-def list_orders(db: Session):
-    return db.query(models.Order).all()
+def encode_cursor(order_date: datetime, order_id: int) -> str:
+    """Opaque, URL-safe token for the (order_date, order_id) of the last order on a page"""
+    payload = json.dumps({"d": order_date.replace(tzinfo=None).isoformat(), "id": order_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode((cursor + "=" * (-len(cursor) % 4)).encode()))
+        return datetime.fromisoformat(payload["d"]), int(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed cursor")
+
+def _filtered(stmt, user_id: Optional[int], status_str: Optional[str], date_from: Optional[datetime], date_to: Optional[datetime]):
+    """Equality filters first, so each one lines up with a (column, order_date, order_id) index"""
+    Order = models.Order
+    if user_id is not None:
+        stmt = stmt.where(Order.user_id == user_id)
+    if status_str is not None:
+        try:
+            stmt = stmt.where(Order.status == models.OrderStatus(status_str))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Invalid status: {status_str}")
+    if date_from is not None:
+        stmt = stmt.where(Order.order_date >= date_from.replace(tzinfo=None))
+    if date_to is not None:
+        stmt = stmt.where(Order.order_date < date_to.replace(tzinfo=None))
+    return stmt.order_by(Order.order_date.desc(), Order.order_id.desc())
+
+def list_orders(
+    db: Session,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    user_id: Optional[int] = None,
+    status_str: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+) -> Tuple[List[models.Order], Optional[str]]:
+    """One page of orders, newest first, plus the cursor of the next page (None on the last)"""
+    Order = models.Order
+    stmt = _filtered(select(Order), user_id, status_str, date_from, date_to)
+    if cursor:
+        order_date, order_id = decode_cursor(cursor)
+        # Row-value comparison spelled out so every backend can seek the index
+        stmt = stmt.where(or_(
+            Order.order_date < order_date,
+            and_(Order.order_date == order_date, Order.order_id < order_id)
+        ))
+    orders = db.execute(stmt.limit(limit + 1)).scalars().all()
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1].order_date, orders[-1].order_id)
+    return orders, next_cursor
+
+# ─────────────────────────────────────────────────────
+#  Per-product sales (order_items aggregates)
+# ─────────────────────────────────────────────────────
+def _sales_select(date_from: Optional[datetime], date_to: Optional[datetime]):
+    """units / revenue / order count over order_items of orders that were not cancelled"""
+    OrderItem, Order = models.OrderItem, models.Order
+    stmt = select(
+        OrderItem.product_id,
+        func.count(func.distinct(OrderItem.order_id)).label("orders"),
+        func.sum(OrderItem.quantity).label("units_sold"),
+        func.sum(OrderItem.quantity * OrderItem.price).label("revenue")
+    ).join(Order, Order.order_id == OrderItem.order_id)\
+        .where(Order.status != models.OrderStatus.canceled)
+    if date_from is not None:
+        stmt = stmt.where(Order.order_date >= date_from.replace(tzinfo=None))
+    if date_to is not None:
+        stmt = stmt.where(Order.order_date < date_to.replace(tzinfo=None))
+    return stmt.group_by(OrderItem.product_id)
+
+def product_sales(db: Session, product_id: int, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> dict:
+    row = db.execute(
+        _sales_select(date_from, date_to).where(models.OrderItem.product_id == product_id)
+    ).mappings().first()
+    if row is None:
+        return {"product_id": product_id, "orders": 0, "units_sold": 0, "revenue": 0.0}
+    return {**row, "revenue": round(row["revenue"] or 0, 2)}
+
+def top_products(db: Session, limit: int = 20, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> List[dict]:
+    rows = db.execute(
+        _sales_select(date_from, date_to).order_by(func.sum(models.OrderItem.quantity).desc()).limit(limit)
+    ).mappings()
+    return [{**row, "revenue": round(row["revenue"] or 0, 2)} for row in rows]
+
+def orders_with_product(db: Session, product_id: int, limit: int = 50, before_id: Optional[int] = None) -> List[models.Order]:
+    """Orders containing a product, highest order_id first (pass the last id as before_id)"""
+    Order, OrderItem = models.Order, models.OrderItem
+    order_ids = select(OrderItem.order_id).where(OrderItem.product_id == product_id)
+    if before_id is not None:
+        order_ids = order_ids.where(OrderItem.order_id < before_id)
+    return db.execute(
+        select(Order).where(Order.order_id.in_(order_ids)).order_by(Order.order_id.desc()).limit(limit)
+    ).scalars().all()
+
+EXPORT_CHUNK_SIZE = int(os.getenv("ORDER_EXPORT_CHUNK_SIZE", "1000"))
+
+def iter_orders_ndjson(
+    user_id: Optional[int] = None,
+    status_str: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Every matching order as one JSON line, read through a server-side cursor.
+
+    Opens its own session so the stream can outlive the request handler; memory stays at
+    one chunk of rows whatever the number of orders. Filters are checked before the
+    first byte is sent, so a bad status is still a 400.
+    """
+    Order = models.Order
+    stmt = _filtered(
+        select(Order.order_id, Order.user_id, Order.order_date, Order.status, Order.total_amount,
+               Order.payment_method, Order.shipping_address, Order.items),
+        user_id, status_str, date_from, date_to
+    )
+    return _stream_ndjson(stmt, chunk_size)
+
+def _stream_ndjson(stmt, chunk_size: int) -> Iterator[bytes]:
+    db = SessionLocal()
+    try:
+        result = db.execute(stmt.execution_options(stream_results=True, yield_per=chunk_size))
+        for partition in result.partitions():
+            yield b"".join(
+                json.dumps({
+                    **row._asdict(),
+                    "order_date": row.order_date.isoformat(),
+                    "status": row.status.value
+                }, separators=(",", ":")).encode() + b"\n"
+                for row in partition
+            )
+    finally:
+        db.close()
 
 def update_order_status(db: Session, order_id: int, status_str: str):
     order = get_order(db, order_id)
+    old_status = order.status
     try:
         order.status = models.OrderStatus(status_str)
     except ValueError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Invalid status: {status_str}")
+    rollups.on_status_change(db, order, old_status)
     db.commit()
     db.refresh(order)
     return order
@@ -57,47 +203,21 @@ def cancel_order(db: Session, order_id: int):
     if order.status == models.OrderStatus.canceled:  
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "Order already cancelled")
 
+    old_status = order.status
     order.status = models.OrderStatus.canceled
+    rollups.on_status_change(db, order, old_status)
 
-    # Release reserved products
-    try:
-        reservations = [
-            {"product_id": item.get("product_id"), "quantity": item.get("quantity", 0)}
-            for item in order.items
-        ]
-        release_reserved_products(reservations, order_id=str(order.id))
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=f"Order cancelled but releasing reserved products failed: {str(e)}")
-
+    # Committed together with the status change. A finalize no dispatcher has claimed yet
+    # sold nothing: withdraw it and release the cart's holds (without a cart a release could
+    # take another cart's, so the expiry sweeper frees them). Otherwise put the sold units
+    # back on sale once the finalize is settled
+    items = [
+        {"product_id": item.get("product_id"), "quantity": item.get("quantity", 0), "cart_id": order.cart_id}
+        for item in order.items
+    ]
+    if outbox.withdraw(db, "finalize", order.order_id):
+        if order.cart_id is not None:
+            outbox.enqueue(db, "release", order.order_id, items)
+    else:
+        outbox.enqueue(db, "restock", order.order_id, items)
     db.commit()
-
-import requests
-
-def finalize_reserved_products(reservations: List[dict], order_id: str, base_url: str = "http://localhost:8000"):
-    """
-    Call the /products/finalize endpoint to mark reserved products as sold
-    """
-    url = f"{base_url}/products/finalize"
-    payload = {
-        "reservations": reservations,
-        "order_id": order_id
-    }
-    response = requests.post(url, json=payload)
-    if response.status_code != 200:
-        raise Exception(f"Failed to finalize products: {response.json().get('detail')}")
-    return response.json()
-
-def release_reserved_products(reservations: List[dict], order_id: str, base_url: str = "http://localhost:8000"):
-    """
-    Call the /products/release endpoint to free up reserved products on cancellation
-    """
-    url = f"{base_url}/products/release"
-    payload = {
-        "reservations": reservations,
-        "order_id": order_id
-    }
-    response = requests.post(url, json=payload)
-    if response.status_code != 200:
-        raise Exception(f"Failed to release products: {response.json().get('detail')}")
-    return response.json()
\ No newline at end of file
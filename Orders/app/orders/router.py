@@ -1,4 +1,7 @@
-from fastapi import APIRouter, Depends, status
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, Query, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from app.dependencies import get_db
 from app.orders import crud, schemas
@@ -10,23 +13,79 @@ router = APIRouter(tags=["Orders"])
 def create_order(order_in: schemas.OrderCreate, db: Session = Depends(get_db)):
     return crud.create_order(db, order_in)
 
+# List orders, newest first, one keyset page at a time (next page cursor in X-Next-Cursor)
+@router.get("/", response_model=list[schemas.OrderResponse])
+def list_orders(
+    response: Response,
+    limit: int = Query(50, ge=1, le=500, description="Orders per page"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    user_id: Optional[int] = Query(None, description="Only this user's orders"),
+    status_filter: Optional[str] = Query(None, alias="status", description="Only orders in this status"),
+    date_from: Optional[datetime] = Query(None, description="Placed at or after (UTC)"),
+    date_to: Optional[datetime] = Query(None, description="Placed before (UTC)"),
+    db: Session = Depends(get_db)
+):
+    orders, next_cursor = crud.list_orders(db, limit, cursor, user_id, status_filter, date_from, date_to)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return orders
+
+# Stream every matching order as NDJSON (back-office exports; constant memory)
+@router.get("/export")
+def export_orders(
+    user_id: Optional[int] = Query(None, description="Only this user's orders"),
+    status_filter: Optional[str] = Query(None, alias="status", description="Only orders in this status"),
+    date_from: Optional[datetime] = Query(None, description="Placed at or after (UTC)"),
+    date_to: Optional[datetime] = Query(None, description="Placed before (UTC)")
+):
+    return StreamingResponse(
+        crud.iter_orders_ndjson(user_id, status_filter, date_from, date_to),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=orders.ndjson"}
+    )
+
+# Best-selling products (units), optionally within a date range; excludes cancelled orders
+@router.get("/sales/products", response_model=list[schemas.ProductSalesResponse])
+def get_top_products(
+    limit: int = Query(20, ge=1, le=500),
+    date_from: Optional[datetime] = Query(None, description="Placed at or after (UTC)"),
+    date_to: Optional[datetime] = Query(None, description="Placed before (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.top_products(db, limit, date_from, date_to)
+
+# Units sold, revenue and order count of one product
+@router.get("/sales/products/{product_id}", response_model=schemas.ProductSalesResponse)
+def get_product_sales(
+    product_id: int,
+    date_from: Optional[datetime] = Query(None, description="Placed at or after (UTC)"),
+    date_to: Optional[datetime] = Query(None, description="Placed before (UTC)"),
+    db: Session = Depends(get_db)
+):
+    return crud.product_sales(db, product_id, date_from, date_to)
+
+# Orders that contain a product, newest id first (page with before_id = last order_id)
+@router.get("/by-product/{product_id}", response_model=list[schemas.OrderResponse])
+def get_orders_with_product(
+    product_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    before_id: Optional[int] = Query(None, description="Only orders with a lower order_id"),
+    db: Session = Depends(get_db)
+):
+    return crud.orders_with_product(db, product_id, limit, before_id)
+
 # Get a specific order by ID
 @router.get("/{order_id}", response_model=schemas.OrderResponse)
 def get_order(order_id: int, db: Session = Depends(get_db)):
     return crud.get_order(db, order_id)
 
-# List all orders
-@router.get("/", response_model=list[schemas.OrderResponse])
-def list_orders(db: Session = Depends(get_db)):
-    return crud.list_orders(db)
-
 # Update order status
 @router.patch("/{order_id}/status", response_model=schemas.OrderResponse)
 def update_order_status(order_id: int, status_in: schemas.OrderStatusUpdate, db: Session = Depends(get_db)):
     return crud.update_order_status(db, order_id, status_in.status)
 
-# Cancel an order — triggers product release
+# Cancel an order — releases its reserved stock, or restocks what was already sold
 @router.delete("/{order_id}", response_model=schemas.OrderCancelResponse)
 def cancel_order(order_id: int, db: Session = Depends(get_db)):
     crud.cancel_order(db, order_id)
-    return {"detail": f"Order {order_id} canceled and reserved inventory released."}
\ No newline at end of file
+    return {"detail": f"Order {order_id} canceled; its inventory will be released or restocked."}
\ No newline at end of file
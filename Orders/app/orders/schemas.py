@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, PositiveInt
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -17,6 +17,7 @@ class OrderCreate(BaseModel):
     items: List[Item]
     payment_method: str = Field(..., min_length=3, max_length=225)
     shipping_address: str = Field(..., min_length=5, max_length=255)
+    cart_id: Optional[PositiveInt] = None  # cart checked out: its reservations are finalized
 
 
 # --- Response model for each item inside OrderResponse ---
@@ -49,6 +50,14 @@ class OrderCancelResponse(BaseModel):
     detail: str
 
 
+# --- Per-product sales from order_items ---
+class ProductSalesResponse(BaseModel):
+    product_id: int
+    orders: int
+    units_sold: int
+    revenue: float
+
+
 # --- This seems related to the cart, not orders ---
 class CartItemResponse(BaseModel):
     product_id: PositiveInt
@@ -0,0 +1,383 @@
+# app/outbox.py
+"""Transactional outbox for the inventory calls an order owes Products.
+
+create_order / cancel_order only add an OutboxMessage in the same transaction as the
+order change, so the client waits for one local commit, and an order that commits is
+guaranteed to be finalized (or released / restocked) eventually. A background
+OutboxDispatcher delivers the messages:
+
+- due messages are claimed in batches (SKIP LOCKED, so several Orders instances can
+  share the work) and grouped by kind: one call per kind and batch, items sorted by
+  product and tagged with their order_id and the order's cart, so Products settles only
+  that cart's reservations
+- each batch gets an Idempotency-Key stored on its rows before the first attempt, so
+  a retry after a lost response (or a crash) is replayed by Products, never applied twice:
+  Products records the key in its idempotency_keys table in the transaction of the
+  stock change, so this holds across restarts of either side
+- a finalize line Products skipped (nothing left to sell) leaves its message failed,
+  holding only the skipped items
+- cancelling an order withdraws its finalize if no dispatcher claimed it yet (nothing was
+  sold: the cart's holds are released); otherwise the sold units are restocked. A restock
+  waits until the finalize is settled and leaves out the units it failed to sell
+- unavailable / busy Products: the batch is retried with exponential backoff
+- a rejected batch is split into single messages; a message rejected on its own is
+  marked failed with the error
+"""
+import logging
+import os
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, exists, func, or_, select, update
+from sqlalchemy.orm import Session, aliased
+
+from app.models import OutboxMessage
+from app.inventory_client import InventoryError, InventoryUnavailableError
+from app.inventory_gateway import get_inventory_gateway
+
+OUTBOX_DISPATCHER = os.getenv("OUTBOX_DISPATCHER", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "60"))
+# A claimed batch is hidden from other dispatchers this long (covers the delivery call)
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "30"))
+
+_INFO_KEY = "outbox_enqueued"
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue(db: Session, kind: str, order_id: int, items: List[dict]) -> None:
+    """Add a finalize/release/restock message to the current transaction of `db` (no commit)"""
+    now = _now()
+    db.add(OutboxMessage(
+        kind=kind,
+        order_id=order_id,
+        items=[_item(i) for i in items if int(i["quantity"]) > 0],
+        status="pending",
+        next_attempt_at=now,
+        created_at=now
+    ))
+    db.info[_INFO_KEY] = True
+
+
+def withdraw(db: Session, kind: str, order_id: int) -> bool:
+    """Cancel the order's messages of `kind` if no dispatcher has claimed them yet.
+
+    Their rows are locked first, so a dispatcher either claimed them before (False is
+    returned and they stay as they are) or skips them until this transaction ends.
+    """
+    messages = db.execute(
+        select(OutboxMessage).where(OutboxMessage.kind == kind, OutboxMessage.order_id == order_id).with_for_update()
+    ).scalars().all()
+    if not messages or any(m.status != "pending" or m.batch_key is not None for m in messages):
+        return False
+    for message in messages:
+        message.status = "canceled"
+        message.processed_at = _now()
+    return True
+
+
+def _item(item: dict) -> dict:
+    line = {"product_id": int(item["product_id"]), "quantity": int(item["quantity"])}
+    if item.get("cart_id") is not None:
+        line["cart_id"] = int(item["cart_id"])
+    return line
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_dispatcher(session: Session) -> None:
+    if session.info.pop(_INFO_KEY, False):
+        outbox_dispatcher.wake()
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_enqueued(session: Session, previous_transaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop(_INFO_KEY, None)
+
+
+def _payload(messages: List[dict]) -> List[dict]:
+    """Items of every message, one line per (product, order, cart), in product order.
+    Lines without a cart (orders placed without one) let Products settle any cart's hold."""
+    lines: Dict[tuple, int] = {}
+    for message in messages:
+        for item in message["items"]:
+            key = (item["product_id"], message["order_id"], item.get("cart_id"))
+            lines[key] = lines.get(key, 0) + item["quantity"]
+    return [
+        {"product_id": product_id, "quantity": quantity, "order_id": order_id, **({"cart_id": cart_id} if cart_id is not None else {})}
+        for (product_id, order_id, cart_id), quantity in sorted(lines.items(), key=lambda line: (line[0][0], line[0][1], line[0][2] or 0))
+    ]
+
+
+def _line_key(product_id, order_id, cart_id) -> tuple:
+    return int(product_id), str(order_id), str(cart_id) if cart_id is not None else None
+
+
+def _skipped(messages: List[dict], settled: List[dict]) -> Dict[int, List[dict]]:
+    """Items of each message that have no line in the Products response, by message id"""
+    covered = {_line_key(line["product_id"], line.get("order_id"), line.get("cart_id")) for line in settled}
+    skipped: Dict[int, List[dict]] = {}
+    for message in messages:
+        items = [i for i in message["items"] if _line_key(i["product_id"], message["order_id"], i.get("cart_id")) not in covered]
+        if items:
+            skipped[message["id"]] = items
+    return skipped
+
+
+def _unsold(db: Session, order_ids) -> Dict[int, Dict[int, int]]:
+    """Units failed finalize messages hold (never sold), per order and product"""
+    unsold: Dict[int, Dict[int, int]] = {}
+    if not order_ids:
+        return unsold
+    for order_id, items in db.execute(
+        select(OutboxMessage.order_id, OutboxMessage.items)
+        .where(OutboxMessage.kind == "finalize", OutboxMessage.status == "failed", OutboxMessage.order_id.in_(order_ids))
+    ):
+        per_product = unsold.setdefault(order_id, {})
+        for item in items:
+            per_product[item["product_id"]] = per_product.get(item["product_id"], 0) + item["quantity"]
+    return unsold
+
+
+def _sold(items: List[dict], unsold: Dict[int, int]) -> List[dict]:
+    """`items` less the units in `unsold`"""
+    left = dict(unsold)
+    sold = []
+    for item in items:
+        kept = min(item["quantity"], left.get(item["product_id"], 0))
+        left[item["product_id"]] = left.get(item["product_id"], 0) - kept
+        if item["quantity"] > kept:
+            sold.append({**item, "quantity": item["quantity"] - kept})
+    return sold
+
+
+def _new_key(kind: str) -> str:
+    return f"outbox-{kind}-{uuid.uuid4().hex}"
+
+
+class OutboxDispatcher:
+    """Background thread delivering outbox messages to the inventory gateway"""
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll_seconds: float = OUTBOX_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._cond = threading.Condition()
+        self._woken = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._session_factory = None
+        self.delivered = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+
+    def start(self, session_factory) -> None:
+        if self._thread is not None:
+            return
+        self._session_factory = session_factory
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def wake(self) -> None:
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._woken and not self._stopping:
+                    self._cond.wait(self.poll_seconds)
+                if self._stopping:
+                    return
+                self._woken = False
+            db = self._session_factory()
+            try:
+                while self.dispatch(db) and not self._stopping:
+                    pass
+            except Exception as e:
+                logging.error(f"Outbox dispatch failed: {e}")
+            finally:
+                db.close()
+
+    # ---------------------------------------------------------
+    # One round
+    # ---------------------------------------------------------
+
+    def dispatch(self, db: Session) -> int:
+        """Deliver one round of due messages; returns how many were claimed (0: nothing due)"""
+        batches = self._claim(db)
+        for batch_key, messages in batches.items():
+            self._deliver(db, batch_key, messages)
+        return sum(len(messages) for messages in batches.values())
+
+    def _claim(self, db: Session) -> Dict[str, List[dict]]:
+        """Due messages grouped by batch_key, leased to this dispatcher.
+
+        New messages get one key per kind. A retried batch must go out exactly as first
+        sent (same items under the same key), so its rows are always loaded together.
+        A restock is held back while its order's finalize is pending, then loses the
+        units that finalize failed to sell before it is first sent.
+        """
+        now = _now()
+        columns = (OutboxMessage.id, OutboxMessage.kind, OutboxMessage.order_id, OutboxMessage.items,
+                   OutboxMessage.batch_key, OutboxMessage.attempts)
+        finalize = aliased(OutboxMessage)
+        due = [dict(row) for row in db.execute(
+            select(*columns)
+            .where(
+                OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now,
+                or_(OutboxMessage.kind != "restock", ~exists().where(
+                    finalize.kind == "finalize", finalize.order_id == OutboxMessage.order_id, finalize.status == "pending"
+                ))
+            )
+            .order_by(OutboxMessage.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        ).mappings()]
+        retried = {m["batch_key"] for m in due if m["batch_key"] is not None}
+        if retried:
+            seen = {m["id"] for m in due}
+            due.extend(dict(row) for row in db.execute(
+                select(*columns)
+                .where(OutboxMessage.status == "pending", OutboxMessage.batch_key.in_(retried))
+                .with_for_update(skip_locked=True)
+            ).mappings() if row["id"] not in seen)
+        if not due:
+            db.rollback()
+            return {}
+
+        restocks = [m for m in due if m["kind"] == "restock" and m["batch_key"] is None]
+        unsold = _unsold(db, {m["order_id"] for m in restocks})
+        for message in restocks:
+            if message["order_id"] in unsold:
+                message["items"] = _sold(message["items"], unsold[message["order_id"]])
+                db.execute(update(OutboxMessage).where(OutboxMessage.id == message["id"]).values(items=message["items"]))
+
+        keys: Dict[str, str] = {}
+        for message in due:
+            if message["batch_key"] is None:
+                message["batch_key"] = keys.setdefault(message["kind"], _new_key(message["kind"]))
+        for kind, key in keys.items():
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_([m["id"] for m in due if m["batch_key"] == key]))
+                .values(batch_key=key)
+            )
+        db.execute(
+            update(OutboxMessage).where(OutboxMessage.id.in_([m["id"] for m in due]))
+            .values(next_attempt_at=now + timedelta(seconds=OUTBOX_LEASE_SECONDS))
+        )
+        db.commit()
+
+        batches: Dict[str, List[dict]] = {}
+        for message in due:
+            batches.setdefault(message["batch_key"], []).append(message)
+        return batches
+
+    def _deliver(self, db: Session, batch_key: str, messages: List[dict]) -> None:
+        gateway = get_inventory_gateway()
+        kind = messages[0]["kind"]
+        ids = [m["id"] for m in messages]
+        try:
+            if kind == "finalize":
+                settled = gateway.finalize(_payload(messages), order_id=None, idempotency_key=batch_key)
+            elif kind == "restock":
+                # Empty when the finalize sold nothing
+                if _payload(messages):
+                    gateway.restock(_payload(messages), idempotency_key=batch_key)
+            else:
+                gateway.release(_payload(messages), idempotency_key=batch_key)
+        except InventoryUnavailableError as e:
+            return self._retry_later(db, ids, messages[0]["attempts"], e.detail)
+        except InventoryError as e:
+            if e.status_code == 409:
+                return self._retry_later(db, ids, messages[0]["attempts"], e.detail)
+            if len(messages) > 1:
+                # Find the message Products rejects: retry each one in a batch of its own
+                for message_id in ids:
+                    db.execute(
+                        update(OutboxMessage).where(OutboxMessage.id == message_id)
+                        .values(batch_key=_new_key(kind), next_attempt_at=_now())
+                    )
+                db.commit()
+                logging.warning(f"Outbox batch of {len(messages)} rejected ({e.detail}); retrying one by one")
+                return
+            db.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(ids))
+                .values(status="failed", last_error=str(e.detail)[:500], processed_at=_now(), attempts=OutboxMessage.attempts + 1)
+            )
+            db.commit()
+            self.failed += 1
+            logging.error(f"Outbox {kind} for order {messages[0]['order_id']} failed: {e.detail}")
+            return
+
+        # A release may return less than asked (expired reservations were returned by the
+        # sweeper already); a finalize line missing from the response was not sold
+        skipped = _skipped(messages, settled) if kind == "finalize" else {}
+        for message_id, items in skipped.items():
+            db.execute(
+                update(OutboxMessage).where(OutboxMessage.id == message_id)
+                .values(
+                    status="failed", items=items, last_error="Products skipped these items: not enough stock",
+                    processed_at=_now(), attempts=OutboxMessage.attempts + 1
+                )
+            )
+        done = [message_id for message_id in ids if message_id not in skipped]
+        if done:
+            db.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(done))
+                .values(status="done", processed_at=_now(), attempts=OutboxMessage.attempts + 1)
+            )
+        db.commit()
+        self.batches += 1
+        self.delivered += len(done)
+        if skipped:
+            self.failed += len(skipped)
+            logging.error(f"Outbox finalize skipped items of {len(skipped)} order(s): {sorted(m['order_id'] for m in messages if m['id'] in skipped)}")
+
+    def _retry_later(self, db: Session, ids: List[int], attempts: int, error: str) -> None:
+        delay = min(OUTBOX_MAX_BACKOFF, random.uniform(0.5, 1.0) * 2 ** attempts)
+        db.execute(
+            update(OutboxMessage).where(OutboxMessage.id.in_(ids))
+            .values(attempts=OutboxMessage.attempts + 1, last_error=str(error)[:500], next_attempt_at=_now() + timedelta(seconds=delay))
+        )
+        db.commit()
+        self.retries += 1
+        logging.warning(f"Outbox delivery of {len(ids)} message(s) failed ({error}); retrying in {delay:.1f}s")
+
+    def stats(self, db: Session) -> Dict[str, Any]:
+        counts = dict(db.execute(select(OutboxMessage.status, func.count()).group_by(OutboxMessage.status)).all())
+        oldest = db.execute(select(func.min(OutboxMessage.created_at)).where(OutboxMessage.status == "pending")).scalar()
+        return {
+            "running": self._thread is not None,
+            "pending": counts.get("pending", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "canceled": counts.get("canceled", 0),
+            "oldest_pending": oldest.isoformat() if oldest else None,
+            "delivered": self.delivered,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed_messages": self.failed
+        }
+
+
+outbox_dispatcher = OutboxDispatcher()
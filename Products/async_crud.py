@@ -0,0 +1,130 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+import Products.crud, Products.models
+from Products.database import SessionLocal
+from Products.reservation_engine import reservation_engine
+from Products.ledger import ledger_writer
+from Products import inventory_shards
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Simple reads are written against the AsyncSession directly. Paths built from many sync
+# helpers (search, facets, counts, the inventory write pipeline) run through run_sync(),
+# which executes the sync code on a greenlet: every statement still awaits the asyncio
+# driver, so no threadpool worker is held for the round trips.
+
+_shards = Products.models.InventoryShard.__table__
+
+
+async def list_products(
+    session: AsyncSession,
+    skip: int,
+    limit: int,
+    search: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_dir: str = "desc",
+    filters: Optional[Dict[str, Any]] = None,
+    estimated: bool = False
+) -> Tuple[List[Dict[str, Any]], Tuple[int, bool]]:
+    """Offset page of product list rows plus (total, is_estimate)"""
+    def page(db):
+        return (
+            Products.crud.list_product_summaries(db, skip, limit, search, sort_by, sort_dir, filters),
+            Products.crud.count_products(db, search, filters, estimated=estimated)
+        )
+    return await session.run_sync(page)
+
+
+async def list_products_keyset(
+    session: AsyncSession,
+    limit: int,
+    cursor: Optional[str] = None,
+    search: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_dir: str = "desc",
+    filters: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    return await session.run_sync(
+        Products.crud.list_product_summaries_keyset, limit, cursor, search, sort_by, sort_dir, filters
+    )
+
+
+async def count_products(session: AsyncSession, search: Optional[str], filters: Optional[Dict[str, Any]], estimated: bool) -> Tuple[int, bool]:
+    return await session.run_sync(Products.crud.count_products, search, filters, estimated)
+
+
+async def get_product_detail(session: AsyncSession, product_id: int) -> Optional[bytes]:
+    """Cached JSON detail; only a cache miss touches the database"""
+    payload = Products.crud.product_detail_cache.get(product_id)
+    if payload is not None:
+        return payload
+    return await session.run_sync(Products.crud.get_product_detail, product_id)
+
+
+async def get_inventory_by_product_id(session: AsyncSession, product_id: int):
+    Inventory = Products.models.Inventory
+    inventory = (await session.execute(select(Inventory).where(Inventory.product_id == product_id))).scalar_one_or_none()
+    if inventory is None:
+        return None
+    if inventory.shard_count:
+        shards = _shards.c
+        rows = (await session.execute(
+            select(shards.id, shards.quantity_available, shards.quantity_reserve).where(shards.product_id == product_id)
+        )).all()
+        available, reserved = inventory_shards.totals([(row[0], row[1] or 0, row[2] or 0) for row in rows])
+        set_committed_value(inventory, "quantity_available", available)
+        set_committed_value(inventory, "quantity_reserve", reserved)
+    if reservation_engine.enabled:
+        # The engine's counters run ahead of the table until the write-behind catches up
+        for available, reserved in reservation_engine.counters([product_id]).values():
+            set_committed_value(inventory, "quantity_available", available)
+            set_committed_value(inventory, "quantity_reserve", reserved)
+    return inventory
+
+
+def _blocks_in_commit() -> bool:
+    """The reservation engine (journal fsync) and the sync ledger wait on threads at commit"""
+    return reservation_engine.enabled or ledger_writer.mode == "sync"
+
+
+async def _write(session: AsyncSession, fn, *args, **kwargs):
+    if _blocks_in_commit():
+        # Those waits would stall the event loop; give them a worker thread and a sync session
+        def call():
+            db = SessionLocal()
+            try:
+                return fn(db, *args, **kwargs)
+            finally:
+                db.close()
+        return await asyncio.to_thread(call)
+    return await session.run_sync(fn, *args, **kwargs)
+
+
+async def reserve_items(
+    session: AsyncSession,
+    items: List[Dict[str, Any]],
+    cart_id: Optional[str] = None,
+    ttl: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    return await _write(session, Products.crud.reserve_items, items, cart_id, ttl=ttl)
+
+
+async def release_items(session: AsyncSession, items: List[Dict[str, Any]], cart_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    return await _write(session, Products.crud.release_items, items, cart_id)
+
+
+async def finalize_items(
+    session: AsyncSession,
+    items: List[Dict[str, Any]],
+    order_id: Optional[str] = None,
+    cart_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    return await _write(session, Products.crud.finalize_items, items, order_id, cart_id)
+
+
+async def restock_items(session: AsyncSession, items: List[Dict[str, Any]], order_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    return await _write(session, Products.crud.restock_items, items, order_id)
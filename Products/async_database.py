@@ -0,0 +1,68 @@
+from typing import AsyncIterator, Optional
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from Products.database import DB_URL
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# "sync" serves every route from the threadpool; "async" mounts the asyncio versions of
+# the hot routes (listing, detail, inventory reads, reserve/release/finalize)
+DB_MODE = os.getenv("DB_MODE", "sync")
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+ASYNC_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20"))
+
+# Sync driver -> its asyncio counterpart
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql+mysqldb": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url: str) -> str:
+    """DATABASE_URL rewritten for an asyncio driver (ASYNC_DATABASE_URL wins when set)"""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+_engine: Optional[AsyncEngine] = None
+_sessionmaker: Optional[async_sessionmaker] = None
+
+
+def get_async_engine() -> AsyncEngine:
+    """Created on first use so sync-only deployments never need the asyncio drivers"""
+    global _engine, _sessionmaker
+    if _engine is None:
+        url = os.getenv("ASYNC_DATABASE_URL") or async_url(DB_URL)
+        kwargs = {}
+        if not url.startswith("sqlite"):
+            kwargs = {"pool_size": ASYNC_POOL_SIZE, "max_overflow": ASYNC_MAX_OVERFLOW, "pool_pre_ping": True}
+        _engine = create_async_engine(url, **kwargs)
+        _sessionmaker = async_sessionmaker(bind=_engine, autoflush=False, expire_on_commit=False)
+        log.info(f"Async database engine created ({_engine.dialect.driver})")
+    return _engine
+
+
+def AsyncSessionLocal() -> AsyncSession:
+    get_async_engine()
+    return _sessionmaker()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    session = AsyncSessionLocal()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+async def dispose_async_engine() -> None:
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = _sessionmaker = None
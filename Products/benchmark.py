@@ -0,0 +1,577 @@
+"""Micro-benchmarks for the Products hot paths.
+
+Runs against BENCH_DATABASE_URL (a throwaway SQLite file by default), never the
+configured application database:
+
+    python -m Products.benchmark --products 50000 listing --pages 50
+    python -m Products.benchmark create --rows 5000
+    python -m Products.benchmark async --clients 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from typing import Callable, Dict, List
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import Products.crud, Products.async_crud, Products.export, Products.models, Products.inventory_shards, Products.reservations
+from Products.ledger import ledger_writer
+from Products.reservation_engine import reservation_engine
+from Products.database import Base
+from Products.async_database import async_url
+from Orders.app.models import Base as OrdersBase
+from Products.metrics import inventory_contention
+
+
+class QueryCounter:
+    """Counts statements sent through an engine"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def make_engine(url: str = None):
+    if not url:
+        path = os.path.join(tempfile.mkdtemp(prefix="products-bench-"), "bench.db")
+        url = f"sqlite:///{path}"
+    engine = create_engine(url, connect_args={"timeout": 30} if url.startswith("sqlite") else {})
+    OrdersBase.metadata.create_all(engine)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def seed_catalog(session_factory, n_products: int, batch_size: int = 5000) -> None:
+    db = session_factory()
+    try:
+        if db.query(Products.models.Product.id).first():
+            return
+        categories = [{"id": i, "name": f"Category {i}", "parent_id": 0 if i <= 10 else (i % 10) + 1} for i in range(1, 41)]
+        db.execute(insert(Products.models.Category), categories)
+        for start in range(1, n_products + 1, batch_size):
+            ids = range(start, min(start + batch_size, n_products + 1))
+            db.execute(insert(Products.models.Product), [
+                {
+                    "id": i,
+                    "name": f"Product {i}",
+                    "price": round(random.uniform(5, 2000), 2),
+                    "brand": f"Brand {i % 300}",
+                    "category_id": random.randint(1, 40),
+                    "attributes": {"color": "red", "material": "Metal", "rating": round(random.uniform(3, 5), 1)}
+                } for i in ids
+            ])
+            db.execute(insert(Products.models.Inventory), [
+                {"product_id": i, "quantity_available": random.randint(0, 1000), "quantity_reserve": 0} for i in ids
+            ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def report(label: str, latencies_ms: List[float], queries: int, calls: int) -> Dict[str, float]:
+    latencies_ms = sorted(latencies_ms)
+    result = {
+        "queries_per_call": round(queries / calls, 2),
+        "mean_ms": round(statistics.mean(latencies_ms), 3),
+        "p50_ms": round(latencies_ms[len(latencies_ms) // 2], 3),
+        "p95_ms": round(latencies_ms[int(len(latencies_ms) * 0.95) - 1], 3)
+    }
+    print(f"{label:<28} " + "  ".join(f"{k}={v}" for k, v in result.items()))
+    return result
+
+
+@contextmanager
+def measured(latencies: List[float]):
+    start = time.perf_counter()
+    yield
+    latencies.append((time.perf_counter() - start) * 1000)
+
+
+# =========================================================
+# Listing: ORM hydration vs column projection
+# =========================================================
+
+def _orm_page(db, page: int, per_page: int) -> List[dict]:
+    """The previous list path: full Product entities, then per-row relationship access"""
+    _, products = Products.crud.get_paginated_products(db, page * per_page, per_page, with_total=False)
+    return [
+        {
+            "id": p.id,
+            "name": p.name,
+            "price": p.price,
+            "brand": p.brand,
+            "stock_quantity": p.inventory.quantity_available if p.inventory else 0,
+            "category_name": p.category.name if p.category else "Unknown",
+            "rating": p.attributes.get("rating") if p.attributes else None
+        } for p in products
+    ]
+
+
+def _projection_page(db, page: int, per_page: int) -> List[dict]:
+    return Products.crud.list_product_summaries(db, page * per_page, per_page)
+
+
+def bench_listing(session_factory, engine, pages: int, per_page: int) -> None:
+    counter = QueryCounter(engine)
+    paths: Dict[str, Callable] = {"orm_entities": _orm_page, "summary_projection": _projection_page}
+    for label, fetch in paths.items():
+        latencies: List[float] = []
+        before = counter.count
+        for page in range(pages):
+            db = session_factory()
+            try:
+                with measured(latencies):
+                    fetch(db, page, per_page)
+            finally:
+                db.close()
+        report(label, latencies, counter.count - before, pages)
+
+
+# =========================================================
+# Creation: one flush per product vs batched multi-row inserts
+# =========================================================
+
+def _bulk_payload(n: int) -> List[dict]:
+    return [
+        {
+            "name": f"Bulk Product {i}",
+            "price": round(random.uniform(5, 2000), 2),
+            "brand": f"Brand {i % 300}",
+            "category_id": random.randint(1, 40),
+            "attributes": {"color": "blue", "material": "Wood"},
+            "inventory": {"quantity_available": random.randint(0, 500)}
+        } for i in range(n)
+    ]
+
+
+def _create_per_row(db, items: List[dict]) -> None:
+    """The previous creation path: ORM add + flush for every product and its inventory"""
+    for item in items:
+        product = Products.models.Product(**{k: v for k, v in item.items() if k != "inventory"})
+        db.add(product)
+        db.flush()
+        db.add(Products.models.Inventory(product_id=product.id, **item["inventory"]))
+    db.commit()
+
+
+def _create_bulk(db, items: List[dict]) -> None:
+    Products.crud.bulk_create_products(db, items)
+
+
+def bench_create(session_factory, engine, rows: int, rounds: int) -> None:
+    counter = QueryCounter(engine)
+    paths: Dict[str, Callable] = {"per_row_flush": _create_per_row, "bulk_insert": _create_bulk}
+    for label, create in paths.items():
+        latencies: List[float] = []
+        before = counter.count
+        for _ in range(rounds):
+            items = _bulk_payload(rows)
+            db = session_factory()
+            try:
+                with measured(latencies):
+                    create(db, items)
+            finally:
+                db.close()
+        report(label, latencies, counter.count - before, rounds)
+        print(f"{'':<28} rows_per_s={round(rows * rounds / (sum(latencies) / 1000))}")
+
+
+# =========================================================
+# Export: loading every entity vs streaming from a server-side cursor
+# =========================================================
+
+def _export_all(session_factory) -> int:
+    """Materialize the catalog with .all() and serialize it, as a dump used to work"""
+    db = session_factory()
+    try:
+        return sum(len(chunk) for chunk in Products.export.to_ndjson(
+            {column: getattr(p, column, None) for column in ("id", "name", "price", "brand", "attributes", "category_id")}
+            for p in Products.crud.get_all_products(db)
+        ))
+    finally:
+        db.close()
+
+
+def _export_stream(session_factory) -> int:
+    return sum(len(chunk) for chunk in Products.export.stream_catalog(session_factory, "ndjson"))
+
+
+def bench_export(session_factory) -> None:
+    for label, export in {"load_all": _export_all, "streamed": _export_stream}.items():
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = export(session_factory)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<28} bytes={size}  seconds={elapsed:.2f}  peak_mib={peak / 2**20:.1f}")
+
+
+# =========================================================
+# Reservations: per-item round trips vs one locked batch, under concurrent carts
+# =========================================================
+
+def _reserve_per_item(db, items: List[dict]) -> None:
+    """The previous /products/reserve body: two unlocked lookups and one ORM add per line item"""
+    for item in items:
+        inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
+        if not inventory or inventory.quantity_available < item["quantity"]:
+            db.rollback()
+            raise ValueError("Insufficient stock")
+    for item in items:
+        inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
+        inventory.quantity_available -= item["quantity"]
+        inventory.quantity_reserve += item["quantity"]
+        db.add(Products.models.StockMovement(product_id=item["product_id"], change=-item["quantity"], reason="reserve"))
+    db.commit()
+
+
+def _reserve_batch(mode: str):
+    def reserve(db, items: List[dict]) -> None:
+        Products.crud.INVENTORY_CONCURRENCY = mode
+        Products.crud.reserve_items(db, items, endpoint=f"bench_{mode}")
+    return reserve
+
+
+@contextmanager
+def _engine_enabled(session_factory):
+    """Route crud inventory writes through the in-memory engine with a throwaway journal"""
+    reservation_engine.journal.path = os.path.join(tempfile.mkdtemp(), "reservations.journal")
+    reservation_engine.enabled = True
+    reservation_engine.start(session_factory)
+    try:
+        yield
+    finally:
+        reservation_engine.stop()
+        reservation_engine.enabled = False
+
+
+def bench_reserve(session_factory, engine, carts: int, workers: int, items_per_cart: int, hot_products: int) -> None:
+    counter = QueryCounter(engine)
+    db = session_factory()
+    db.query(Products.models.Inventory).update({"quantity_available": 10 ** 9, "quantity_reserve": 0})
+    db.commit()
+    db.close()
+
+    def checkout(reserve, latencies: List[float]) -> None:
+        items = [
+            {"product_id": product_id, "quantity": random.randint(1, 3)}
+            for product_id in random.sample(range(1, hot_products + 1), items_per_cart)
+        ]
+        db = session_factory()
+        try:
+            with measured(latencies):
+                try:
+                    reserve(db, items)
+                except Products.crud.InventoryConflictError:
+                    pass  # counted as exhausted by inventory_contention
+        finally:
+            db.close()
+
+    paths = {
+        "per_item": _reserve_per_item,
+        "batch_pessimistic": _reserve_batch("pessimistic"),
+        "batch_optimistic": _reserve_batch("optimistic"),
+        "engine": _reserve_batch("engine")
+    }
+    for label, reserve in paths.items():
+        latencies: List[float] = []
+        before = counter.count
+        with _engine_enabled(session_factory) if label == "engine" else nullcontext():
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for future in [pool.submit(checkout, reserve, latencies) for _ in range(carts)]:
+                    future.result()
+            elapsed = time.perf_counter() - started
+        report(label, latencies, counter.count - before, carts)
+        contention = inventory_contention.stats().get(f"bench_{label.split('_')[-1]}", {})
+        print(f"{'':<28} carts_per_s={round(carts / elapsed)}  conflicts={contention.get('conflicts', 0)}  exhausted={contention.get('exhausted', 0)}")
+
+
+def bench_hot_sku(session_factory, engine, carts: int, workers: int, shards: int) -> None:
+    """Every cart reserves one unit of the same product: one counter vs `shards` counters"""
+    db = session_factory()
+    db.query(Products.models.Inventory).update({"quantity_available": 10 ** 9, "quantity_reserve": 0})
+    db.commit()
+    db.close()
+
+    def checkout(endpoint: str, latencies: List[float]) -> None:
+        db = session_factory()
+        try:
+            with measured(latencies):
+                try:
+                    Products.crud.reserve_items(db, [{"product_id": 1, "quantity": 1}], endpoint=endpoint)
+                except Products.crud.InventoryConflictError:
+                    pass  # counted as exhausted by inventory_contention
+        finally:
+            db.close()
+
+    counter = QueryCounter(engine)
+    Products.crud.INVENTORY_CONCURRENCY = "optimistic"
+    for label, shard_count in (("single_counter", 0), (f"sharded_x{shards}", shards)):
+        if shard_count:
+            db = session_factory()
+            Products.inventory_shards.enable_sharding(db, 1, shard_count)
+            db.commit()
+            db.close()
+        endpoint = f"bench_{label}"
+        latencies: List[float] = []
+        before = counter.count
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(checkout, endpoint, latencies) for _ in range(carts)]:
+                future.result()
+        elapsed = time.perf_counter() - started
+        report(label, latencies, counter.count - before, carts)
+        contention = inventory_contention.stats().get(endpoint, {})
+        print(f"{'':<28} carts_per_s={round(carts / elapsed)}  conflicts={contention.get('conflicts', 0)}  exhausted={contention.get('exhausted', 0)}")
+
+
+# =========================================================
+# Ledger: stock_movements inserted per request vs group-committed
+# =========================================================
+
+def bench_ledger(session_factory, engine, carts: int, workers: int) -> None:
+    db = session_factory()
+    db.query(Products.models.Inventory).update({"quantity_available": 10 ** 9, "quantity_reserve": 0})
+    db.commit()
+    n_products = db.query(Products.models.Product.id).count()
+    db.close()
+
+    def checkout(latencies: List[float]) -> None:
+        db = session_factory()
+        try:
+            with measured(latencies):
+                try:
+                    Products.crud.reserve_items(db, [{"product_id": random.randint(1, n_products), "quantity": 1}], endpoint="bench_ledger")
+                except Products.crud.InventoryConflictError:
+                    pass
+        finally:
+            db.close()
+
+    counter = QueryCounter(engine)
+    ledger_writer.start(session_factory)
+    for mode in ("inline", "sync", "async"):
+        ledger_writer.mode = mode
+        ledger_writer.metrics.reset()
+        latencies: List[float] = []
+        before = counter.count
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(checkout, latencies) for _ in range(carts)]:
+                future.result()
+        ledger_writer.flush()
+        elapsed = time.perf_counter() - started
+        report(mode, latencies, counter.count - before, carts)
+        stats = ledger_writer.stats()
+        print(f"{'':<28} carts_per_s={round(carts / elapsed)}  flushes={stats['flushes']}  mean_batch={stats['mean_batch']}  flush_p99_ms={stats['flush_p99_ms']}")
+    ledger_writer.stop()
+
+
+# =========================================================
+# Reservation expiry: sweep cost with many reservations outstanding
+# =========================================================
+
+def bench_expiry(session_factory, engine, outstanding: int, due: int, batch_size: int) -> None:
+    """Release `due` expired reservations while `outstanding` others are still live"""
+    db = session_factory()
+    n_products = db.query(Products.models.Product.id).count()
+    now = Products.reservations.utc_naive()
+    for start in range(0, outstanding + due, 50000):
+        db.execute(insert(Products.models.Reservation), [
+            {
+                "product_id": random.randint(1, n_products),
+                "cart_id": i,
+                "quantity": 1,
+                "expires_at": now + (timedelta(seconds=-random.randint(1, 600)) if i < due else timedelta(seconds=random.randint(60, 3600)))
+            } for i in range(start, min(start + 50000, outstanding + due))
+        ])
+    db.query(Products.models.Inventory).update({"quantity_available": 10 ** 6, "quantity_reserve": 10 ** 6})
+    db.commit()
+
+    counter = QueryCounter(engine)
+    latencies: List[float] = []
+    started = time.perf_counter()
+    released = 0
+    while True:
+        with measured(latencies):
+            rows, _ = Products.crud.expire_reservations(db, batch_size, now)
+        released += rows
+        if rows < batch_size:
+            break
+    elapsed = time.perf_counter() - started
+    db.close()
+    report(f"sweep_batch_{batch_size}", latencies, counter.count, len(latencies))
+    print(f"{'':<28} released={released}  outstanding={outstanding}  rows_per_s={round(released / elapsed)}")
+
+
+# =========================================================
+# DB_MODE: threadpool + sync driver vs event loop + asyncio driver
+# =========================================================
+
+def _mixed_ops(n_products: int, requests: int, read_share: float) -> List[tuple]:
+    return [
+        ("read" if random.random() < read_share else "reserve", random.randint(1, n_products))
+        for _ in range(requests)
+    ]
+
+
+def _tail(label: str, latencies: List[float], elapsed: float) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    print(f"{'':<28} p99_ms={round(p99, 3)}  max_ms={round(latencies[-1], 3)}  requests_per_s={round(len(latencies) / elapsed)}")
+
+
+def bench_async(session_factory, engine, requests: int, clients: int, threads: int, read_share: float) -> None:
+    """Inventory reads mixed with reserve+release, `clients` requests in flight at once.
+
+    sync mimics the default deployment: every request waits for one of `threads` worker
+    threads (Starlette's threadpool is 40) and a pooled connection. async runs the same
+    requests as coroutines on one event loop through Products.async_crud.
+    """
+    db = session_factory()
+    db.query(Products.models.Inventory).update({"quantity_available": 10 ** 9, "quantity_reserve": 0})
+    db.commit()
+    n_products = db.query(Products.models.Product.id).count()
+    db.close()
+    ops = _mixed_ops(n_products, requests, read_share)
+    counter = QueryCounter(engine)
+
+    def sync_op(kind: str, product_id: int) -> None:
+        db = session_factory()
+        try:
+            if kind == "read":
+                Products.crud.get_inventory_by_product_id(db, product_id)
+            else:
+                items = [{"product_id": product_id, "quantity": 1}]
+                Products.crud.reserve_items(db, items, endpoint="bench_async")
+                Products.crud.release_items(db, items)
+        finally:
+            db.close()
+
+    latencies: List[float] = []
+    before = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as workers, ThreadPoolExecutor(max_workers=clients) as client_pool:
+        def client(op) -> None:
+            with measured(latencies):
+                workers.submit(sync_op, *op).result()
+        for future in [client_pool.submit(client, op) for op in ops]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    report(f"sync_threads_{threads}", latencies, counter.count - before, requests)
+    _tail("sync", latencies, elapsed)
+
+    async_engine = create_async_engine(async_url(engine.url.render_as_string(hide_password=False)))
+    make_session = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+    async_counter = QueryCounter(async_engine.sync_engine)
+
+    async def run_async() -> List[float]:
+        gate = asyncio.Semaphore(clients)
+        results: List[float] = []
+
+        async def async_op(kind: str, product_id: int) -> None:
+            async with gate:
+                start = time.perf_counter()
+                async with make_session() as session:
+                    if kind == "read":
+                        await Products.async_crud.get_inventory_by_product_id(session, product_id)
+                    else:
+                        items = [{"product_id": product_id, "quantity": 1}]
+                        await Products.async_crud.reserve_items(session, items)
+                        await Products.async_crud.release_items(session, items)
+                results.append((time.perf_counter() - start) * 1000)
+
+        await asyncio.gather(*(async_op(*op) for op in ops))
+        await async_engine.dispose()
+        return results
+
+    started = time.perf_counter()
+    latencies = asyncio.run(run_async())
+    elapsed = time.perf_counter() - started
+    report(f"async_clients_{clients}", latencies, async_counter.count, requests)
+    _tail("async", latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Products micro-benchmarks")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--products", type=int, default=20000, help="Catalog size to seed into an empty database")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    listing = sub.add_parser("listing", help="Per-page query count and latency of product list rows")
+    listing.add_argument("--pages", type=int, default=50)
+    listing.add_argument("--per-page", type=int, default=50)
+
+    create = sub.add_parser("create", help="Throughput of per-row vs batched product creation")
+    create.add_argument("--rows", type=int, default=2000)
+    create.add_argument("--rounds", type=int, default=5)
+
+    sub.add_parser("export", help="Peak memory of a full catalog export")
+
+    reserve = sub.add_parser("reserve", help="Checkout reservation throughput under concurrent carts")
+    reserve.add_argument("--carts", type=int, default=500)
+    reserve.add_argument("--workers", type=int, default=8)
+    reserve.add_argument("--items", type=int, default=5, help="Line items per cart")
+    reserve.add_argument("--hot-products", type=int, default=100, help="Carts pick from this many products")
+
+    hot = sub.add_parser("hot-sku", help="Reservation throughput on one product, sharded vs unsharded")
+    hot.add_argument("--carts", type=int, default=500)
+    hot.add_argument("--workers", type=int, default=16)
+    hot.add_argument("--shards", type=int, default=8)
+
+    ledger = sub.add_parser("ledger", help="Reservation latency with stock movements inline vs group-committed")
+    ledger.add_argument("--carts", type=int, default=1000)
+    ledger.add_argument("--workers", type=int, default=16)
+
+    expiry = sub.add_parser("expiry", help="Expired-reservation sweep with many reservations outstanding")
+    expiry.add_argument("--outstanding", type=int, default=1000000)
+    expiry.add_argument("--due", type=int, default=20000)
+    expiry.add_argument("--batch-size", type=int, default=Products.reservations.SWEEP_BATCH_SIZE)
+
+    mixed = sub.add_parser("async", help="p50/p99 of mixed inventory traffic, DB_MODE=sync vs DB_MODE=async")
+    mixed.add_argument("--requests", type=int, default=5000)
+    mixed.add_argument("--clients", type=int, default=200, help="Requests in flight at once")
+    mixed.add_argument("--threads", type=int, default=40, help="Worker threads of the sync mode")
+    mixed.add_argument("--read-share", type=float, default=0.7, help="Fraction of requests that only read inventory")
+
+    args = parser.parse_args()
+    engine = make_engine(args.database_url)
+    session_factory = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    seed_catalog(session_factory, args.products)
+
+    if args.scenario == "listing":
+        bench_listing(session_factory, engine, args.pages, args.per_page)
+    elif args.scenario == "create":
+        bench_create(session_factory, engine, args.rows, args.rounds)
+    elif args.scenario == "export":
+        bench_export(session_factory)
+    elif args.scenario == "reserve":
+        bench_reserve(session_factory, engine, args.carts, args.workers, args.items, args.hot_products)
+    elif args.scenario == "hot-sku":
+        bench_hot_sku(session_factory, engine, args.carts, args.workers, args.shards)
+    elif args.scenario == "ledger":
+        bench_ledger(session_factory, engine, args.carts, args.workers)
+    elif args.scenario == "expiry":
+        bench_expiry(session_factory, engine, args.outstanding, args.due, args.batch_size)
+    elif args.scenario == "async":
+        bench_async(session_factory, engine, args.requests, args.clients, args.threads, args.read_share)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, Iterable, List, Optional, Set
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+import Products.models
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self._removed(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every invalidation; pass to set() to drop values read before one"""
+        return self._generation
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self._removed(evicted)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self._removed(key)
+                self.invalidations += 1
+
+    def discard_if(self, predicate: Callable[[Hashable], bool]) -> None:
+        with self._lock:
+            self._generation += 1
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+                self._removed(key)
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def _removed(self, key: Hashable) -> None:
+        """Called with the lock held whenever `key` leaves the cache (expired, evicted or dropped)"""
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+
+class ProductDetailCache(TTLCache):
+    """Serialized product detail keyed by product id, with a category -> products
+    reverse map so category edits only drop the products that embed that category"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__(maxsize, ttl)
+        self._by_category: dict = {}
+        self._category_of: dict = {}
+
+    def put(self, product_id: int, category_id: Optional[int], payload: bytes, generation: int) -> None:
+        self.set(product_id, payload, generation)
+        with self._lock:
+            # Only cached products are tracked, so the map stays bounded by maxsize
+            if product_id not in self._data:
+                return
+            self._removed(product_id)
+            if category_id is not None:
+                self._category_of[product_id] = category_id
+                self._by_category.setdefault(category_id, set()).add(product_id)
+
+    def _removed(self, product_id: Hashable) -> None:
+        category_id = self._category_of.pop(product_id, None)
+        members = self._by_category.get(category_id)
+        if members is not None:
+            members.discard(product_id)
+            if not members:
+                del self._by_category[category_id]
+
+    def invalidate(self, product_ids: Iterable[int] = (), category_ids: Iterable[int] = ()) -> None:
+        keys = set(product_ids)
+        with self._lock:
+            for category_id in category_ids:
+                keys |= self._by_category.pop(category_id, set())
+        for key in keys:
+            self.pop(key)
+
+    def clear(self) -> None:
+        super().clear()
+        with self._lock:
+            self._by_category.clear()
+            self._category_of.clear()
+
+
+# =========================================================
+# Commit-time change tracking
+# =========================================================
+
+@dataclass
+class ChangeSet:
+    """Ids touched by a committed transaction, grouped by what they invalidate"""
+    product_ids: Set[int] = field(default_factory=set)
+    inventory_product_ids: Set[int] = field(default_factory=set)
+    category_ids: Set[int] = field(default_factory=set)
+    bind: Any = None
+
+    def __bool__(self):
+        return bool(self.product_ids or self.inventory_product_ids or self.category_ids)
+
+
+_commit_listeners: List[Callable[[ChangeSet], None]] = []
+_before_commit_listeners: List[Callable[[Session, ChangeSet], None]] = []
+_INFO_KEY = "products_changeset"
+
+
+def on_commit(callback: Callable[[ChangeSet], None]) -> Callable[[ChangeSet], None]:
+    """Register `callback` to run after every commit that touched products, inventory or categories"""
+    _commit_listeners.append(callback)
+    return callback
+
+
+def before_commit(callback: Callable[[Session, ChangeSet], None]) -> Callable[[Session, ChangeSet], None]:
+    """Register `callback(session, changes)` to run inside such a transaction, just before it commits.
+    Its writes commit with the transaction; an exception rolls the whole transaction back."""
+    _before_commit_listeners.append(callback)
+    return callback
+
+
+def _pending(session: Session) -> ChangeSet:
+    changes = session.info.get(_INFO_KEY)
+    if changes is None:
+        changes = session.info[_INFO_KEY] = ChangeSet()
+    return changes
+
+
+def mark_changed(
+    db: Session,
+    product_ids: Iterable[int] = (),
+    inventory_product_ids: Iterable[int] = (),
+    category_ids: Iterable[int] = ()
+) -> None:
+    """Record changes made with Core statements, which bypass the ORM flush hooks below"""
+    changes = _pending(db)
+    changes.product_ids.update(product_ids)
+    changes.inventory_product_ids.update(inventory_product_ids)
+    changes.category_ids.update(category_ids)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    changes = None
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Products.models.Product):
+            changes = changes or _pending(session)
+            if obj.id is not None:
+                changes.product_ids.add(obj.id)
+            # Only a move touches the categories; the product itself is dropped by id
+            changes.category_ids.update(c for c in _history_values(obj, "category_id", changed_only=True) if c is not None)
+        elif isinstance(obj, Products.models.Inventory):
+            changes = changes or _pending(session)
+            changes.inventory_product_ids.add(obj.product_id)
+        elif isinstance(obj, Products.models.PriceHistory):
+            changes = changes or _pending(session)
+            changes.product_ids.add(obj.product_id)
+        elif isinstance(obj, Products.models.Category):
+            changes = changes or _pending(session)
+            if obj.id is not None:
+                changes.category_ids.add(obj.id)
+            changes.category_ids.update(p for p in _history_values(obj, "parent_id") if p is not None)
+
+
+def _history_values(obj, key: str, changed_only: bool = False) -> Set[Any]:
+    history = inspect(obj).attrs[key].history
+    values = set(history.added or ()) | set(history.deleted or ())
+    return values if changed_only else values | set(history.unchanged or ())
+
+
+@event.listens_for(Session, "before_commit")
+def _prepare_changes(session: Session) -> None:
+    if not _before_commit_listeners or session.in_nested_transaction():
+        return
+    # Collect the changes still waiting in the unit of work
+    session.flush()
+    changes: Optional[ChangeSet] = session.info.get(_INFO_KEY)
+    if not changes:
+        return
+    for callback in _before_commit_listeners:
+        callback(session, changes)
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch_changes(session: Session) -> None:
+    if session.in_nested_transaction():
+        # Released SAVEPOINT; wait for the outer transaction to commit
+        return
+    changes: Optional[ChangeSet] = session.info.pop(_INFO_KEY, None)
+    if not changes:
+        return
+    changes.bind = session.get_bind()
+    for callback in _commit_listeners:
+        try:
+            callback(changes)
+        except Exception as e:
+            log.error(f"Commit listener {getattr(callback, '__name__', callback)} failed: {e}")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session: Session, previous_transaction) -> None:
+    # A rolled-back SAVEPOINT leaves the outer transaction's changes pending; ids recorded
+    # inside it only cause a harmless extra invalidation if the outer transaction commits.
+    if previous_transaction.parent is None:
+        session.info.pop(_INFO_KEY, None)
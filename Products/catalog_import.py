@@ -0,0 +1,300 @@
+import argparse
+import csv
+import json
+import time
+from dataclasses import dataclass, field, asdict
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from pydantic import ValidationError
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+import Products.models, Products.schemas, Products.crud, Products.cache
+import Products.facets  # registers the facet refresh that runs with each committed batch
+from Products import inventory_shards
+from Products.logger import log
+from Products.search import product_search
+from Products.category_tree import category_tree
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+IMPORT_BATCH_SIZE = int(os.getenv("CATALOG_IMPORT_BATCH_SIZE", "2000"))
+MAX_REPORTED_ERRORS = 100
+
+_INVENTORY_FIELDS = set(Products.schemas.InventoryBase.model_fields)
+_PRODUCT_FIELDS = set(Products.schemas.ProductCreate.model_fields)
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    price_changes: int = 0
+    failed: int = 0
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+
+    def fail(self, line: int, error: str) -> None:
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+
+# =========================================================
+# Reading
+# =========================================================
+
+def _csv_row(row: Dict[str, str]) -> Dict[str, Any]:
+    """Flat CSV columns -> the nested shape ProductBulkItem expects (empty cells are absent)"""
+    item: Dict[str, Any] = {}
+    inventory: Dict[str, Any] = {}
+    for key, value in row.items():
+        if value is None or value == "":
+            continue
+        if key == "attributes":
+            item[key] = json.loads(value)
+        elif key in _INVENTORY_FIELDS:
+            inventory[key] = value
+        elif key in _PRODUCT_FIELDS:
+            item[key] = value
+    if inventory:
+        item["inventory"] = inventory
+    return item
+
+
+def read_rows(path: str, fmt: Optional[str] = None, skip: int = 0) -> Iterator[Tuple[int, Any]]:
+    """Yield (line number, raw row) one at a time, skipping the first `skip` data rows.
+
+    A row that cannot be parsed is yielded as an Exception so it is reported, not fatal.
+    """
+    fmt = fmt or ("csv" if path.endswith(".csv") else "ndjson")
+    with open(path, newline="", encoding="utf-8") as source:
+        if fmt == "csv":
+            rows = enumerate(csv.DictReader(source), start=2)
+        else:
+            rows = ((number, line) for number, line in enumerate(source, start=1) if line.strip())
+        for position, (number, raw) in enumerate(rows):
+            if position < skip:
+                continue
+            try:
+                yield number, _csv_row(raw) if fmt == "csv" else json.loads(raw)
+            except ValueError as e:
+                yield number, e
+
+
+# =========================================================
+# Checkpoints
+# =========================================================
+
+def _checkpoint_key(path: str) -> Dict[str, Any]:
+    info = os.stat(path)
+    return {"source": os.path.abspath(path), "size": info.st_size, "mtime": info.st_mtime}
+
+
+def load_checkpoint(checkpoint_path: str, path: str) -> Tuple[int, ImportStats]:
+    """Rows already committed by an earlier run of the same (unchanged) file"""
+    if not os.path.exists(checkpoint_path):
+        return 0, ImportStats()
+    with open(checkpoint_path) as f:
+        saved = json.load(f)
+    if saved.get("file") != _checkpoint_key(path):
+        log.warning(f"Ignoring checkpoint {checkpoint_path}: it belongs to a different input file")
+        return 0, ImportStats()
+    return saved["rows_done"], ImportStats(**saved["stats"])
+
+
+def save_checkpoint(checkpoint_path: str, path: str, rows_done: int, stats: ImportStats) -> None:
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"file": _checkpoint_key(path), "rows_done": rows_done, "stats": asdict(stats)}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+# =========================================================
+# Upsert
+# =========================================================
+
+def _natural_key(name: str, brand: Optional[str]) -> Tuple[str, str]:
+    return name.strip().lower(), (brand or "").strip().lower()
+
+
+def _existing_products(db: Session, keys: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, str], Tuple[int, Decimal, Optional[int], int]]:
+    """(product id, price, inventory id, shard count) of catalog rows matching the given (name, brand) pairs"""
+    Product = Products.models.Product
+    Inventory = Products.models.Inventory
+    wanted = {_natural_key(name, brand) for name, brand in keys}
+    names = {name for name, _ in wanted}
+    found: Dict[Tuple[str, str], Tuple[int, Decimal, Optional[int], int]] = {}
+    rows = db.execute(
+        select(Product.id, Product.name, Product.brand, Product.price, Inventory.id, Inventory.shard_count)
+        .outerjoin(Inventory, Inventory.product_id == Product.id)
+        # Same normalization as _natural_key, so matching ignores case on every collation
+        .where(func.lower(func.trim(Product.name)).in_(names))
+        .order_by(Product.id)
+    )
+    for product_id, name, brand, price, inventory_id, shard_count in rows:
+        key = _natural_key(name, brand)
+        if key in wanted and key not in found:
+            found[key] = (product_id, price, inventory_id, shard_count or 0)
+    return found
+
+
+def upsert_batch(db: Session, items: List[Products.schemas.ProductBulkItem], stats: ImportStats, reason: str = "catalog_import") -> None:
+    """Insert new products and update existing ones with a handful of bulk statements (no commit)"""
+    latest: Dict[Tuple[str, str], Products.schemas.ProductBulkItem] = {}
+    for item in items:
+        latest[_natural_key(item.name, item.brand)] = item
+    existing = _existing_products(db, [(item.name.strip(), item.brand) for item in latest.values()])
+
+    new_products, new_inventory = [], []
+    product_updates, inventory_updates, inventory_inserts, history = [], [], [], []
+    sharded_stock: List[Tuple[int, Optional[int], Optional[int]]] = []
+    for key, item in latest.items():
+        product_row = item.model_dump(exclude={"inventory"})
+        if key not in existing:
+            new_products.append(product_row)
+            new_inventory.append((item.inventory or Products.schemas.InventoryBase()).model_dump())
+            continue
+
+        product_id, old_price, inventory_id, shard_count = existing[key]
+        product_updates.append({"id": product_id, **product_row})
+        new_price = Decimal(str(item.price)).quantize(Decimal("0.01"))
+        if old_price is None or Decimal(old_price) != new_price:
+            history.append({"product_id": product_id, "old_price": old_price or 0, "new_price": new_price, "reason": reason})
+        if item.inventory is not None:
+            # Only the columns present in the feed, so a price-only file does not reset stock
+            changes = item.inventory.model_dump(exclude_unset=True)
+            if shard_count and {"quantity_available", "quantity_reserve"} & changes.keys():
+                # The row of a sharded product is only a rollup: the stock goes onto its shards
+                sharded_stock.append((product_id, changes.pop("quantity_available", None), changes.pop("quantity_reserve", None)))
+            if inventory_id is None:
+                inventory_inserts.append({**item.inventory.model_dump(), "product_id": product_id})
+            elif changes:
+                inventory_updates.append({"id": inventory_id, **changes})
+
+    if new_products:
+        Products.crud.insert_products_with_inventory(db, new_products, new_inventory)
+    if product_updates:
+        db.execute(update(Products.models.Product), product_updates)
+        product_search.index_rows(db, (
+            (row["id"], row["name"], row.get("brand"), row.get("attributes")) for row in product_updates
+        ))
+    if inventory_updates:
+        db.execute(update(Products.models.Inventory), inventory_updates)
+    if inventory_inserts:
+        db.execute(insert(Products.models.Inventory), inventory_inserts)
+    for product_id, available, reserved in sharded_stock:
+        inventory_shards.rebalance_product(db, product_id, available=available, reserved=reserved)
+    if history:
+        db.execute(insert(Products.models.PriceHistory), history)
+
+    updated_ids = [row["id"] for row in product_updates]
+    Products.cache.mark_changed(
+        db,
+        product_ids=updated_ids,
+        inventory_product_ids=[row["product_id"] for row in inventory_inserts] + updated_ids
+    )
+    stats.created += len(new_products)
+    stats.updated += len(product_updates)
+    stats.price_changes += len(history)
+
+
+def _validate(db: Session, number: int, raw: Any, stats: ImportStats) -> Optional[Products.schemas.ProductBulkItem]:
+    if isinstance(raw, Exception):
+        stats.fail(number, f"Unparseable row: {raw}")
+        return None
+    try:
+        item = Products.schemas.ProductBulkItem.model_validate(raw)
+    except ValidationError as e:
+        stats.fail(number, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+        return None
+    if not category_tree.contains(db, item.category_id):
+        stats.fail(number, f"Invalid category_id {item.category_id}")
+        return None
+    return item
+
+
+def _write_batch(db: Session, batch: List[Tuple[int, Products.schemas.ProductBulkItem]], stats: ImportStats) -> None:
+    try:
+        with db.begin_nested():
+            upsert_batch(db, [item for _, item in batch], stats)
+    except Exception as e:
+        log.warning(f"Import batch of {len(batch)} failed ({e}); retrying row by row")
+        for number, item in batch:
+            try:
+                with db.begin_nested():
+                    upsert_batch(db, [item], stats)
+            except Exception as row_error:
+                stats.fail(number, str(getattr(row_error, "orig", row_error)))
+    db.commit()
+
+
+def import_catalog(
+    db: Session,
+    path: str,
+    fmt: Optional[str] = None,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    checkpoint_path: Optional[str] = None,
+    resume: bool = True
+) -> ImportStats:
+    """Stream a catalog file into products/inventory, one committed batch at a time.
+
+    After every batch the number of consumed rows is written to the checkpoint file, so a
+    rerun with the same file skips straight past work that is already committed.
+    """
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    rows_done, stats = load_checkpoint(checkpoint_path, path) if resume else (0, ImportStats())
+    if rows_done:
+        log.info(f"Resuming import of {path} after {rows_done} row(s)")
+
+    started = time.perf_counter()
+    processed = 0
+    batch: List[Tuple[int, Products.schemas.ProductBulkItem]] = []
+
+    def flush() -> None:
+        nonlocal batch
+        if batch:
+            _write_batch(db, batch, stats)
+        batch = []
+        save_checkpoint(checkpoint_path, path, rows_done + processed, stats)
+        elapsed = time.perf_counter() - started
+        log.info(f"Imported {rows_done + processed} row(s) of {path} ({processed / elapsed if elapsed else 0:.0f} rows/s)")
+
+    for number, raw in read_rows(path, fmt, skip=rows_done):
+        processed += 1
+        stats.rows += 1
+        item = _validate(db, number, raw, stats)
+        if item is not None:
+            batch.append((number, item))
+        if processed % batch_size == 0:
+            flush()
+    flush()
+
+    elapsed = time.perf_counter() - started
+    os.remove(checkpoint_path)
+    log.info(
+        f"Catalog import of {path} finished: {stats.created} created, {stats.updated} updated, "
+        f"{stats.price_changes} price change(s), {stats.failed} failed in {elapsed:.1f}s "
+        f"({processed / elapsed if elapsed else 0:.0f} rows/s)"
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    from Products.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Import or update products from an NDJSON/CSV catalog file")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="Defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        result = import_catalog(session, args.path, args.format, args.batch_size, args.checkpoint, resume=not args.restart)
+        for error in result.errors:
+            log.warning(f"Line {error['line']}: {error['error']}")
+    finally:
+        session.close()
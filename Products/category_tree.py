@@ -0,0 +1,146 @@
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, Optional, Set
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import Products.models
+from Products.cache import ChangeSet, on_commit
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+CATEGORY_TREE_TTL = float(os.getenv("CATEGORY_TREE_TTL", "300"))
+
+
+class CategoryTree:
+    """In-memory copy of the categories adjacency list with memoized descendant sets.
+
+    Loaded with one query, patched node-by-node when categories commit, and fully
+    reloaded after CATEGORY_TREE_TTL to pick up edits made by other processes.
+    """
+
+    def __init__(self, ttl: float = CATEGORY_TREE_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._parent: Dict[int, Optional[int]] = {}
+        self._children: Dict[int, Set[int]] = {}
+        self._descendants: Dict[int, FrozenSet[int]] = {}
+        self._loaded_at: Optional[float] = None
+
+    def _ensure_loaded(self, db: Session) -> None:
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        rows = db.execute(select(Products.models.Category.id, Products.models.Category.parent_id)).all()
+        with self._lock:
+            self._parent = {}
+            self._children = {}
+            for category_id, parent_id in rows:
+                self._link(category_id, parent_id)
+            self._descendants = {}
+            self._loaded_at = time.monotonic()
+        log.info(f"Loaded category tree with {len(rows)} categories")
+
+    def _link(self, category_id: int, parent_id: Optional[int]) -> None:
+        self._parent[category_id] = parent_id
+        self._children.setdefault(category_id, set())
+        if parent_id is not None:
+            self._children.setdefault(parent_id, set()).add(category_id)
+
+    def _unlink(self, category_id: int) -> None:
+        parent_id = self._parent.pop(category_id, None)
+        if parent_id is not None and parent_id in self._children:
+            self._children[parent_id].discard(category_id)
+
+    def contains(self, db: Session, category_id: int) -> bool:
+        self._ensure_loaded(db)
+        if category_id in self._parent:
+            return True
+        # Possibly created by another process since the last load: check the row itself
+        row = db.execute(
+            select(Products.models.Category.id, Products.models.Category.parent_id)
+            .where(Products.models.Category.id == category_id)
+        ).first()
+        if row is None:
+            return False
+        with self._lock:
+            self._link(row.id, row.parent_id)
+            self._descendants = {}
+        return True
+
+    def descendants(self, db: Session, category_id: int) -> FrozenSet[int]:
+        """The category itself plus every category below it"""
+        self._ensure_loaded(db)
+        cached = self._descendants.get(category_id)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            found = {category_id}
+            stack = [category_id]
+            while stack:
+                for child in self._children.get(stack.pop(), ()):
+                    if child not in found:
+                        found.add(child)
+                        stack.append(child)
+            result = frozenset(found)
+            self._descendants[category_id] = result
+        return result
+
+    def ancestors(self, db, category_ids: Iterable[int]) -> Set[int]:
+        """The given categories plus every category above them"""
+        self._ensure_loaded(db)
+        found: Set[int] = set()
+        with self._lock:
+            for category_id in category_ids:
+                while category_id is not None and category_id not in found:
+                    found.add(category_id)
+                    category_id = self._parent.get(category_id)
+        return found
+
+    def _read(self, conn, ids: Set[int]) -> Dict[int, Optional[int]]:
+        return dict(conn.execute(
+            select(Products.models.Category.id, Products.models.Category.parent_id)
+            .where(Products.models.Category.id.in_(ids))
+        ).all())
+
+    def refresh_nodes(self, conn, category_ids: Iterable[int]) -> None:
+        """Re-read the given categories; rows that no longer exist are dropped from the tree.
+        Children of a dropped category are re-read as well (deleted with it or re-parented)."""
+        if self._loaded_at is None:
+            return
+        ids = set(category_ids)
+        rows = self._read(conn, ids)
+        gone = ids - rows.keys()
+        while gone:
+            with self._lock:
+                children = {child for category_id in gone for child in self._children.get(category_id, ())} - ids
+            if not children:
+                break
+            ids |= children
+            found = self._read(conn, children)
+            rows.update(found)
+            gone = children - found.keys()
+
+        with self._lock:
+            for category_id in ids:
+                self._unlink(category_id)
+                if category_id in rows:
+                    self._link(category_id, rows[category_id])
+            for category_id in ids - rows.keys():
+                self._children.pop(category_id, None)
+            self._descendants = {}
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+
+category_tree = CategoryTree()
+
+
+@on_commit
+def _refresh_changed_categories(changes: ChangeSet) -> None:
+    if not changes.category_ids or changes.bind is None:
+        return
+    with changes.bind.connect() as conn:
+        category_tree.refresh_nodes(conn, changes.category_ids)
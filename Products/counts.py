@@ -0,0 +1,108 @@
+import random
+from typing import Any, Dict, Optional, Tuple
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+import Products.models
+from Products.cache import TTLCache, ChangeSet, on_commit
+from Products.logger import log
+from Products.search import tokenize
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+COUNT_CACHE_TTL = float(os.getenv("PRODUCT_COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_SIZE = int(os.getenv("PRODUCT_COUNT_CACHE_SIZE", "2048"))
+# Below this many rows an exact count is cheap enough that estimating is not worth the error
+EXACT_COUNT_THRESHOLD = int(os.getenv("PRODUCT_EXACT_COUNT_THRESHOLD", "50000"))
+SAMPLE_SIZE = int(os.getenv("PRODUCT_COUNT_SAMPLE_SIZE", "5000"))
+
+count_cache = TTLCache(maxsize=COUNT_CACHE_SIZE, ttl=COUNT_CACHE_TTL)
+
+
+def filter_signature(search: Optional[str], filters: Optional[Dict[str, Any]]) -> Tuple:
+    """Normalize listing filters so equivalent requests share a cache entry"""
+    filters = filters or {}
+    min_price = filters.get('min_price')
+    max_price = filters.get('max_price')
+    return (
+        " ".join(tokenize(search)),
+        float(min_price) if min_price else None,
+        float(max_price) if max_price else None,
+        filters.get('category_id') or None,
+        bool(filters.get('in_stock_only'))
+    )
+
+
+def table_row_estimate(db: Session) -> int:
+    """Row count of the products table from statistics rather than a scan"""
+    if db.get_bind().dialect.name == "mysql":
+        estimate = db.execute(text(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+        ), {"table": Products.models.Product.__tablename__}).scalar()
+        if estimate is not None:
+            return int(estimate)
+
+    # Ids are dense apart from deletions, so the id span is a close upper bound
+    low, high = db.execute(select(func.min(Products.models.Product.id), func.max(Products.models.Product.id))).one()
+    return (high - low + 1) if high is not None else 0
+
+
+def sample_count(db: Session, query, table_rows: int) -> int:
+    """Estimate a filtered count by measuring selectivity inside one random window of ids"""
+    Product = Products.models.Product
+    low, high = db.execute(select(func.min(Product.id), func.max(Product.id))).one()
+    if high is None:
+        return 0
+
+    start = random.randint(low, max(low, high - SAMPLE_SIZE))
+    end = db.execute(
+        select(Product.id).where(Product.id >= start).order_by(Product.id).offset(SAMPLE_SIZE - 1).limit(1)
+    ).scalar() or high
+
+    window = db.execute(select(func.count()).where(Product.id.between(start, end))).scalar() or 0
+    if window == 0:
+        return 0
+    matched = query.filter(Product.id.between(start, end)).order_by(None).count()
+    return round(table_rows * matched / window)
+
+
+def count_products(db: Session, query, search: Optional[str], filters: Optional[Dict[str, Any]], estimated: bool = False) -> Tuple[int, bool]:
+    """Count the rows of a filtered product query, served from the count cache when possible.
+
+    Returns (total, is_estimate). Estimated mode answers from table statistics (no filters)
+    or from a sampled selectivity (with filters) once the table is large enough.
+    """
+    signature = filter_signature(search, filters)
+    # A write committing while we count bumps this, and the stale total is not stored
+    generation = count_cache.generation
+    exact = count_cache.get(("exact",) + signature)
+    if exact is not None:
+        return exact, False
+
+    if estimated:
+        approx = count_cache.get(("estimate",) + signature)
+        if approx is not None:
+            return approx, True
+
+        table_rows = table_row_estimate(db)
+        if table_rows > EXACT_COUNT_THRESHOLD:
+            has_filters = any(value not in (None, "", False) for value in signature)
+            approx = table_rows if not has_filters else sample_count(db, query, table_rows)
+            count_cache.set(("estimate",) + signature, approx, generation)
+            log.info(f"Estimated product count {approx} for {signature}")
+            return approx, True
+
+    total = query.order_by(None).count()
+    count_cache.set(("exact",) + signature, total, generation)
+    return total, False
+
+
+@on_commit
+def _invalidate_counts(changes: ChangeSet) -> None:
+    # Product and category writes can move rows in or out of any filter, so they drop
+    # every cached total; stock-only writes can only affect in_stock_only listings.
+    if changes.product_ids or changes.category_ids:
+        count_cache.clear()
+    elif changes.inventory_product_ids:
+        count_cache.discard_if(lambda key: key[-1])
@@ -1,9 +1,26 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, func, desc, asc
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, or_, func, desc, asc, select, insert, bindparam
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.util.concurrency import await_only, in_greenlet
 from typing import Tuple, Dict, Any, Optional, List
-import Products.models, Products.schemas
+from datetime import datetime
+from decimal import Decimal
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from pydantic import ValidationError
+import Products.models, Products.schemas, Products.counts, Products.cache
+from Products.metrics import inventory_contention
+from Products.exceptions import InsufficientStockError, InventoryConflictError, ReservationConflictError
+from Products import inventory_shards, reservations, ledger, idempotency
+from Products.reservation_engine import reservation_engine
 from Products.logger import log
+from Products.search import product_search
+from Products.category_tree import category_tree
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -12,6 +29,8 @@ def create_product_manual(db: Session, product: Products.schemas.ProductCreate):
     try:
         db_product = Products.models.Product(**product.model_dump())
         db.add(db_product)
+        db.flush()
+        product_search.index_products(db, [db_product])
         db.commit()
         db.refresh(db_product)
         log.info(f"Product created manually: ID={db_product.id}, Name={db_product.name}")
@@ -21,11 +40,115 @@ def create_product_manual(db: Session, product: Products.schemas.ProductCreate):
         log.error(f"Failed to create product: {e}")
         raise
 
+BULK_BATCH_SIZE = int(os.getenv("PRODUCT_BULK_BATCH_SIZE", "1000"))
+
+def _insert_product_rows(db: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """Insert products in one multi-row statement and return their ids in input order"""
+    dialect = db.get_bind().dialect
+    if dialect.insert_executemany_returning_sort_by_parameter_order:
+        stmt = insert(Products.models.Product).returning(Products.models.Product.id, sort_by_parameter_order=True)
+        return list(db.execute(stmt, rows).scalars())
+
+    # MySQL has no RETURNING, and the ids of one statement need not be consecutive
+    # (auto_increment_increment, interleaved lock mode). They do increase in row order and
+    # MySQL's lastrowid is the first of them, so re-select the batch by its token from there.
+    Product = Products.models.Product
+    token = uuid.uuid4().hex
+    result = db.execute(insert(Product.__table__).values([{**row, "bulk_batch": token} for row in rows]))
+    stmt = select(Product.id).where(Product.bulk_batch == token)
+    if dialect.name == "mysql":
+        stmt = stmt.where(Product.id >= result.lastrowid)
+    ids = list(db.execute(stmt.order_by(Product.id)).scalars())
+    if len(ids) != len(rows):
+        raise RuntimeError(f"Bulk insert returned {len(ids)} id(s) for {len(rows)} row(s)")
+    return ids
+
+def insert_products_with_inventory(
+    db: Session,
+    product_rows: List[Dict[str, Any]],
+    inventory_rows: List[Optional[Dict[str, Any]]]
+) -> List[int]:
+    """Batched insert of products plus their inventory and search documents (no commit)"""
+    ids = _insert_product_rows(db, product_rows)
+    db.execute(insert(Products.models.Inventory), [
+        {**(inventory or {}), "product_id": product_id}
+        for product_id, inventory in zip(ids, inventory_rows)
+    ])
+    product_search.index_rows(db, (
+        (product_id, row["name"], row.get("brand"), row.get("attributes"))
+        for product_id, row in zip(ids, product_rows)
+    ))
+    Products.cache.mark_changed(db, product_ids=ids, inventory_product_ids=ids)
+    return ids
+
+def bulk_create_products(db: Session, items: List[Dict[str, Any]], batch_size: int = BULK_BATCH_SIZE) -> Dict[str, Any]:
+    """Create many products with inventory in multi-row batches.
+
+    Rows failing validation are reported and skipped. A batch the database rejects is
+    retried row by row inside savepoints so only the offending rows fail.
+    """
+    started = time.perf_counter()
+    errors: List[Dict[str, Any]] = []
+    valid: List[Tuple[int, Dict[str, Any], Dict[str, Any]]] = []
+
+    for index, raw in enumerate(items):
+        try:
+            item = Products.schemas.ProductBulkItem.model_validate(raw)
+        except ValidationError as e:
+            errors.append({"index": index, "error": "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())})
+            continue
+        if not category_tree.contains(db, item.category_id):
+            errors.append({"index": index, "error": f"Invalid category_id {item.category_id}"})
+            continue
+        inventory = (item.inventory or Products.schemas.InventoryBase()).model_dump()
+        valid.append((index, item.model_dump(exclude={"inventory"}), inventory))
+
+    created_ids: List[int] = []
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        try:
+            with db.begin_nested():
+                created_ids.extend(insert_products_with_inventory(db, [b[1] for b in batch], [b[2] for b in batch]))
+        except Exception as e:
+            log.warning(f"Bulk batch of {len(batch)} failed ({e}); retrying row by row")
+            for index, product_row, inventory_row in batch:
+                try:
+                    with db.begin_nested():
+                        created_ids.extend(insert_products_with_inventory(db, [product_row], [inventory_row]))
+                except Exception as row_error:
+                    errors.append({"index": index, "error": str(getattr(row_error, "orig", row_error))})
+        db.commit()
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    rate = len(created_ids) / (elapsed_ms / 1000) if elapsed_ms else 0
+    log.info(f"Bulk created {len(created_ids)} product(s), {len(errors)} failed, in {elapsed_ms:.1f} ms ({rate:.0f} rows/s)")
+    return {
+        "created": len(created_ids),
+        "failed": len(errors),
+        "product_ids": created_ids,
+        "errors": sorted(errors, key=lambda err: err["index"]),
+        "elapsed_ms": round(elapsed_ms, 2)
+    }
+
 def get_all_products(db: Session):
     products = db.query(Products.models.Product).all()
     log.info(f"Retrieved {len(products)} products")
     return products
 
+def get_random_products(db: Session, count: int):
+    """Up to `count` random products, picked from the id span instead of loading the catalog"""
+    Product = Products.models.Product
+    low, high = db.execute(select(func.min(Product.id), func.max(Product.id))).one()
+    if high is None:
+        return []
+    span = high - low + 1
+    # Oversample so gaps left by deleted products rarely leave the batch short
+    ids = random.sample(range(low, high + 1), min(span, count * 2))
+    products = db.query(Product).filter(Product.id.in_(ids)).all()
+    random.shuffle(products)
+    log.info(f"Sampled {min(len(products), count)} random product(s)")
+    return products[:count]
+
 def get_product_by_id(db: Session, id: int):
     product = db.query(Products.models.Product).filter(Products.models.Product.id == id).first()
     if product:
@@ -34,6 +157,50 @@ def get_product_by_id(db: Session, id: int):
         log.warning(f"No product found with ID={id}")
     return product
 
+product_detail_cache = Products.cache.ProductDetailCache(
+    maxsize=int(os.getenv("PRODUCT_DETAIL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PRODUCT_DETAIL_CACHE_TTL", "300"))
+)
+
+def get_product_detail(db: Session, id: int) -> Optional[bytes]:
+    """JSON-serialized schemas.Product for a product id, read through product_detail_cache"""
+    payload = product_detail_cache.get(id)
+    if payload is not None:
+        return payload
+
+    generation = product_detail_cache.generation
+    product = db.query(Products.models.Product)\
+        .options(
+            joinedload(Products.models.Product.category).selectinload(Products.models.Category.children),
+            selectinload(Products.models.Product.price_history)
+        )\
+        .filter(Products.models.Product.id == id).first()
+    if not product:
+        log.warning(f"No product found with ID={id}")
+        return None
+
+    payload = Products.schemas.Product.model_validate(product).model_dump_json().encode()
+    product_detail_cache.put(id, product.category_id, payload, generation)
+    return payload
+
+@Products.cache.on_commit
+def _invalidate_product_details(changes: Products.cache.ChangeSet) -> None:
+    category_ids = changes.category_ids
+    if category_ids and changes.bind is not None:
+        # A detail embeds its category's whole subtree, so a change anywhere below an
+        # ancestor shows up in the details of that ancestor's products too
+        try:
+            with changes.bind.connect() as conn:
+                category_ids = category_tree.ancestors(conn, category_ids)
+        except Exception as e:
+            log.error(f"Resolving category ancestors failed, dropping every cached detail: {e}")
+            product_detail_cache.clear()
+            return
+    product_detail_cache.invalidate(
+        product_ids=changes.product_ids | changes.inventory_product_ids,
+        category_ids=category_ids
+    )
+
 def get_product_by_name(db: Session, name: str):
     return db.query(Products.models.Product).filter(Products.models.Product.name == name).first()
 
@@ -50,6 +217,51 @@ def get_all_categories(db: Session):
     log.info(f"Retrieved {len(categories)} categories")
     return categories
 
+SORTABLE_COLUMNS = ("id", "name", "price", "brand", "created_at", "updated_at")
+
+def _apply_product_filters(db: Session, query, search: Optional[str], filters: Optional[Dict[str, Any]]):
+    """Apply search and filters; returns the query and a relevance ordering when searching"""
+    relevance = None
+    if search:
+        query, relevance = product_search.apply(db, query, search)
+
+    if filters:
+        if filters.get('min_price'):
+            query = query.filter(Products.models.Product.price >= filters['min_price'])
+        if filters.get('max_price'):
+            query = query.filter(Products.models.Product.price <= filters['max_price'])
+        if filters.get('category_id'):
+            category_ids = category_tree.descendants(db, filters['category_id'])
+            query = query.filter(Products.models.Product.category_id.in_(category_ids))
+        if filters.get('in_stock_only'):
+            query = query.filter(Products.models.Product.inventory.has(Products.models.Inventory.quantity_available > 0))
+    return query, relevance
+
+def _apply_sort(query, sort_by: str, sort_dir: str, relevance=None):
+    if sort_by == "relevance":
+        if relevance is not None:
+            query = query.order_by(relevance, desc(Products.models.Product.id))
+    elif hasattr(Products.models.Product, sort_by):
+        sort_column = getattr(Products.models.Product, sort_by)
+        if sort_dir == "desc":
+            query = query.order_by(desc(sort_column))
+        else:
+            query = query.order_by(asc(sort_column))
+    else:
+        log.warning(f"Invalid sort_by column '{sort_by}'")
+    return query
+
+def count_products(
+    db: Session,
+    search: Optional[str] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    estimated: bool = False
+) -> Tuple[int, bool]:
+    """Filtered product total as (total, is_estimate), cached per normalized filter signature"""
+    query = db.query(Products.models.Product.id)
+    query, _ = _apply_product_filters(db, query, search, filters)
+    return Products.counts.count_products(db, query, search, filters, estimated)
+
 def get_paginated_products(
     db: Session, 
     skip: int, 
@@ -57,42 +269,17 @@ def get_paginated_products(
     search: Optional[str] = None,
     sort_by: str = "created_at",
     sort_dir: str = "desc",
-    filters: Optional[Dict[str, Any]] = None
-) -> Tuple[int, List[Products.models.Product]]:
+    filters: Optional[Dict[str, Any]] = None,
+    with_total: bool = True
+) -> Tuple[Optional[int], List[Products.models.Product]]:
     try:
         log.info(f"Fetching paginated products | Skip={skip}, Limit={limit}, Search={search}, Sort={sort_by} {sort_dir}, Filters={filters}")
         query = db.query(Products.models.Product).options(joinedload(Products.models.Product.category))
-        
-        if search:
-            search_term = f"%{search}%"
-            query = query.filter(
-                or_(
-                    Products.models.Product.name.like(search_term),
-                    Products.models.Product.brand.like(search_term)
-                )
-            )
-        
-        if filters:
-            if filters.get('min_price'):
-                query = query.filter(Products.models.Product.price >= filters['min_price'])
-            if filters.get('max_price'):
-                query = query.filter(Products.models.Product.price <= filters['max_price'])
-            if filters.get('category_id'):
-                query = query.filter(Products.models.Product.category_id == filters['category_id'])
-            if filters.get('in_stock_only'):
-                query = query.filter(Products.models.Product.stock_quantity > 0)
-
-        total = query.count()
-
-        if hasattr(Products.models.Product, sort_by):
-            sort_column = getattr(Products.models.Product, sort_by)
-            if sort_dir == "desc":
-                query = query.order_by(desc(sort_column))
-            else:
-                query = query.order_by(asc(sort_column))
-        else:
-            log.warning(f"Invalid sort_by column '{sort_by}'")
+        query, relevance = _apply_product_filters(db, query, search, filters)
 
+        total = count_products(db, search, filters)[0] if with_total else None
+
+        query = _apply_sort(query, sort_by, sort_dir, relevance)
         products = query.offset(skip).limit(limit).all()
         log.info(f"Returning {len(products)} products out of total {total}")
         return total, products
@@ -101,6 +288,132 @@ def get_paginated_products(
         log.error(f"Error in get_paginated_products: {e}")
         raise
 
+def encode_cursor(sort_by: str, sort_dir: str, value: Any, last_id: int) -> str:
+    """Pack the sort key of the last row on a page into an opaque, URL-safe token"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, Decimal):
+        value = str(value)
+    payload = json.dumps({"s": sort_by, "d": sort_dir, "v": value, "id": last_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort_by: str, sort_dir: str) -> Tuple[Any, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        value, last_id = payload["v"], int(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed cursor")
+
+    if payload.get("s") != sort_by or payload.get("d") != sort_dir:
+        raise ValueError("Cursor was issued for a different sort order")
+
+    if value is not None:
+        if sort_by in ("created_at", "updated_at"):
+            value = datetime.fromisoformat(value)
+        elif sort_by == "price":
+            value = Decimal(value)
+    return value, last_id
+
+def _keyset_predicate(sort_column, id_column, sort_dir: str, value: Any, last_id: int):
+    # MySQL and SQLite both order NULLs as the smallest value, so a NULL sort key
+    # sits at the start of an ascending scan and at the end of a descending one.
+    if sort_column is id_column:
+        return id_column < last_id if sort_dir == "desc" else id_column > last_id
+
+    if sort_dir == "desc":
+        if value is None:
+            return and_(sort_column.is_(None), id_column < last_id)
+        return or_(
+            sort_column < value,
+            sort_column.is_(None),
+            and_(sort_column == value, id_column < last_id)
+        )
+
+    if value is None:
+        return or_(sort_column.isnot(None), and_(sort_column.is_(None), id_column > last_id))
+    return or_(sort_column > value, and_(sort_column == value, id_column > last_id))
+
+def _apply_keyset(db: Session, query, cursor: Optional[str], sort_by: str, sort_dir: str):
+    if sort_by not in SORTABLE_COLUMNS:
+        raise ValueError(f"sort_by must be one of {', '.join(SORTABLE_COLUMNS)} for cursor pagination")
+
+    sort_column = getattr(Products.models.Product, sort_by)
+    id_column = Products.models.Product.id
+    normalize = None
+    if sort_by in ("created_at", "updated_at") and db.get_bind().dialect.name == "sqlite":
+        # SQLite keeps timestamps as text: "YYYY-MM-DD HH:MM:SS" from CURRENT_TIMESTAMP but
+        # with microseconds when bound from Python, which breaks the string comparison
+        normalize = lambda value: func.strftime("%Y-%m-%d %H:%M:%f", value)
+        sort_column = normalize(sort_column)
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort_by, sort_dir)
+        if normalize is not None and value is not None:
+            value = normalize(value)
+        query = query.filter(_keyset_predicate(sort_column, id_column, sort_dir, value, last_id))
+
+    direction = desc if sort_dir == "desc" else asc
+    if sort_column is id_column:
+        return query.order_by(direction(id_column))
+    return query.order_by(direction(sort_column), direction(id_column))
+
+def _summary_select(sort_by: Optional[str] = None):
+    """Only the ProductSummary columns: category name and stock come from joins and the
+    rating is pulled out of the attributes JSON in SQL, so no ORM objects are built."""
+    Product = Products.models.Product
+    columns = [
+        Product.id,
+        Product.name,
+        Product.price,
+        Product.brand,
+        func.coalesce(Products.models.Category.name, "Unknown").label("category_name"),
+        func.coalesce(Products.models.Inventory.quantity_available, 0).label("stock_quantity"),
+        Product.attributes["rating"].as_float().label("rating")
+    ]
+    if sort_by in ("created_at", "updated_at"):
+        columns.append(getattr(Product, sort_by).label("sort_key"))
+    return select(*columns)\
+        .select_from(Product)\
+        .outerjoin(Products.models.Category, Products.models.Category.id == Product.category_id)\
+        .outerjoin(Products.models.Inventory, Products.models.Inventory.product_id == Product.id)
+
+def list_product_summaries(
+    db: Session,
+    skip: int,
+    limit: int,
+    search: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_dir: str = "desc",
+    filters: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """Offset page of product list rows as plain dicts"""
+    stmt, relevance = _apply_product_filters(db, _summary_select(), search, filters)
+    stmt = _apply_sort(stmt, sort_by, sort_dir, relevance)
+    return [dict(row) for row in db.execute(stmt.offset(skip).limit(limit)).mappings()]
+
+def list_product_summaries_keyset(
+    db: Session,
+    limit: int,
+    cursor: Optional[str] = None,
+    search: Optional[str] = None,
+    sort_by: str = "created_at",
+    sort_dir: str = "desc",
+    filters: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Cursor page of product list rows as plain dicts, plus the next cursor"""
+    stmt, _ = _apply_product_filters(db, _summary_select(sort_by), search, filters)
+    stmt = _apply_keyset(db, stmt, cursor, sort_by, sort_dir)
+    rows = [dict(row) for row in db.execute(stmt.limit(limit + 1)).mappings()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(sort_by, sort_dir, last.get("sort_key", last.get(sort_by)), last["id"])
+    rows = rows[:limit]
+    for row in rows:
+        row.pop("sort_key", None)
+    return rows, next_cursor
+
 def update_product(db: Session, product_id: int, product_update: Products.schemas.ProductUpdate):
     """Update a product with only the provided fields"""
     
@@ -135,6 +448,8 @@ def update_product(db: Session, product_id: int, product_update: Products.schema
             setattr(db_product, field, value)
     
     try:
+        if {'name', 'brand', 'attributes'} & set(product_update.model_fields_set):
+            product_search.index_products(db, [db_product])
         db.commit()
         db.refresh(db_product)
         return db_product
@@ -143,26 +458,68 @@ def update_product(db: Session, product_id: int, product_update: Products.schema
         raise e
     
 def get_inventory_by_product_id(db: Session, product_id: int):
-    return db.query(Products.models.Inventory).filter(Products.models.Inventory.product_id == product_id).first()
+    inventory = db.query(Products.models.Inventory).filter(Products.models.Inventory.product_id == product_id).first()
+    if inventory is not None and inventory.shard_count:
+        # Report the live shard totals without marking the rollup columns dirty
+        shards = inventory_shards.read_shards(db, [product_id]).get(product_id, [])
+        available, reserved = inventory_shards.totals(shards)
+        set_committed_value(inventory, "quantity_available", available)
+        set_committed_value(inventory, "quantity_reserve", reserved)
+    if inventory is not None and reservation_engine.enabled:
+        # The engine's counters run ahead of the table until the write-behind catches up
+        for available, reserved in reservation_engine.counters([product_id]).values():
+            set_committed_value(inventory, "quantity_available", available)
+            set_committed_value(inventory, "quantity_reserve", reserved)
+    return inventory
 
 def update_inventory_quantity(db: Session, product_id: int, quantity_delta: int, reason: str = None, order_id: int = None):
-    inventory = get_inventory_by_product_id(db, product_id)
-    if not inventory:
-        raise Exception("Inventory record not found for product_id")
+    if reservation_engine.enabled:
+        applied = reservation_engine.apply(
+            {product_id: (quantity_delta, 0)}, strict=False, clamp_available=True,
+            build_movements=lambda applied: [
+                {"product_id": product_id, "order_id": order_id, "change": quantity_delta, "reason": reason}
+            ]
+        )
+        if product_id not in applied:
+            raise Exception("Inventory record not found for product_id")
+        return get_inventory_by_product_id(db, product_id)
 
-    inventory.quantity_available += quantity_delta
-    inventory.quantity_available = max(0, inventory.quantity_available)
+    def attempt():
+        current = _read_stock(db, [product_id])
+        if product_id not in current:
+            raise Exception("Inventory record not found for product_id")
+        version, available, _, shard_count = current[product_id]
+        if shard_count:
+            shards = inventory_shards.read_shards(db, [product_id])[product_id]
+            available = inventory_shards.totals(shards)[0]
+        # Stock never goes below zero, so a large negative delta only empties it
+        delta = max(quantity_delta, -available)
+        if shard_count:
+            if not inventory_shards.apply_moves(db, inventory_shards.plan_moves(shards, delta, 0)):
+                raise InventoryConflictError("An inventory shard was drained concurrently")
+        else:
+            _apply_guarded(db, [{
+                "p_id": product_id, "p_version": version, "p_available": delta, "p_reserved": 0,
+                "p_need_available": 0, "p_need_reserved": 0, "p_now": Products.models.utc_now().replace(tzinfo=None)
+            }])
+        Products.cache.mark_changed(db, inventory_product_ids=[product_id])
+        ledger.record(db, [
+            {"product_id": product_id, "order_id": order_id, "change": quantity_delta, "reason": reason}
+        ])
 
-    movement = Products.models.StockMovement(
-        product_id=product_id,
-        order_id=order_id,
-        change=quantity_delta,
-        reason=reason
-        )
-    db.add(movement)
-    db.commit()
-    db.refresh(inventory)
-    return inventory
+    _with_conflict_retry(db, "update_inventory_quantity", attempt)
+    return get_inventory_by_product_id(db, product_id)
+
+def _set_sharded_stock(db: Session, inventory, values: Dict[str, Any]) -> None:
+    """Move absolute stock values of a sharded product onto its shards (the row holds only a rollup)"""
+    if not inventory.shard_count or not {"quantity_available", "quantity_reserve"} & values.keys():
+        return
+    inventory_shards.rebalance_product(
+        db, inventory.product_id,
+        available=values.pop("quantity_available", None),
+        reserved=values.pop("quantity_reserve", None)
+    )
+    Products.cache.mark_changed(db, inventory_product_ids=[inventory.product_id])
 
 def create_or_update_inventory(db: Session, product_id: int, data: Products.schemas.InventoryBase):
     inventory = get_inventory_by_product_id(db, product_id)
@@ -170,7 +527,9 @@ def create_or_update_inventory(db: Session, product_id: int, data: Products.sche
         inventory = Products.models.Inventory(product_id=product_id, **data.model_dump())
         db.add(inventory)
     else:
-        for key, value in data.model_dump().items():
+        values = data.model_dump()
+        _set_sharded_stock(db, inventory, values)
+        for key, value in values.items():
             setattr(inventory, key, value)
     db.commit()
     db.refresh(inventory)
@@ -189,34 +548,397 @@ def update_inventory_settings(
     if not inventory:
         raise Exception("Inventory not found")
 
-    for key, value in update_data.model_dump(exclude_unset=True).items():
+    values = update_data.model_dump(exclude_unset=True)
+    _set_sharded_stock(db, inventory, values)
+    for key, value in values.items():
         setattr(inventory, key, value)
 
     db.commit()
     db.refresh(inventory)
     return inventory
 
+INVENTORY_CONCURRENCY = os.getenv("INVENTORY_CONCURRENCY", "optimistic")
+INVENTORY_MAX_RETRIES = int(os.getenv("INVENTORY_MAX_RETRIES", "5"))
+INVENTORY_RETRY_BASE_MS = float(os.getenv("INVENTORY_RETRY_BASE_MS", "5"))
+
+def _merge_quantities(items: List[Dict[str, Any]]) -> Dict[int, int]:
+    """Total quantity per product; a product listed twice is locked and checked once"""
+    quantities: Dict[int, int] = {}
+    for item in items:
+        quantity = int(item["quantity"])
+        if quantity <= 0:
+            raise ValueError(f"Quantity for product {item['product_id']} must be positive")
+        product_id = int(item["product_id"])
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+def lock_inventory(db: Session, product_ids) -> Dict[int, Any]:
+    """Load and row-lock the inventory of many products in one query.
+
+    Locks are taken in ascending product_id order so two checkouts touching the same
+    products always queue behind each other instead of deadlocking.
+    """
+    rows = db.query(Products.models.Inventory)\
+        .filter(Products.models.Inventory.product_id.in_(sorted(set(product_ids))))\
+        .order_by(Products.models.Inventory.product_id)\
+        .with_for_update()\
+        .populate_existing()\
+        .all()
+    return {inventory.product_id: inventory for inventory in rows}
+
+def _read_stock(db: Session, product_ids) -> Dict[int, Tuple[int, int, int, int]]:
+    """product_id -> (version, available, reserved, shard_count), read without locks.
+
+    For sharded products available/reserved are only the rollup; read their shards for live totals.
+    """
+    Inventory = Products.models.Inventory
+    rows = db.execute(
+        select(Inventory.product_id, Inventory.version, Inventory.quantity_available, Inventory.quantity_reserve, Inventory.shard_count)
+        .where(Inventory.product_id.in_(sorted(set(product_ids))))
+    )
+    return {row[0]: (row[1] or 0, row[2] or 0, row[3] or 0, row[4] or 0) for row in rows}
+
+_guarded_stock_update = Products.models.Inventory.__table__.update()\
+    .where(
+        Products.models.Inventory.__table__.c.product_id == bindparam("p_id"),
+        Products.models.Inventory.__table__.c.version == bindparam("p_version"),
+        Products.models.Inventory.__table__.c.quantity_available >= bindparam("p_need_available"),
+        Products.models.Inventory.__table__.c.quantity_reserve >= bindparam("p_need_reserved")
+    )\
+    .values(
+        quantity_available=Products.models.Inventory.__table__.c.quantity_available + bindparam("p_available"),
+        quantity_reserve=Products.models.Inventory.__table__.c.quantity_reserve + bindparam("p_reserved"),
+        version=Products.models.Inventory.__table__.c.version + 1,
+        last_updated=bindparam("p_now")
+    )
+
+def _apply_guarded(db: Session, params: List[Dict[str, Any]]) -> None:
+    """UPDATE ... WHERE version = ? AND quantity_available >= ? for every row; any miss is a conflict"""
+    if not params:
+        return
+    if db.get_bind().dialect.supports_sane_multi_rowcount:
+        matched = db.execute(_guarded_stock_update, params).rowcount
+    else:
+        matched = sum(db.execute(_guarded_stock_update, row).rowcount for row in params)
+    if matched != len(params):
+        raise InventoryConflictError(f"{len(params) - matched} inventory row(s) changed concurrently")
+
+def _backoff(seconds: float) -> None:
+    if in_greenlet():
+        # Called from AsyncSession.run_sync(): yield to the event loop instead of blocking it
+        await_only(asyncio.sleep(seconds))
+    else:
+        time.sleep(seconds)
+
+def _with_conflict_retry(db: Session, endpoint: str, attempt):
+    """Run attempt() and commit, retrying with jittered exponential backoff on write conflicts"""
+    for retry in range(INVENTORY_MAX_RETRIES + 1):
+        inventory_contention.incr(endpoint, "attempts")
+        try:
+            result = attempt()
+            db.commit()
+            inventory_contention.incr(endpoint, "commits")
+            return result
+        except InventoryConflictError:
+            db.rollback()
+            inventory_contention.incr(endpoint, "conflicts")
+            if retry == INVENTORY_MAX_RETRIES:
+                break
+            inventory_contention.incr(endpoint, "retries")
+            _backoff(random.uniform(0, INVENTORY_RETRY_BASE_MS * 2 ** retry) / 1000)
+        except Exception:
+            db.rollback()
+            raise
+    inventory_contention.incr(endpoint, "exhausted")
+    raise InventoryConflictError(f"Inventory is busy, gave up after {INVENTORY_MAX_RETRIES + 1} attempts")
+
+def _adjust_stock(
+    db: Session,
+    endpoint: str,
+    deltas: Dict[int, Tuple[int, int]],
+    strict: bool,
+    build_movements,
+    reservation_changes=None,
+    result=None
+) -> Dict[int, Tuple[int, int]]:
+    """Apply (available, reserved) deltas per product and log the movements, in one transaction.
+
+    Products whose stock cannot absorb the delta raise InsufficientStockError when strict,
+    otherwise they are skipped. reservation_changes(applied), if given, returns the
+    reservation rows to add and takes to consume (see reservations.write), written in the
+    same transaction. result(applied), if given, is what the caller will return: when an
+    Idempotency-Key is being served it is recorded in the transaction too (idempotency.record).
+    Returns the new (available, reserved) of the applied products.
+    """
+    if reservation_engine.enabled:
+        # The engine journals the reservation rows with the stock change and writes both
+        # behind together; end this read transaction so it holds no rows the write-behind needs
+        db.rollback()
+        return reservation_engine.apply(
+            deltas, strict, build_movements,
+            reservation_changes=reservation_changes,
+            idempotency_row=(lambda applied: idempotency.row(result(applied))) if result else None
+        )
+    pessimistic = INVENTORY_CONCURRENCY == "pessimistic"
+
+    def attempt():
+        current = _read_stock(db, deltas)
+        sharded = {pid for pid, row in current.items() if row[3]}
+        if pessimistic:
+            # Sharded products never lock their (hot) inventory row; their shards are guarded instead
+            locked = lock_inventory(db, set(deltas) - sharded)
+            if any(inv.shard_count for inv in locked.values()):
+                raise InventoryConflictError("Inventory was sharded concurrently")
+            current.update({pid: (inv.version or 0, inv.quantity_available or 0, inv.quantity_reserve or 0, 0) for pid, inv in locked.items()})
+        shards = inventory_shards.read_shards(db, sharded) if sharded else {}
+        if sharded - shards.keys():
+            raise InventoryConflictError("Inventory shards were merged concurrently")
+
+        applied: Dict[int, Tuple[int, int]] = {}
+        for product_id, (d_available, d_reserved) in sorted(deltas.items()):
+            version, available, reserved, _ = current.get(product_id, (0, 0, 0, 0))
+            if product_id in sharded:
+                # Totals from the same snapshot the shard moves are planned on
+                available, reserved = inventory_shards.totals(shards[product_id])
+            if product_id not in current or available + d_available < 0 or reserved + d_reserved < 0:
+                if strict:
+                    raise InsufficientStockError(
+                        f"Insufficient stock for product {product_id} (requested: {-d_available}, available: {available})"
+                    )
+                continue
+            applied[product_id] = (available + d_available, reserved + d_reserved)
+
+        shard_moves = [
+            move for product_id in applied if product_id in sharded
+            for move in inventory_shards.plan_moves(shards[product_id], *deltas[product_id])
+        ]
+        if not inventory_shards.apply_moves(db, shard_moves):
+            raise InventoryConflictError("An inventory shard was drained concurrently")
+
+        unsharded = [product_id for product_id in applied if product_id not in sharded]
+        if pessimistic:
+            for product_id in unsharded:
+                locked[product_id].quantity_available, locked[product_id].quantity_reserve = applied[product_id]
+                locked[product_id].version = (locked[product_id].version or 0) + 1
+            db.flush()
+        else:
+            now = Products.models.utc_now().replace(tzinfo=None)
+            _apply_guarded(db, [
+                {
+                    "p_id": product_id,
+                    "p_version": current[product_id][0],
+                    "p_available": deltas[product_id][0],
+                    "p_reserved": deltas[product_id][1],
+                    "p_need_available": max(0, -deltas[product_id][0]),
+                    "p_need_reserved": max(0, -deltas[product_id][1]),
+                    "p_now": now
+                } for product_id in unsharded
+            ])
+        # Core UPDATEs skip the flush hook, so report the stock change for cache/facet refresh
+        Products.cache.mark_changed(db, inventory_product_ids=applied)
+
+        ledger.record(db, build_movements(applied))
+        if reservation_changes is not None:
+            reservations.write(db, reservation_changes(applied))
+        if result is not None:
+            idempotency.record(db, result(applied))
+        return applied
+
+    return _with_conflict_retry(db, endpoint, attempt)
+
+def _item_cart(item: Dict[str, Any], cart_id: Optional[str]) -> Optional[int]:
+    return reservations.cart_key(item.get("cart_id", cart_id))
+
+def reserve_items(
+    db: Session,
+    items: List[Dict[str, Any]],
+    cart_id: Optional[str] = None,
+    endpoint: str = "reserve",
+    reason: Optional[str] = None,
+    ttl: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Move stock from available to reserved for every item, or for none of them.
+
+    Each (cart, product) gets a reservation row that expires after ttl seconds
+    (RESERVATION_TTL_SECONDS by default), when the expiry sweeper releases it.
+    """
+    quantities = _merge_quantities(items)
+    held: Dict[reservations.Key, int] = {}
+    for item in items:
+        key = (_item_cart(item, cart_id), int(item["product_id"]))
+        held[key] = held.get(key, 0) + int(item["quantity"])
+    reason = reason or (f"reserve_order_{cart_id}" if cart_id else "reserve")
+    rows = reservations.new_rows(held, ttl)
+
+    def result(applied):
+        return [
+            {**item, "remaining_available": applied[int(item["product_id"])][0], "expires_at": rows[0]["expires_at"].isoformat()}
+            for item in items
+        ]
+
+    applied = _adjust_stock(
+        db, endpoint, {pid: (-q, q) for pid, q in quantities.items()}, strict=True,
+        build_movements=lambda applied: [
+            {"product_id": int(item["product_id"]), "cart_id": _item_cart(item, cart_id), "change": -int(item["quantity"]), "reason": reason}
+            for item in items
+        ],
+        reservation_changes=lambda applied: {"add": rows},
+        result=result
+    )
+    return result(applied)
+
+def _settle_reserved(
+    db: Session,
+    endpoint: str,
+    items: List[Dict[str, Any]],
+    cart_id: Optional[str],
+    restock: bool,
+    reason: str,
+    line,
+    order_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Shared body of release/finalize, limited to what each cart still holds.
+
+    A release only returns the part of a reservation that has not expired yet (the
+    sweeper already returned the rest). A finalize sells the held part from reserved and
+    any expired part straight from available. Items with nothing to do are skipped; the
+    others are returned as line(item, new (available, reserved) of its product).
+    """
+    _merge_quantities(items)
+    wanted: Dict[reservations.Key, int] = {}
+    for item in items:
+        key = (_item_cart(item, cart_id), int(item["product_id"]))
+        wanted[key] = wanted.get(key, 0) + int(item["quantity"])
+
+    for _ in range(INVENTORY_MAX_RETRIES + 1):
+        if reservation_engine.enabled:
+            # Reservations made through the engine reach the table with its write-behind
+            reservation_engine.sync()
+        held, takes = reservations.claim(db, wanted)
+        remaining = dict(held)
+        settled = []
+        for item in items:
+            key = (_item_cart(item, cart_id), int(item["product_id"]))
+            from_reserve = min(int(item["quantity"]), remaining[key])
+            remaining[key] -= from_reserve
+            if restock and from_reserve == 0:
+                continue
+            settled.append((item, from_reserve))
+
+        deltas: Dict[int, Tuple[int, int]] = {}
+        for item, from_reserve in settled:
+            d_available, d_reserved = deltas.get(int(item["product_id"]), (0, 0))
+            if restock:
+                deltas[int(item["product_id"])] = (d_available + from_reserve, d_reserved - from_reserve)
+            else:
+                deltas[int(item["product_id"])] = (d_available - (int(item["quantity"]) - from_reserve), d_reserved - from_reserve)
+        if not deltas:
+            return []
+
+        def result(applied, settled=settled):
+            return [
+                line({**item, "quantity": from_reserve} if restock else item, applied[int(item["product_id"])])
+                for item, from_reserve in settled if int(item["product_id"]) in applied
+            ]
+
+        try:
+            applied = _adjust_stock(
+                db, endpoint, deltas, strict=False,
+                build_movements=lambda applied: [
+                    {
+                        "product_id": int(item["product_id"]),
+                        "cart_id": _item_cart(item, cart_id),
+                        "order_id": item.get("order_id", order_id),
+                        "change": from_reserve if restock else -int(item["quantity"]),
+                        "reason": reason
+                    } for item, from_reserve in settled if int(item["product_id"]) in applied
+                ],
+                reservation_changes=lambda applied: {"consume": [
+                    take for take in takes if take["r_product_id"] in applied
+                ]},
+                result=result
+            )
+        except ReservationConflictError:
+            continue  # another release/sweep consumed the same rows; claim again
+        return result(applied)
+    raise InventoryConflictError("Reservations are busy, gave up")
+
+def release_items(db: Session, items: List[Dict[str, Any]], cart_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Return reserved stock to available (cart item removed, checkout abandoned)"""
+    return _settle_reserved(
+        db, "release", items, cart_id, restock=True,
+        reason=f"release_order_{cart_id}" if cart_id else "release",
+        line=lambda item, stock: {**item, "new_available": stock[0]}
+    )
+
+def finalize_items(db: Session, items: List[Dict[str, Any]], order_id: Optional[str] = None, cart_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Turn reserved stock into sold stock"""
+    return _settle_reserved(
+        db, "finalize", items, cart_id, restock=False,
+        reason=f"finalize_order_{order_id}" if order_id else "finalize",
+        line=lambda item, stock: {**item, "remaining_reserved": stock[1]}, order_id=order_id
+    )
+
+def restock_items(db: Session, items: List[Dict[str, Any]], order_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Put sold stock back on sale (a finalized order was cancelled or returned).
+
+    Unknown products are skipped; the others are returned with their new available stock.
+    """
+    quantities = _merge_quantities(items)
+
+    def result(applied):
+        return [
+            {**item, "new_available": applied[int(item["product_id"])][0]}
+            for item in items if int(item["product_id"]) in applied
+        ]
+
+    def movement(item):
+        item_order = item.get("order_id", order_id)
+        return {
+            "product_id": int(item["product_id"]),
+            "cart_id": _item_cart(item, None),
+            "order_id": item_order,
+            "change": int(item["quantity"]),
+            "reason": f"return_order_{item_order}" if item_order else "return"
+        }
+
+    applied = _adjust_stock(
+        db, "restock", {pid: (q, 0) for pid, q in quantities.items()}, strict=False,
+        build_movements=lambda applied: [movement(item) for item in items if int(item["product_id"]) in applied],
+        result=result
+    )
+    return result(applied)
+
+def expire_reservations(db: Session, batch_size: int = reservations.SWEEP_BATCH_SIZE, now=None) -> Tuple[int, int]:
+    """Release one batch of expired reservations; returns (rows, units) released"""
+    due = reservations.due_batch(db, batch_size, now)
+    if not due:
+        db.rollback()
+        return 0, 0
+    deltas: Dict[int, Tuple[int, int]] = {}
+    for _, product_id, _, quantity in due:
+        held = deltas.get(product_id, (0, 0))[0] + quantity
+        deltas[product_id] = (held, -held)
+    _adjust_stock(
+        db, "expire", deltas, strict=False,
+        build_movements=lambda applied: [
+            {"product_id": product_id, "cart_id": cart_id, "change": quantity, "reason": "reservation_expired"}
+            for _, product_id, cart_id, quantity in due if product_id in applied
+        ],
+        # Rows of a product whose reserve no longer covers them are dropped all the same
+        reservation_changes=lambda applied: {"consume": [
+            {"r_id": row_id, "r_take": quantity, "r_whole": True} for row_id, _, _, quantity in due
+        ]}
+    )
+    return len(due), sum(row[3] for row in due)
+
 def reserve_stock(db: Session, product_id: int, quantity: int) -> bool:
     """Reserve stock with proper transaction management"""
     try:
-        inventory = get_inventory_by_product_id(db, product_id)
-        if not inventory or inventory.quantity_available < quantity:
-            return False
-            
-        inventory.quantity_available -= quantity
-        inventory.quantity_reserve += quantity
-        
-        movement = Products.models.StockMovement(
-            product_id=product_id,
-            change=-quantity,
-            reason="reserved"
-        )
-        db.add(movement)
-        db.commit()
+        reserve_items(db, [{"product_id": product_id, "quantity": quantity}], endpoint="reserve_stock", reason="reserved")
         return True
-    except Exception as e:
-        db.rollback()
-        raise e
+    except InsufficientStockError:
+        return False
     
 def generate_recommendations(user_id: int, limit: int, db: Session) -> List[dict]:
     products = db.query(Products.models.Product)\
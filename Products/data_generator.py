@@ -4,6 +4,8 @@ from faker import Faker
 from sqlalchemy.orm import Session
 from Products.models import Product, Category, PriceHistory
 from Products.logger import log
+from datetime import datetime, timedelta
+import Products.crud
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -93,6 +95,8 @@ class DataGenerator:
         }
         
         try:
+            product_rows = []
+            inventory_rows = []
             for _ in range(count):
                 if not categories:
                     raise ValueError("No categories available. Please create categories first.")
@@ -114,36 +118,34 @@ class DataGenerator:
                     "brand": self.generate_brand(),
                     "attributes": self.generate_product_attributes(category.name)
                 }
-
-                product = Product(**product_data)
-                db.add(product)
-                db.flush()
-
-                from models import Inventory
-                from datetime import datetime, timedelta
                 
                 if category.name in categories_with_expiry:
                     expiry_date = datetime.now() + timedelta(days=random.randint(30, 365))
                 else:
                     expiry_date = datetime(9999, 12, 31)
                 
-                inventory = Inventory(
-                    product_id=product.id,
-                    quantity_available=stock_quantity,
-                    quantity_reserve=random.randint(0, min(50, stock_quantity // 4)),
-                    reorder_level=random.randint(5, 25),
-                    reorder_quantity=random.randint(20, 100),
-                    unit_cost=round(product_data["price"] * random.uniform(0.4, 0.7), 2), 
-                    last_restocked=datetime.now() - timedelta(days=random.randint(1, 30)),
-                    expiry_date=expiry_date,
-                    batch_number=self.faker.uuid4(),
-                    location=self.faker.city()
-                )
-                db.add(inventory)
-
-                products.append(product)
-
+                product_rows.append(product_data)
+                inventory_rows.append({
+                    "quantity_available": stock_quantity,
+                    "quantity_reserve": random.randint(0, min(50, stock_quantity // 4)),
+                    "reorder_level": random.randint(5, 25),
+                    "reorder_quantity": random.randint(20, 100),
+                    "unit_cost": round(product_data["price"] * random.uniform(0.4, 0.7), 2),
+                    "last_restocked": datetime.now() - timedelta(days=random.randint(1, 30)),
+                    "expiry_date": expiry_date,
+                    "batch_number": self.faker.uuid4(),
+                    "location": self.faker.city()
+                })
+
+            product_ids = []
+            for start in range(0, len(product_rows), Products.crud.BULK_BATCH_SIZE):
+                end = start + Products.crud.BULK_BATCH_SIZE
+                product_ids.extend(Products.crud.insert_products_with_inventory(
+                    db, product_rows[start:end], inventory_rows[start:end]
+                ))
             db.commit()
+
+            products = db.query(Product).filter(Product.id.in_(product_ids)).order_by(Product.id).all() if product_ids else []
             log.info(f"Successfully created {len(products)} products with complete inventory records.")
         except Exception as e:
             db.rollback()
@@ -158,7 +160,7 @@ class DataGenerator:
             for product in selected:
                 old_price = product.price
                 change_percent = random.uniform(-0.2, 0.2)
-                new_price = round(old_price * (1 + change_percent), 2)
+                new_price = round(float(old_price) * (1 + change_percent), 2)
                 new_price = max(new_price, 1.0)
 
                 price_history = PriceHistory(
@@ -180,7 +182,7 @@ class DataGenerator:
     def randomly_update_stocks(self, db: Session, products: List[Product], batch_size: int = 50) -> None:
         log.info("Starting batch stock update with inventory management...")
         try:
-            from models import Inventory
+            from Products.models import Inventory
             from datetime import datetime
             
             selected = random.sample(products, min(batch_size, len(products)))
@@ -193,6 +195,9 @@ class DataGenerator:
                 if not inventory:
                     log.warning(f"No inventory record found for product {product.id}")
                     continue
+                if inventory.shard_count:
+                    # Sharded stock only changes through the reservation path
+                    continue
                 
                 scenario = random.choices(
                     ["normal_sales", "heavy_sales", "slow_sales", "restock"],
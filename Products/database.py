@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
 from dotenv import load_dotenv
@@ -29,3 +29,26 @@ def get_db():
     finally:
         db.close()
         log.debug("Database session closed")
+
+def add_missing_columns(bind, metadata=None):
+    """create_all never alters existing tables; add model columns the database does not have yet.
+
+    Only additive: columns must be nullable or carry a server_default so existing rows stay valid.
+    """
+    metadata = metadata or Base.metadata
+    inspector = inspect(bind)
+    quote = bind.dialect.identifier_preparer.quote
+    existing_tables = set(inspector.get_table_names())
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = column.type.compile(dialect=bind.dialect)
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                null = "" if column.nullable else " NOT NULL"
+                conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {ddl}{default}{null}"))
+                log.info(f"Added column {table.name}.{column.name}")
@@ -0,0 +1,15 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class InsufficientStockError(ValueError):
+    pass
+
+
+class InventoryConflictError(Exception):
+    """A guarded inventory UPDATE matched no row: the row changed since it was read"""
+
+
+class ReservationConflictError(Exception):
+    """Reservation rows were consumed by someone else between reading and writing them"""
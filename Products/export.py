@@ -0,0 +1,137 @@
+import argparse
+import csv
+import io
+import json
+import time
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import Products.models
+from Products.logger import log
+from Products.category_tree import category_tree
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+EXPORT_CHUNK_SIZE = int(os.getenv("PRODUCT_EXPORT_CHUNK_SIZE", "1000"))
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+EXPORT_COLUMNS = [
+    "id", "name", "price", "brand", "attributes", "category_id", "category_name",
+    "quantity_available", "quantity_reserve", "reorder_level", "unit_cost", "location",
+    "created_at", "updated_at"
+]
+
+
+def _export_select(filters: Optional[Dict[str, Any]] = None, db: Optional[Session] = None):
+    """One flat row per product with its category name and inventory levels, in id order"""
+    Product = Products.models.Product
+    Category = Products.models.Category
+    Inventory = Products.models.Inventory
+    stmt = select(
+        Product.id, Product.name, Product.price, Product.brand, Product.attributes, Product.category_id,
+        Category.name.label("category_name"),
+        Inventory.quantity_available, Inventory.quantity_reserve, Inventory.reorder_level,
+        Inventory.unit_cost, Inventory.location,
+        Product.created_at, Product.updated_at
+    ).select_from(Product)\
+        .outerjoin(Category, Category.id == Product.category_id)\
+        .outerjoin(Inventory, Inventory.product_id == Product.id)\
+        .order_by(Product.id)
+
+    filters = filters or {}
+    if filters.get('category_id'):
+        stmt = stmt.where(Product.category_id.in_(category_tree.descendants(db, filters['category_id'])))
+    if filters.get('in_stock_only'):
+        stmt = stmt.where(Inventory.quantity_available > 0)
+    return stmt
+
+
+def iter_catalog_rows(db: Session, filters: Optional[Dict[str, Any]] = None, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """Yield catalog rows from a server-side cursor, holding at most chunk_size rows at a time"""
+    result = db.execute(
+        _export_select(filters, db).execution_options(stream_results=True, yield_per=chunk_size)
+    )
+    try:
+        for partition in result.partitions():
+            for row in partition:
+                yield row._asdict()
+    finally:
+        result.close()
+
+
+def _json_default(value: Any):
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def to_ndjson(rows: Iterable[Dict[str, Any]], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    buffer = []
+    for row in rows:
+        buffer.append(json.dumps(row, default=_json_default, separators=(",", ":")))
+        if len(buffer) >= chunk_size:
+            yield ("\n".join(buffer) + "\n").encode()
+            buffer = []
+    if buffer:
+        yield ("\n".join(buffer) + "\n").encode()
+
+
+def to_csv(rows: Iterable[Dict[str, Any]], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    pending = 0
+    for row in rows:
+        if row["attributes"] is not None:
+            row["attributes"] = json.dumps(row["attributes"], separators=(",", ":"))
+        writer.writerow(row)
+        pending += 1
+        if pending >= chunk_size:
+            yield out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+            pending = 0
+    if out.tell():
+        yield out.getvalue().encode()
+
+
+def stream_catalog(session_factory, fmt: str = "ndjson", filters: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """Encoded export chunks. Opens its own session so it can outlive the request handler."""
+    encode = to_csv if fmt == "csv" else to_ndjson
+    db = session_factory()
+    started = time.perf_counter()
+    count = 0
+    try:
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+        yield from encode(counted(iter_catalog_rows(db, filters)))
+        log.info(f"Exported {count} product(s) as {fmt} in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    from Products.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Stream the product catalog to a file")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--output", default="-", help="Output path, '-' for stdout")
+    parser.add_argument("--category-id", type=int, help="Only this category and its subcategories")
+    parser.add_argument("--in-stock-only", action="store_true")
+    args = parser.parse_args()
+
+    filters = {"category_id": args.category_id, "in_stock_only": args.in_stock_only}
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in stream_catalog(SessionLocal, args.format, filters):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
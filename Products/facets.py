@@ -0,0 +1,161 @@
+import argparse
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.orm import Session
+import Products.models
+from Products.cache import ChangeSet, before_commit
+from Products.logger import log
+from Products.search import product_search
+from Products.category_tree import category_tree
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+PRICE_BUCKET_EDGES = (0, 25, 50, 100, 250, 500, 1000, 2000)
+MAX_BRAND_FACETS = int(os.getenv("FACET_MAX_BRANDS", "50"))
+REFRESH_BATCH_SIZE = 1000
+
+_FACET_COLUMNS = ["product_id", "category_id", "brand", "price", "price_bucket", "in_stock"]
+
+
+def _facet_rows_select():
+    """SELECT producing product_facets rows straight from products + inventory"""
+    Product = Products.models.Product
+    Inventory = Products.models.Inventory
+    bucket = case(
+        *[(Product.price < edge, index) for index, edge in enumerate(PRICE_BUCKET_EDGES[1:])],
+        else_=len(PRICE_BUCKET_EDGES) - 1
+    )
+    in_stock = case((func.coalesce(Inventory.quantity_available, 0) > 0, True), else_=False)
+    return select(Product.id, Product.category_id, Product.brand, Product.price, bucket, in_stock)\
+        .outerjoin(Inventory, Inventory.product_id == Product.id)
+
+
+def _stale(conn, product_ids: List[int]) -> List[int]:
+    """Products whose facet row differs from (or is missing for) their current values"""
+    Facet = Products.models.ProductFacet
+    current = {row[0]: tuple(row[1:]) for row in conn.execute(
+        _facet_rows_select().where(Products.models.Product.id.in_(product_ids))
+    )}
+    stored = {row[0]: tuple(row[1:]) for row in conn.execute(
+        select(Facet.product_id, Facet.category_id, Facet.brand, Facet.price, Facet.price_bucket, Facet.in_stock)
+        .where(Facet.product_id.in_(product_ids))
+    )}
+    return [product_id for product_id in product_ids if current.get(product_id) != stored.get(product_id)]
+
+
+def refresh_facets(conn, product_ids: Iterable[int], only_stale: bool = False) -> int:
+    """Recompute the facet rows of the given products (deleted products simply lose their row).
+    With only_stale, rows still matching the product are left alone. Returns the products rewritten."""
+    Facet = Products.models.ProductFacet
+    ids = sorted(set(product_ids))
+    refreshed = 0
+    for start in range(0, len(ids), REFRESH_BATCH_SIZE):
+        chunk = ids[start:start + REFRESH_BATCH_SIZE]
+        if only_stale:
+            chunk = _stale(conn, chunk)
+            if not chunk:
+                continue
+        refreshed += len(chunk)
+        conn.execute(delete(Facet).where(Facet.product_id.in_(chunk)))
+        conn.execute(insert(Facet).from_select(
+            _FACET_COLUMNS, _facet_rows_select().where(Products.models.Product.id.in_(chunk))
+        ))
+    return refreshed
+
+
+def sync_missing(db: Session) -> int:
+    """Create facet rows for products that have none (first deploy or rows written out of band)"""
+    Facet = Products.models.ProductFacet
+    Product = Products.models.Product
+    missing = ~select(Facet.product_id).where(Facet.product_id == Product.id).exists()
+    result = db.execute(insert(Facet).from_select(_FACET_COLUMNS, _facet_rows_select().where(missing)))
+    db.commit()
+    if result.rowcount:
+        log.info(f"Added {result.rowcount} product(s) to the facet index")
+    return result.rowcount or 0
+
+
+def rebuild(db: Session) -> int:
+    db.execute(delete(Products.models.ProductFacet))
+    db.commit()
+    return sync_missing(db)
+
+
+def compute_facets(db: Session, search: Optional[str] = None, filters: Optional[Dict[str, Any]] = None) -> dict:
+    """All facet counts for a filtered listing from one GROUP BY over product_facets"""
+    Facet = Products.models.ProductFacet
+    query = db.query(Facet.category_id, Facet.brand, Facet.price_bucket, Facet.in_stock, func.count().label("n"))
+
+    if search:
+        query, _ = product_search.apply(db, query, search, id_column=Facet.product_id)
+    if filters:
+        if filters.get('min_price'):
+            query = query.filter(Facet.price >= filters['min_price'])
+        if filters.get('max_price'):
+            query = query.filter(Facet.price <= filters['max_price'])
+        if filters.get('category_id'):
+            query = query.filter(Facet.category_id.in_(category_tree.descendants(db, filters['category_id'])))
+        if filters.get('in_stock_only'):
+            query = query.filter(Facet.in_stock.is_(True))
+
+    categories, brands, buckets, stock = Counter(), Counter(), Counter(), Counter()
+    total = 0
+    for category_id, brand, bucket, in_stock, n in query.group_by(
+        Facet.category_id, Facet.brand, Facet.price_bucket, Facet.in_stock
+    ):
+        total += n
+        categories[category_id] += n
+        brands[brand] += n
+        buckets[bucket] += n
+        stock[bool(in_stock)] += n
+
+    names = dict(
+        db.query(Products.models.Category.id, Products.models.Category.name)
+        .filter(Products.models.Category.id.in_(list(categories)))
+    ) if categories else {}
+
+    return {
+        "total": total,
+        "categories": [
+            {"id": category_id, "value": names.get(category_id, "Unknown"), "count": n}
+            for category_id, n in categories.most_common()
+        ],
+        "brands": [
+            {"value": brand, "count": n}
+            for brand, n in brands.most_common(MAX_BRAND_FACETS) if brand is not None
+        ],
+        "price_ranges": [
+            {
+                "min": PRICE_BUCKET_EDGES[bucket],
+                "max": PRICE_BUCKET_EDGES[bucket + 1] if bucket + 1 < len(PRICE_BUCKET_EDGES) else None,
+                "count": buckets[bucket]
+            }
+            for bucket in sorted(buckets)
+        ],
+        "stock": {"in_stock": stock[True], "out_of_stock": stock[False]}
+    }
+
+
+@before_commit
+def _refresh_changed_products(db: Session, changes: ChangeSet) -> None:
+    # Same transaction as the change; most stock moves leave in_stock (and the row) as is
+    product_ids = changes.product_ids | changes.inventory_product_ids
+    if product_ids:
+        refresh_facets(db, product_ids, only_stale=True)
+
+
+if __name__ == "__main__":
+    from Products.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Maintain the product facet index")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every facet row")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        count = rebuild(session) if args.rebuild else sync_missing(session)
+        log.info(f"Facet index up to date ({count} row(s) written)")
+    finally:
+        session.close()
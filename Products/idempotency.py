@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import json
+import threading
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import Products.models
+from Products.cache import TTLCache
+from Products.database import SessionLocal
+from Products.exceptions import InventoryConflictError
+from Products.reservation_engine import reservation_engine
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+# How long a retry waits for the first request with the same key to finish
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+
+REPLAY_HEADER = "Idempotent-Replayed"
+
+
+def fingerprint(*parts: Any) -> bytes:
+    """16-byte digest of a request, to tell a retry from a different request reusing the key"""
+    return hashlib.sha256(json.dumps(jsonable_encoder(parts), sort_keys=True, separators=(",", ":")).encode()).digest()[:16]
+
+
+class IdempotencyStore(TTLCache):
+    """Recent Idempotency-Keys and the response each one produced.
+
+    Entries are (request fingerprint, status code, JSON body bytes) and expire after
+    IDEMPOTENCY_TTL seconds; the least recently used go first beyond IDEMPOTENCY_MAX_KEYS.
+    A key whose first request is still running is tracked separately so a concurrent
+    retry waits for that result instead of applying the change a second time.
+    """
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_MAX_KEYS, ttl: float = IDEMPOTENCY_TTL):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._in_flight: Dict[Hashable, Tuple[bytes, threading.Event]] = {}
+        self._flight_lock = threading.Lock()
+        self.replays = 0
+
+    def begin(self, key: Hashable, digest: bytes, wait: float = IDEMPOTENCY_WAIT) -> Optional[Tuple[int, bytes]]:
+        """The stored (status, body) for a replay, or None when the caller now owns the key"""
+        while True:
+            cached = self.get(key)
+            if cached is not None:
+                self._check(cached[0], digest)
+                self.replays += 1
+                return cached[1], cached[2]
+            with self._flight_lock:
+                running = self._in_flight.get(key)
+                if running is None:
+                    # Re-check under the lock: the owner may have finished since get()
+                    cached = self.get(key)
+                    if cached is None:
+                        self._in_flight[key] = (digest, threading.Event())
+                        return None
+                    continue
+            self._check(running[0], digest)
+            if not running[1].wait(wait):
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    def finish(self, key: Hashable, digest: bytes, status_code: Optional[int] = None, body: Optional[bytes] = None) -> None:
+        """Store the outcome (or, without a status, forget the attempt so a retry runs again)"""
+        if status_code is not None:
+            self.set(key, (digest, status_code, body))
+        with self._flight_lock:
+            running = self._in_flight.pop(key, None)
+        if running is not None:
+            running[1].set()
+
+    @staticmethod
+    def _check(stored: bytes, digest: bytes) -> None:
+        if stored != digest:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+    def stats(self) -> dict:
+        return {**super().stats(), "replays": self.replays, "in_flight": len(self._in_flight)}
+
+
+idempotency_store = IdempotencyStore()
+
+
+class _Request:
+    """The keyed request whose stock change is being written (see record())"""
+
+    def __init__(self, scope: str, key: str, digest: bytes, respond: Callable[[Any], Dict[str, Any]]):
+        self.scope = scope
+        self.key = key
+        self.digest = digest
+        self.respond = respond
+
+
+_current: ContextVar[Optional[_Request]] = ContextVar("idempotent_request", default=None)
+
+
+def row(result: Any) -> Optional[Dict[str, Any]]:
+    """The idempotency_keys row for the keyed request being run, given its result (None outside one)"""
+    request = _current.get()
+    if request is None:
+        return None
+    return {
+        "scope": request.scope,
+        "key": request.key,
+        "fingerprint": request.digest.hex(),
+        "response": json.dumps(jsonable_encoder(request.respond(result))),
+        "created_at": Products.models.utc_now().replace(tzinfo=None)
+    }
+
+
+def record(db: Session, result: Any) -> None:
+    """Store the response of the keyed request being run in the transaction of its stock change (no commit)"""
+    values = row(result)
+    if values is None:
+        return
+    try:
+        db.execute(insert(Products.models.IdempotencyKey), [values])
+    except IntegrityError:
+        # Another worker applied this key first; a retry will replay its response
+        raise InventoryConflictError("A request with this Idempotency-Key is being applied elsewhere")
+
+
+def _stored(scope: str, key: str, digest: bytes) -> Optional[bytes]:
+    """The response recorded for this key by an earlier process (or evicted from the store), if any"""
+    stored = None
+    if reservation_engine.enabled:
+        # Only look in the table for keys the engine may have written behind already
+        recorded, row = reservation_engine.recorded_key(scope, key)
+        if row is not None:
+            stored = (row["fingerprint"], row["response"])
+        elif not recorded:
+            return None
+    if stored is None:
+        IdempotencyKey = Products.models.IdempotencyKey
+        db = SessionLocal()
+        try:
+            stored = db.execute(
+                select(IdempotencyKey.fingerprint, IdempotencyKey.response)
+                .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            ).first()
+        finally:
+            db.close()
+    if stored is None:
+        return None
+    if stored[0] != digest.hex():
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    return stored[1].encode()
+
+
+def purge_expired(db: Session, ttl: float = IDEMPOTENCY_TTL) -> int:
+    """Delete recorded keys older than ttl seconds"""
+    cutoff = Products.models.utc_now().replace(tzinfo=None) - timedelta(seconds=ttl)
+    IdempotencyKey = Products.models.IdempotencyKey
+    purged = db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)).rowcount
+    db.commit()
+    return purged
+
+
+def _replay(status_code: int, body: bytes) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json", headers={REPLAY_HEADER: "true"})
+
+
+def idempotent(
+    scope: str,
+    key: Optional[str],
+    digest: bytes,
+    run: Callable[[], Any],
+    respond: Callable[[Any], Dict[str, Any]] = lambda result: result
+):
+    """Run an endpoint body once per (scope, Idempotency-Key) and replay its response to retries.
+
+    run() applies the change and respond(result) turns its result into the response.
+    Success and client errors are stored; 409 (retry later) and unexpected errors are not,
+    so those can be retried with the same key. A successful stock change also records its
+    response in idempotency_keys in the same transaction (see record()), so it is never
+    applied twice even when this process dies before storing it here.
+    """
+    if not key:
+        return respond(run())
+    store_key = (scope, key)
+    cached = idempotency_store.begin(store_key, digest)
+    if cached is not None:
+        return _replay(*cached)
+    token = _current.set(_Request(scope, key, digest, respond))
+    try:
+        stored = _stored(scope, key, digest)
+        if stored is not None:
+            idempotency_store.finish(store_key, digest, 200, stored)
+            return _replay(200, stored)
+        result = respond(run())
+    except HTTPException as e:
+        if e.status_code == 409 or e.status_code >= 500:
+            idempotency_store.finish(store_key, digest)
+        else:
+            idempotency_store.finish(store_key, digest, e.status_code, json.dumps({"detail": e.detail}).encode())
+        raise
+    except BaseException:
+        idempotency_store.finish(store_key, digest)
+        raise
+    finally:
+        _current.reset(token)
+    idempotency_store.finish(store_key, digest, 200, json.dumps(jsonable_encoder(result)).encode())
+    return result
+
+
+async def idempotent_async(
+    scope: str,
+    key: Optional[str],
+    digest: bytes,
+    run: Callable[[], Awaitable[Any]],
+    respond: Callable[[Any], Dict[str, Any]] = lambda result: result
+):
+    """idempotent() for coroutine endpoints; waiting on a concurrent first request happens off the event loop"""
+    if not key:
+        return respond(await run())
+    store_key = (scope, key)
+    cached = await asyncio.to_thread(idempotency_store.begin, store_key, digest)
+    if cached is not None:
+        return _replay(*cached)
+    token = _current.set(_Request(scope, key, digest, respond))
+    try:
+        stored = await asyncio.to_thread(_stored, scope, key, digest)
+        if stored is not None:
+            idempotency_store.finish(store_key, digest, 200, stored)
+            return _replay(200, stored)
+        result = respond(await run())
+    except HTTPException as e:
+        if e.status_code == 409 or e.status_code >= 500:
+            idempotency_store.finish(store_key, digest)
+        else:
+            idempotency_store.finish(store_key, digest, e.status_code, json.dumps({"detail": e.detail}).encode())
+        raise
+    except BaseException:
+        idempotency_store.finish(store_key, digest)
+        raise
+    finally:
+        _current.reset(token)
+    idempotency_store.finish(store_key, digest, 200, json.dumps(jsonable_encoder(result)).encode())
+    return result
@@ -0,0 +1,244 @@
+import argparse
+import random
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.orm import Session
+import Products.models, Products.cache
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+DEFAULT_SHARD_COUNT = int(os.getenv("INVENTORY_SHARD_COUNT", "8"))
+REBALANCE_INTERVAL = int(os.getenv("INVENTORY_REBALANCE_INTERVAL", "60"))
+
+# (shard id, available, reserved)
+Shard = Tuple[int, int, int]
+
+_shards = Products.models.InventoryShard.__table__
+_guarded_shard_update = _shards.update()\
+    .where(
+        _shards.c.id == bindparam("s_id"),
+        _shards.c.quantity_available >= bindparam("s_need_available"),
+        _shards.c.quantity_reserve >= bindparam("s_need_reserved")
+    )\
+    .values(
+        quantity_available=_shards.c.quantity_available + bindparam("s_available"),
+        quantity_reserve=_shards.c.quantity_reserve + bindparam("s_reserved")
+    )
+
+
+def _split(total: int, parts: int) -> List[int]:
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def read_shards(db: Session, product_ids: Iterable[int]) -> Dict[int, List[Shard]]:
+    """All shards of the given products, in shard order, from one query"""
+    rows = db.execute(
+        select(_shards.c.product_id, _shards.c.id, _shards.c.quantity_available, _shards.c.quantity_reserve)
+        .where(_shards.c.product_id.in_(sorted(set(product_ids))))
+        .order_by(_shards.c.product_id, _shards.c.shard_no)
+    )
+    result: Dict[int, List[Shard]] = {}
+    for product_id, shard_id, available, reserved in rows:
+        result.setdefault(product_id, []).append((shard_id, available or 0, reserved or 0))
+    return result
+
+
+def totals(shards: List[Shard]) -> Tuple[int, int]:
+    return sum(s[1] for s in shards), sum(s[2] for s in shards)
+
+
+def plan_moves(shards: List[Shard], d_available: int, d_reserved: int) -> Optional[List[dict]]:
+    """Spread an (available, reserved) delta over a product's shards.
+
+    Decrements are drawn from shards in order starting at a random one, spilling over to
+    the next when a shard runs dry, so concurrent reservations mostly touch different
+    rows. When stock moves between available and reserved, the credit lands on the same
+    shards the debit came from. Returns None when the shards cannot absorb the delta.
+    """
+    available, reserved = totals(shards)
+    if available + d_available < 0 or reserved + d_reserved < 0:
+        return None
+
+    start = random.randrange(len(shards))
+    order = shards[start:] + shards[:start]
+    moves: Dict[int, List[int]] = {}
+
+    def drain(column: int, amount: int, credit_other: bool) -> None:
+        for shard in order:
+            if amount <= 0:
+                break
+            take = min(amount, shard[column])
+            if take <= 0:
+                continue
+            move = moves.setdefault(shard[0], [0, 0])
+            move[column - 1] -= take
+            if credit_other:
+                move[2 - column] += take
+            amount -= take
+
+    if d_available < 0:
+        drain(1, -d_available, credit_other=d_reserved == -d_available)
+    if d_reserved < 0:
+        drain(2, -d_reserved, credit_other=d_available == -d_reserved)
+
+    # Credits that did not ride along with a debit go to one random shard
+    credited_available = sum(m[0] for m in moves.values() if m[0] > 0)
+    credited_reserved = sum(m[1] for m in moves.values() if m[1] > 0)
+    extra_available = max(0, d_available) - credited_available
+    extra_reserved = max(0, d_reserved) - credited_reserved
+    if extra_available or extra_reserved:
+        move = moves.setdefault(order[0][0], [0, 0])
+        move[0] += extra_available
+        move[1] += extra_reserved
+
+    return [
+        {
+            "s_id": shard_id,
+            "s_available": d_avail,
+            "s_reserved": d_res,
+            "s_need_available": max(0, -d_avail),
+            "s_need_reserved": max(0, -d_res)
+        } for shard_id, (d_avail, d_res) in moves.items()
+    ]
+
+
+def apply_moves(db: Session, params: List[dict]) -> bool:
+    """Run the guarded shard updates; False when a shard was drained by someone else first"""
+    if not params:
+        return True
+    if db.get_bind().dialect.supports_sane_multi_rowcount:
+        matched = db.execute(_guarded_shard_update, params).rowcount
+    else:
+        matched = sum(db.execute(_guarded_shard_update, row).rowcount for row in params)
+    return matched == len(params)
+
+
+def enable_sharding(db: Session, product_id: int, shard_count: int = DEFAULT_SHARD_COUNT) -> Products.models.Inventory:
+    """Split a product's stock across shard_count counters (no commit)"""
+    Inventory = Products.models.Inventory
+    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).with_for_update().first()
+    if not inventory:
+        raise Exception("Inventory record not found for product_id")
+    if inventory.shard_count:
+        rebalance_product(db, product_id, shard_count)
+        return inventory
+
+    db.execute(insert(Products.models.InventoryShard), [
+        {"product_id": product_id, "shard_no": shard_no, "quantity_available": available, "quantity_reserve": reserved}
+        for shard_no, (available, reserved) in enumerate(zip(
+            _split(inventory.quantity_available or 0, shard_count), _split(inventory.quantity_reserve or 0, shard_count)
+        ))
+    ])
+    inventory.shard_count = shard_count
+    # Optimistic writers that read shard_count=0 must not update the row any more
+    inventory.version = (inventory.version or 0) + 1
+    log.info(f"Sharded inventory of product {product_id} into {shard_count} counters")
+    return inventory
+
+
+def disable_sharding(db: Session, product_id: int) -> Products.models.Inventory:
+    """Fold the shards back into the single inventory row (no commit)"""
+    Inventory = Products.models.Inventory
+    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).with_for_update().first()
+    if not inventory or not inventory.shard_count:
+        return inventory
+    shards = db.execute(
+        select(_shards.c.quantity_available, _shards.c.quantity_reserve)
+        .where(_shards.c.product_id == product_id).with_for_update()
+    ).all()
+    inventory.quantity_available = sum(s[0] for s in shards)
+    inventory.quantity_reserve = sum(s[1] for s in shards)
+    inventory.version = (inventory.version or 0) + 1
+    inventory.shard_count = 0
+    db.execute(delete(Products.models.InventoryShard).where(Products.models.InventoryShard.product_id == product_id))
+    log.info(f"Merged inventory shards of product {product_id}")
+    return inventory
+
+
+def rebalance_product(
+    db: Session,
+    product_id: int,
+    shard_count: Optional[int] = None,
+    available: Optional[int] = None,
+    reserved: Optional[int] = None
+) -> Tuple[int, int]:
+    """Even out a product's shards and refresh the rollup on its inventory row (no commit).
+
+    available / reserved, when given, replace the current totals: the way to overwrite the
+    stock of a sharded product, whose inventory row columns are only a rollup.
+    """
+    Shards = Products.models.InventoryShard
+    shards = db.query(Shards).filter(Shards.product_id == product_id)\
+        .order_by(Shards.shard_no).with_for_update().populate_existing().all()
+    if not shards:
+        return 0, 0
+    if available is None:
+        available = sum(s.quantity_available or 0 for s in shards)
+    if reserved is None:
+        reserved = sum(s.quantity_reserve or 0 for s in shards)
+    shard_count = shard_count or len(shards)
+
+    for shard in shards[shard_count:]:
+        db.delete(shard)
+    for shard_no in range(len(shards), shard_count):
+        shards.append(Shards(product_id=product_id, shard_no=shard_no))
+        db.add(shards[-1])
+    for shard, a, r in zip(shards[:shard_count], _split(available, shard_count), _split(reserved, shard_count)):
+        shard.quantity_available, shard.quantity_reserve = a, r
+
+    db.execute(
+        update(Products.models.Inventory)
+        .where(Products.models.Inventory.product_id == product_id)
+        .values(
+            quantity_available=available,
+            quantity_reserve=reserved,
+            shard_count=shard_count,
+            version=Products.models.Inventory.version + 1
+        )
+    )
+    return available, reserved
+
+
+def rebalance_all(db: Session) -> int:
+    """Rebalance every sharded product, one short transaction each"""
+    product_ids = db.execute(
+        select(Products.models.Inventory.product_id).where(Products.models.Inventory.shard_count > 0)
+    ).scalars().all()
+    for product_id in product_ids:
+        try:
+            rebalance_product(db, product_id)
+            Products.cache.mark_changed(db, inventory_product_ids=[product_id])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            log.error(f"Rebalancing inventory shards of product {product_id} failed: {e}")
+    if product_ids:
+        log.info(f"Rebalanced inventory shards of {len(product_ids)} product(s)")
+    return len(product_ids)
+
+
+if __name__ == "__main__":
+    from Products.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Manage sharded stock counters")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--enable", type=int, metavar="PRODUCT_ID")
+    group.add_argument("--disable", type=int, metavar="PRODUCT_ID")
+    group.add_argument("--rebalance", action="store_true", help="Rebalance every sharded product")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARD_COUNT)
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        if args.rebalance:
+            rebalance_all(session)
+        else:
+            if args.enable:
+                enable_sharding(session, args.enable, args.shards)
+            else:
+                disable_sharding(session, args.disable)
+            session.commit()
+    finally:
+        session.close()
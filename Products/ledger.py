@@ -0,0 +1,279 @@
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event, insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+import Products.models
+from Products.metrics import FlushMetrics
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# inline: movements are inserted by the request's own transaction (no writer thread)
+# sync:   the writer inserts them right after the request commits; commit() waits for it.
+#         Still a transaction of its own: a crash between the two loses the movements
+# async:  commit() returns at once; movements land within LEDGER_FLUSH_MS, or are lost
+#         with the process if it dies first
+# Only inline keeps the ledger exactly in step with stock.
+LEDGER_MODES = ("inline", "sync", "async")
+LEDGER_MODE = os.getenv("LEDGER_MODE", "inline")
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "500"))
+LEDGER_FLUSH_MS = float(os.getenv("LEDGER_FLUSH_MS", "20"))
+LEDGER_QUEUE_LIMIT = int(os.getenv("LEDGER_QUEUE_LIMIT", "100000"))
+LEDGER_SYNC_TIMEOUT = float(os.getenv("LEDGER_SYNC_TIMEOUT", "5"))
+# Transient failures are retried until the database is back, except while stopping:
+# then a flush gives up after this many retries so shutdown does not hang
+LEDGER_SHUTDOWN_RETRIES = int(os.getenv("LEDGER_SHUTDOWN_RETRIES", "8"))
+
+_INFO_KEY = "ledger_movements"
+_COLUMNS = ("product_id", "order_id", "cart_id", "change", "reason", "timestamp")
+_insert_movements = Products.models.StockMovement.__table__.insert()
+_insert_failures = Products.models.StockMovementFailure.__table__.insert()
+
+
+class LedgerWriter:
+    """Buffers stock_movements rows from concurrent requests and inserts them in groups.
+
+    A flush starts once LEDGER_BATCH_SIZE rows are queued or the oldest queued row is
+    LEDGER_FLUSH_MS old. Everything queued by then goes out as multi-row INSERTs in one
+    transaction, so N concurrent checkouts cost one commit instead of N. A flush failing
+    for a transient reason (database unreachable) is retried with backoff for as long as
+    it takes; meanwhile the queue fills up to LEDGER_QUEUE_LIMIT and then holds producers
+    back. One the database rejects (IntegrityError/DataError) is split in halves until
+    the bad rows are isolated, and only those go to stock_movement_failures, so one bad
+    row never stalls the queue and the commits behind it.
+    """
+
+    def __init__(self, mode: str = LEDGER_MODE, batch_size: int = LEDGER_BATCH_SIZE, flush_ms: float = LEDGER_FLUSH_MS):
+        if mode not in LEDGER_MODES:
+            raise ValueError(f"LEDGER_MODE must be one of {', '.join(LEDGER_MODES)}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.metrics = FlushMetrics()
+        self._cond = threading.Condition()
+        self._queue: List[Dict[str, Any]] = []
+        self._oldest = 0.0
+        self._submitted = 0  # rows ever queued
+        self._flushed = 0    # rows ever committed or set aside
+        self._dead_lettered = 0
+        self._bind = None
+        self._connection = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    # ---------------------------------------------------------
+    # Lifecycle
+    # ---------------------------------------------------------
+
+    def start(self, session_factory=None) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            if session_factory is None:
+                from Products.database import SessionLocal
+                session_factory = SessionLocal
+            self._stopping = False
+            # A connection of its own: in sync mode every request waits on this thread while
+            # still holding a pooled connection, so it must never queue for the pool
+            db = session_factory()
+            try:
+                self._bind = db.get_bind()
+                self._connection = self._bind.connect()
+            finally:
+                db.close()
+            self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Flush what is queued and stop the writer thread"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        thread.join()
+        self._thread = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # ---------------------------------------------------------
+    # Producers
+    # ---------------------------------------------------------
+
+    def submit(self, rows: List[Dict[str, Any]]) -> int:
+        """Queue committed movements; returns the ticket to pass to wait()"""
+        self.start()
+        with self._cond:
+            while len(self._queue) >= LEDGER_QUEUE_LIMIT and not self._stopping:
+                self._cond.wait()  # back-pressure when the database falls behind
+            if not self._queue:
+                # Wake the writer to start the flush_ms clock
+                self._oldest = time.monotonic()
+                self._cond.notify_all()
+            self._queue.extend(rows)
+            self._submitted += len(rows)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+            return self._submitted
+
+    def wait(self, ticket: int, timeout: float = LEDGER_SYNC_TIMEOUT) -> bool:
+        """Block until every row queued up to `ticket` is committed"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._flushed < ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def flush(self) -> bool:
+        """Wait for everything queued so far"""
+        with self._cond:
+            ticket = self._submitted
+            self._cond.notify_all()
+        return self.wait(ticket)
+
+    # ---------------------------------------------------------
+    # Writer thread
+    # ---------------------------------------------------------
+
+    def _take(self) -> Optional[List[Dict[str, Any]]]:
+        with self._cond:
+            while True:
+                if self._queue:
+                    age_ms = (time.monotonic() - self._oldest) * 1000
+                    if self._stopping or len(self._queue) >= self.batch_size or age_ms >= self.flush_ms:
+                        rows, self._queue = self._queue, []
+                        self._cond.notify_all()
+                        return rows
+                    self._cond.wait((self.flush_ms - age_ms) / 1000)
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self) -> None:
+        while True:
+            rows = self._take()
+            if rows is None:
+                return
+            self._deliver(rows)
+            with self._cond:
+                self._flushed += len(rows)
+                self._cond.notify_all()
+
+    def _deliver(self, rows: List[Dict[str, Any]]) -> None:
+        failures = 0
+        while True:
+            try:
+                self._write(rows)
+                return
+            except (IntegrityError, DataError) as e:
+                # Permanent: the same rows can never go in, but the rest of the batch can
+                if len(rows) == 1:
+                    self._dead_letter(rows, e)
+                    return
+                middle = len(rows) // 2
+                self._deliver(rows[:middle])
+                self._deliver(rows[middle:])
+                return
+            except Exception as e:
+                failures += 1
+                if not self._back_off(failures, rows, e):
+                    return
+
+    def _back_off(self, failures: int, rows: List[Dict[str, Any]], error: Exception) -> bool:
+        """Sleep before retrying a transient failure; False once stopping and out of retries"""
+        if self._stopping and failures > LEDGER_SHUTDOWN_RETRIES:
+            log.error(f"Ledger stopped before it could write {len(rows)} movement(s) ({error}); lost rows: {rows}")
+            return False
+        log.error(f"Ledger flush of {len(rows)} movement(s) failed, will retry: {error}")
+        time.sleep(min(5.0, random.uniform(0, 0.05 * 2 ** min(failures, 10))))
+        return True
+
+    def _execute(self, stmt, params: List[Dict[str, Any]]) -> None:
+        try:
+            if self._connection is None:
+                self._connection = self._bind.connect()
+            for start in range(0, len(params), self.batch_size):
+                self._connection.execute(stmt, params[start:start + self.batch_size])
+            self._connection.commit()
+        except Exception:
+            self.metrics.failed()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            raise
+
+    def _write(self, rows: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        self._execute(_insert_movements, [{column: row.get(column) for column in _COLUMNS} for row in rows])
+        self.metrics.record(len(rows), (time.perf_counter() - started) * 1000)
+
+    def _dead_letter(self, rows: List[Dict[str, Any]], error: Exception) -> None:
+        """Set aside rows the database rejected, retrying the insert like any flush"""
+        self._dead_lettered += len(rows)
+        log.error(f"Setting aside {len(rows)} stock movement(s) the database rejected: {error}")
+        failures = 0
+        while True:
+            try:
+                self._execute(_insert_failures, [
+                    {**{column: row.get(column) for column in _COLUMNS}, "error": str(error)[:2000]} for row in rows
+                ])
+                return
+            except (IntegrityError, DataError) as e:
+                log.error(f"Could not record failed stock movements ({e}); lost rows: {rows}")
+                return
+            except Exception as e:
+                failures += 1
+                if not self._back_off(failures, rows, e):
+                    return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queued = len(self._queue)
+        return {"mode": self.mode, "queued": queued, "dead_lettered": self._dead_lettered, **self.metrics.stats()}
+
+
+ledger_writer = LedgerWriter()
+
+
+def record(db: Session, movements: List[Dict[str, Any]]) -> None:
+    """Log stock movements for the current transaction of `db`.
+
+    In inline mode they are inserted right away. Otherwise they are held on the session
+    and queued for the writer only if the transaction commits; in async mode a reader
+    may not see them for up to LEDGER_FLUSH_MS after the stock change.
+    """
+    if not movements:
+        return
+    if ledger_writer.mode == "inline":
+        db.execute(insert(Products.models.StockMovement), movements)
+        return
+    now = Products.models.utc_now().replace(tzinfo=None)
+    db.info.setdefault(_INFO_KEY, []).extend({"timestamp": now, **m} for m in movements)
+
+
+@event.listens_for(Session, "after_commit")
+def _submit_movements(session: Session) -> None:
+    if session.in_nested_transaction():
+        return
+    movements = session.info.pop(_INFO_KEY, None)
+    if not movements:
+        return
+    ticket = ledger_writer.submit(movements)
+    if ledger_writer.mode == "sync" and not ledger_writer.wait(ticket):
+        log.warning(f"Ledger did not confirm {len(movements)} movement(s) within {LEDGER_SYNC_TIMEOUT}s; they stay queued")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_movements(session: Session, previous_transaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop(_INFO_KEY, None)
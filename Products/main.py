@@ -2,10 +2,18 @@ import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from apscheduler.schedulers.background import BackgroundScheduler
-from Products.database import engine, Base, SessionLocal
-from Products.crud import get_all_products
+from Products.database import engine, Base, SessionLocal, add_missing_columns
+from Products.crud import get_random_products
 from Products.routers import product_router
+from Products.async_database import DB_MODE, dispose_async_engine
 from Products.data_generator import DataGenerator
+from Products.search import product_search
+import Products.facets
+from Products import inventory_shards
+from Products.reservation_engine import reservation_engine
+from Products import reservations, idempotency
+from Products.reservations import expiry_sweeper
+from Products.ledger import ledger_writer
 import os
 from dotenv import load_dotenv
 from Products.logger import log
@@ -35,7 +43,7 @@ def scheduled_generate_product():
 def scheduled_price_update():
     db = SessionLocal()
     try:
-        products = get_all_products(db)
+        products = get_random_products(db, 50)
         if products:
             log.info("Updating product prices...")
             generator.randomly_update_prices(db, products)
@@ -47,7 +55,7 @@ def scheduled_price_update():
 def scheduled_stock_update():
     db = SessionLocal()
     try:
-        products = get_all_products(db)
+        products = get_random_products(db, 50)
         if products:
             log.info("Updating product stock quantities...")
             generator.randomly_update_stocks(db, products)
@@ -56,6 +64,24 @@ def scheduled_stock_update():
     finally:
         db.close()
 
+def scheduled_shard_rebalance():
+    db = SessionLocal()
+    try:
+        inventory_shards.rebalance_all(db)
+    except Exception as e:
+        log.error(f"Error in scheduled_shard_rebalance: {e}")
+    finally:
+        db.close()
+
+def scheduled_idempotency_purge():
+    db = SessionLocal()
+    try:
+        idempotency.purge_expired(db)
+    except Exception as e:
+        log.error(f"Error in scheduled_idempotency_purge: {e}")
+    finally:
+        db.close()
+
 print("Tables found:", Base.metadata.tables.keys())
 
 ENABLE_SCHEDULER = os.getenv("ENABLE_SCHEDULER", "false").lower() == "true"
@@ -66,10 +92,20 @@ async def lifespan(app: FastAPI):
     
     try:
         Base.metadata.create_all(bind=engine)
+        add_missing_columns(engine)
         log.info("Database tables created or already exist.")
     except Exception as e:
         log.error(f"Error creating tables: {e}")
 
+    db = SessionLocal()
+    try:
+        product_search.sync_missing(db)
+        Products.facets.sync_missing(db)
+    except Exception as e:
+        log.error(f"Error syncing search and facet indexes: {e}")
+    finally:
+        db.close()
+
     db = SessionLocal()
     try:
         categories = generator.get_categories(db)
@@ -88,11 +124,34 @@ async def lifespan(app: FastAPI):
         scheduler.add_job(scheduled_generate_product, "interval", seconds=30, id="generate_product")
         scheduler.add_job(scheduled_price_update, "interval", seconds=600, id="price_update")
         scheduler.add_job(scheduled_stock_update, "interval", seconds=900, id="stock_update")
-        scheduler.start()
-        log.info("Scheduler jobs started.")
     else:
         log.warning("Scheduler disabled — products will only generate manually")
 
+    # Not demo data: sharded products need their inventory rollup refreshed either way
+    scheduler.add_job(scheduled_shard_rebalance, "interval", seconds=inventory_shards.REBALANCE_INTERVAL, id="shard_rebalance")
+    scheduler.add_job(scheduled_idempotency_purge, "interval", seconds=3600, id="idempotency_purge")
+    scheduler.start()
+    log.info("Scheduler jobs started.")
+
+    if reservation_engine.enabled:
+        # Replays any journal entries a crash left unwritten before serving traffic
+        reservation_engine.start(SessionLocal)
+
+    db = SessionLocal()
+    try:
+        backfilled = reservations.backfill(db)
+        db.commit()
+        if backfilled:
+            log.warning(f"Backfilled cart-less reservations for {backfilled} reserved unit(s)")
+    except Exception as e:
+        db.rollback()
+        log.error(f"Error backfilling reservations: {e}")
+    finally:
+        db.close()
+    expiry_sweeper.start(SessionLocal)
+    if ledger_writer.mode != "inline":
+        ledger_writer.start(SessionLocal)
+
     try:
         yield
     except asyncio.CancelledError:
@@ -100,9 +159,14 @@ async def lifespan(app: FastAPI):
         raise
     finally:
         log.info("Shutting down...")
-        if ENABLE_SCHEDULER and scheduler.running:
+        if scheduler.running:
             scheduler.shutdown(wait=False)
             log.info("Scheduler shutdown complete.")
+        expiry_sweeper.stop()
+        reservation_engine.stop()
+        # Last: the sweeper and the engine may still hand it movements
+        ledger_writer.stop()
+        await dispose_async_engine()
 
 
 app = FastAPI(
@@ -111,6 +175,11 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+if DB_MODE == "async":
+    # Registered first so its routes win; everything else stays on the sync router
+    from Products.routers import async_product_router
+    app.include_router(async_product_router.router)
+    log.info("DB_MODE=async: hot product routes served by the asyncio engine")
 app.include_router(product_router.router)
 
 @app.get("/")
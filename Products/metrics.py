@@ -0,0 +1,82 @@
+import threading
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class ContentionMetrics:
+    """Per-endpoint counters for optimistic inventory writes.
+
+    attempts counts every try of the write transaction, conflicts the tries whose
+    conditional UPDATE lost the race, retries the conflicts that were tried again
+    and exhausted the requests that gave up after the last retry.
+    """
+
+    FIELDS = ("attempts", "commits", "conflicts", "retries", "exhausted")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Counter] = defaultdict(Counter)
+
+    def incr(self, endpoint: str, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[endpoint][name] += amount
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            result = {}
+            for endpoint, counter in sorted(self._counters.items()):
+                row = {name: counter[name] for name in self.FIELDS}
+                row["conflict_ratio"] = round(counter["conflicts"] / counter["attempts"], 4) if counter["attempts"] else 0.0
+                result[endpoint] = row
+            return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+
+inventory_contention = ContentionMetrics()
+
+
+class FlushMetrics:
+    """Batch sizes and latencies of a background writer's flushes (last `window` flushes for percentiles)"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.flushes = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.failures = 0
+
+    def record(self, rows: int, latency_ms: float) -> None:
+        with self._lock:
+            self.flushes += 1
+            self.rows += rows
+            self.max_batch = max(self.max_batch, rows)
+            self._latencies.append(latency_ms)
+
+    def failed(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "flushes": self.flushes,
+                "rows": self.rows,
+                "mean_batch": round(self.rows / self.flushes, 2) if self.flushes else 0.0,
+                "max_batch": self.max_batch,
+                "failures": self.failures,
+                "flush_p50_ms": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+                "flush_p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3) if latencies else 0.0
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latencies.clear()
+            self.flushes = self.rows = self.max_batch = self.failures = 0
@@ -1,5 +1,5 @@
 from typing import Optional
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, DateTime, Numeric
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, DateTime, Numeric, Text, Index, Boolean, BigInteger
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from Products.database import Base
@@ -37,6 +37,8 @@ class Product(Base):
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Token of the bulk insert that created the row (databases without RETURNING re-select by it)
+    bulk_batch = Column(String(32), nullable=True)
 
     category = relationship("Category", back_populates="products")
     price_history = relationship("PriceHistory", back_populates="product", cascade="all, delete-orphan")
@@ -44,6 +46,33 @@ class Product(Base):
     stock_movements = relationship("StockMovement", back_populates="product", cascade="all, delete-orphan")
 
 
+class ProductSearchDocument(Base):
+    """Tokenized text of a product (name, brand, searchable attributes) kept in sync by Products.search"""
+    __tablename__ = "product_search_documents"
+    __table_args__ = (
+        Index("ix_product_search_documents_body", "body", mysql_prefix="FULLTEXT"),
+    )
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    body = Column(Text, nullable=False)
+    indexed_at = Column(DateTime, default=utc_now, index=True)
+
+
+class ProductFacet(Base):
+    """Narrow per-product row of the facet dimensions, refreshed by Products.facets"""
+    __tablename__ = "product_facets"
+    __table_args__ = (
+        Index("ix_product_facets_dimensions", "category_id", "in_stock", "price_bucket", "brand"),
+    )
+
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    category_id = Column(Integer, nullable=False)
+    brand = Column(String(100), nullable=True)
+    price = Column(Numeric(10, 2), nullable=False, index=True)
+    price_bucket = Column(Integer, nullable=False)
+    in_stock = Column(Boolean, nullable=False, default=False)
+
+
 class PriceHistory(Base):
     __tablename__ = "product_history"
 
@@ -71,21 +100,96 @@ class Inventory(Base):
     batch_number = Column(String(100), nullable=True)
     location = Column(String(100), nullable=True)
     last_updated = Column(DateTime, default=utc_now, onupdate=utc_now)
+    # Bumped by every stock write so optimistic writers can detect a concurrent change
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # 0 = stock lives in this row; N = split across N inventory_shards (the quantities here are a rollup)
+    shard_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     product = relationship("Product", back_populates="inventory")
 
 
+class InventoryShard(Base):
+    """One of several sub-counters holding a hot product's stock"""
+    __tablename__ = "inventory_shards"
+    __table_args__ = (Index("ix_inventory_shards_product_shard", "product_id", "shard_no", unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    shard_no = Column(Integer, nullable=False)
+    quantity_available = Column(Integer, nullable=False, default=0)
+    quantity_reserve = Column(Integer, nullable=False, default=0)
+
+
 class StockMovement(Base):
     __tablename__ = "stock_movements"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey(Order.order_id), nullable=False)
-    cart_id = Column(Integer, ForeignKey(Cart.cart_id), nullable=False)
+    # A movement belongs to a cart (reserve/release), an order (finalize) or neither (manual adjustment)
+    order_id = Column(Integer, ForeignKey(Order.order_id), nullable=True)
+    cart_id = Column(Integer, ForeignKey(Cart.cart_id), nullable=True)
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     change = Column(Integer, nullable=False)
     reason = Column(String(255), nullable=True)
     timestamp = Column(DateTime, default=utc_now)
 
     product = relationship("Product", back_populates="stock_movements")
-    order = relationship("Order", back_populates="stock_movements")
-    cart = relationship("Cart", back_populates="stock_movement") 
+    order = relationship(Order)
+    cart = relationship(Cart) 
+
+
+class StockMovementFailure(Base):
+    """Movements the ledger writer could not insert (rejected by the database or out of retries)"""
+    __tablename__ = "stock_movement_failures"
+
+    id = Column(Integer, primary_key=True)
+    # No FKs: a dangling cart/order id is the usual reason a row ends up here
+    order_id = Column(Integer, nullable=True)
+    cart_id = Column(Integer, nullable=True)
+    product_id = Column(Integer, nullable=True)
+    change = Column(Integer, nullable=True)
+    reason = Column(String(255), nullable=True)
+    timestamp = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+    failed_at = Column(DateTime, default=utc_now)
+
+
+class IdempotencyKey(Base):
+    """Response of an inventory request, written in the transaction that applied it, so a
+    retry with the same Idempotency-Key is replayed even after a restart"""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+    scope = Column(String(50), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(32), nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=utc_now, nullable=False)
+
+
+class ReservationJournalState(Base):
+    """Highest reservation-engine journal sequence already written to inventory/stock_movements"""
+    __tablename__ = "reservation_journal_state"
+
+    name = Column(String(50), primary_key=True)
+    applied_seq = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=utc_now, onupdate=utc_now)
+
+
+class Reservation(Base):
+    """Stock held for a cart until expires_at, when the expiry sweeper returns it to available"""
+    __tablename__ = "reservations"
+    __table_args__ = (
+        Index("ix_reservations_expires_at", "expires_at"),
+        Index("ix_reservations_cart_product", "cart_id", "product_id"),
+        Index("ix_reservations_product_expires", "product_id", "expires_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    # No FK: reservations made without a cart (or for a cart in another service) still expire
+    cart_id = Column(Integer, nullable=True)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=utc_now)
@@ -0,0 +1,609 @@
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, func, insert, select, tuple_, update
+import Products.models, Products.cache
+from Products.exceptions import InsufficientStockError, InventoryConflictError
+from Products.logger import log
+from Products import inventory_shards, reservations
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+ENGINE_ENABLED = os.getenv("RESERVATION_ENGINE", "false").lower() == "true"
+JOURNAL_PATH = os.getenv("RESERVATION_JOURNAL_PATH", "reservations.journal")
+# How long the journal waits to gather more writers into one fsync
+GROUP_COMMIT_MS = float(os.getenv("RESERVATION_GROUP_COMMIT_MS", "2"))
+WRITE_BEHIND_MS = float(os.getenv("RESERVATION_WRITE_BEHIND_MS", "200"))
+WRITE_BEHIND_BATCH = int(os.getenv("RESERVATION_WRITE_BEHIND_BATCH", "5000"))
+STATE_NAME = "reservation_engine"
+# Same setting as Products.idempotency: how long a recorded Idempotency-Key is replayed
+KEY_TTL = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+Deltas = Dict[int, Tuple[int, int]]
+
+
+class Journal:
+    """Append-only JSON-lines log with group commit.
+
+    Writers append under a lock and block until a single flusher thread has written and
+    fsync'd their record; everyone who appended during one fsync shares the next one.
+    """
+
+    def __init__(self, path: str, group_commit_ms: float = GROUP_COMMIT_MS):
+        self.path = path
+        self.group_commit_ms = group_commit_ms
+        self._cond = threading.Condition()
+        self._buffer: List[bytes] = []
+        self._next_seq = 1
+        self._durable_seq = 0
+        self._file = None
+        self._lock_file = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.fsyncs = 0
+        self.records_synced = 0
+
+    def lock(self) -> None:
+        """Take the journal for this process: sequence numbers and replay assume a single writer"""
+        lock_file = open(self.path + ".lock", "a+b")
+        try:
+            if sys.platform == "win32":
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                f"Reservation journal {self.path} is in use by another process; run a single worker "
+                f"with RESERVATION_ENGINE=true or give each its own RESERVATION_JOURNAL_PATH and database"
+            )
+        self._lock_file = lock_file
+
+    def unlock(self) -> None:
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def read(self) -> List[dict]:
+        """Every complete record in the file; a torn last line from a crash is ignored"""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    log.warning(f"Ignoring torn record at the end of {self.path}")
+                    break
+        return records
+
+    def open(self, last_seq: int) -> None:
+        self._file = open(self.path, "ab")
+        self._next_seq = last_seq + 1
+        self._durable_seq = last_seq
+        self._stopping = False
+        self._thread = threading.Thread(target=self._flush_loop, name="reservation-journal", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @property
+    def durable_seq(self) -> int:
+        return self._durable_seq
+
+    @property
+    def appended_seq(self) -> int:
+        with self._cond:
+            return self._next_seq - 1
+
+    def append(self, record: dict) -> int:
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            record["seq"] = seq
+            self._buffer.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            self._cond.notify_all()
+            return seq
+
+    def wait_durable(self, seq: int) -> None:
+        with self._cond:
+            while self._durable_seq < seq:
+                self._cond.wait()
+
+    def truncate_if_applied(self, applied_seq: int) -> bool:
+        """Empty the file once every record in it has been written to the database"""
+        with self._cond:
+            if self._file is None or self._buffer or self._durable_seq != applied_seq or self._next_seq != applied_seq + 1:
+                return False
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+            return True
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._buffer and not self._stopping:
+                    self._cond.wait()
+                if not self._buffer and self._stopping:
+                    return
+            if self.group_commit_ms:
+                time.sleep(self.group_commit_ms / 1000)
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+                upto = self._next_seq - 1
+            # Only this thread writes, so records reach the file in sequence order
+            self._file.write(b"".join(batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            with self._cond:
+                self._durable_seq = upto
+                self.fsyncs += 1
+                self.records_synced += len(batch)
+                self._cond.notify_all()
+
+
+class _Counter:
+    __slots__ = ("lock", "available", "reserved", "stale")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.available = 0
+        self.reserved = 0
+        self.stale = True
+
+
+class ReservationEngine:
+    """Authoritative in-memory available/reserved counters for the products being sold.
+
+    reserve/release/finalize/adjust take per-product locks (in product_id order), check
+    and update the counters, journal the change and return once the journal entry is
+    durable. A write-behind thread folds durable entries into inventory (relative
+    updates), stock_movements and reservations, storing the last applied sequence in the same
+    transaction, so replaying the journal after a crash applies each entry exactly once.
+    Counters are (re)loaded as database value + changes not yet written behind.
+    """
+
+    def __init__(self, journal_path: str = JOURNAL_PATH, write_behind_ms: float = WRITE_BEHIND_MS):
+        self.enabled = ENGINE_ENABLED
+        self.journal = Journal(journal_path)
+        self.write_behind_ms = write_behind_ms
+        self._session_factory = None
+        self._counters: Dict[int, _Counter] = {}
+        self._counters_lock = threading.Lock()
+        self._pending: Dict[int, List[int]] = {}
+        self._pending_lock = threading.Lock()
+        self._unapplied: Deque[dict] = deque()
+        # Idempotency-Keys journaled since start (time recorded), and the rows not written behind yet
+        self._keys: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._unflushed_keys: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Keys recorded before this process started may be replayed from the table until then
+        self._older_keys_until: Optional[datetime] = None
+        self._persist_lock = threading.RLock()
+        self._persisting = threading.local()
+        self._applied_seq = 0
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.persisted_batches = 0
+        self.persisted_records = 0
+
+    # ---------------------------------------------------------
+    # Lifecycle
+    # ---------------------------------------------------------
+
+    def start(self, session_factory=None) -> None:
+        with self._start_lock:
+            if self._started:
+                return
+            if session_factory is None:
+                from Products.database import SessionLocal
+                session_factory = SessionLocal
+            self._session_factory = session_factory
+            self.journal.lock()
+            try:
+                self._recover()
+            except Exception:
+                self.journal.unlock()
+                raise
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write_behind_loop, name="reservation-write-behind", daemon=True)
+            self._thread.start()
+            self._started = True
+            log.info(f"Reservation engine started (journal {self.journal.path}, applied seq {self._applied_seq})")
+
+    def stop(self) -> None:
+        with self._start_lock:
+            if not self._started:
+                return
+            self._stop.set()
+            self._thread.join()
+            self.flush()
+            self.journal.close()
+            self.journal.unlock()
+            self._started = False
+            with self._counters_lock:
+                self._counters.clear()
+            log.info("Reservation engine stopped")
+
+    def _recover(self) -> None:
+        db = self._session_factory()
+        try:
+            state = db.get(Products.models.ReservationJournalState, STATE_NAME)
+            self._applied_seq = state.applied_seq if state else 0
+        finally:
+            db.close()
+
+        records = [r for r in self.journal.read() if r["seq"] > self._applied_seq]
+        if records:
+            log.warning(f"Replaying {len(records)} reservation journal record(s) after seq {self._applied_seq}")
+            for start in range(0, len(records), WRITE_BEHIND_BATCH):
+                self._persist(records[start:start + WRITE_BEHIND_BATCH])
+        last_seq = records[-1]["seq"] if records else self._applied_seq
+        db = self._session_factory()
+        try:
+            newest = db.execute(select(func.max(Products.models.IdempotencyKey.created_at))).scalar()
+        finally:
+            db.close()
+        self._older_keys_until = newest + timedelta(seconds=KEY_TTL) if newest else None
+        self.journal.open(last_seq)
+        self.journal.truncate_if_applied(self._applied_seq)
+
+    # ---------------------------------------------------------
+    # Counters
+    # ---------------------------------------------------------
+
+    def _lock_counters(self, product_ids: Iterable[int]) -> List[Tuple[int, _Counter]]:
+        with self._counters_lock:
+            counters = [(pid, self._counters.setdefault(pid, _Counter())) for pid in sorted(set(product_ids))]
+        for _, counter in counters:
+            counter.lock.acquire()
+        stale = [(pid, counter) for pid, counter in counters if counter.stale]
+        if stale:
+            try:
+                self._load([pid for pid, _ in stale], dict(stale))
+            except Exception:
+                self._unlock(counters)
+                raise
+        return counters
+
+    @staticmethod
+    def _unlock(counters: List[Tuple[int, _Counter]]) -> None:
+        for _, counter in counters:
+            counter.lock.release()
+
+    def _load(self, product_ids: List[int], counters: Dict[int, _Counter]) -> None:
+        """database value + not yet persisted deltas, read while no write-behind commit is in flight"""
+        Inventory = Products.models.Inventory
+        with self._persist_lock:
+            db = self._session_factory()
+            try:
+                rows = db.execute(
+                    select(Inventory.product_id, Inventory.quantity_available, Inventory.quantity_reserve, Inventory.shard_count)
+                    .where(Inventory.product_id.in_(product_ids))
+                ).all()
+                stock = {pid: (a or 0, r or 0) for pid, a, r, _ in rows}
+                sharded = [pid for pid, _, _, shard_count in rows if shard_count]
+                if sharded:
+                    for pid, shards in inventory_shards.read_shards(db, sharded).items():
+                        stock[pid] = inventory_shards.totals(shards)
+            finally:
+                db.close()
+            with self._pending_lock:
+                for pid in product_ids:
+                    if pid not in stock:
+                        continue
+                    pending = self._pending.get(pid, (0, 0))
+                    counters[pid].available = stock[pid][0] + pending[0]
+                    counters[pid].reserved = stock[pid][1] + pending[1]
+                    counters[pid].stale = False
+
+    def invalidate(self, product_ids: Iterable[int]) -> None:
+        """Reload these counters on next use (stock was written outside the engine)"""
+        with self._counters_lock:
+            counters = [self._counters.get(pid) for pid in product_ids]
+        for counter in counters:
+            if counter is not None:
+                # Under the counter's lock, so an apply() in progress never sees it flip mid-check
+                with counter.lock:
+                    counter.stale = True
+
+    # ---------------------------------------------------------
+    # Operations
+    # ---------------------------------------------------------
+
+    def apply(
+        self,
+        deltas: Deltas,
+        strict: bool,
+        build_movements: Callable[[Deltas], List[Dict[str, Any]]],
+        clamp_available: bool = False,
+        reservation_changes: Optional[Callable[[Deltas], Dict[str, List[Dict[str, Any]]]]] = None,
+        idempotency_row: Optional[Callable[[Deltas], Optional[Dict[str, Any]]]] = None
+    ) -> Deltas:
+        """Same contract as crud._adjust_stock, answered from memory and journaled.
+
+        The reservation rows to add / takes to consume, and the idempotency_keys row of a
+        keyed request, are journaled with the stock change and written behind in its
+        transaction. Takes are checked first against the table as of every earlier journal
+        record, raising ReservationConflictError if a row moved.
+        """
+        self.start()
+        counters = self._lock_counters(deltas)
+        try:
+            applied: Deltas = {}
+            effective: Deltas = {}
+            for pid, counter in counters:
+                d_available, d_reserved = deltas[pid]
+                if clamp_available and not counter.stale:
+                    d_available = max(d_available, -counter.available)
+                if counter.stale or counter.available + d_available < 0 or counter.reserved + d_reserved < 0:
+                    if strict:
+                        raise InsufficientStockError(
+                            f"Insufficient stock for product {pid} (requested: {-d_available}, available: {counter.available})"
+                        )
+                    continue
+                effective[pid] = (d_available, d_reserved)
+
+            for pid, counter in counters:
+                if pid in effective:
+                    applied[pid] = (counter.available + effective[pid][0], counter.reserved + effective[pid][1])
+            if not applied:
+                return applied
+            changes = reservation_changes(applied) if reservation_changes else {}
+            key_row = idempotency_row(applied) if idempotency_row else None
+            if changes.get("consume"):
+                # The counters are locked, so no other change to these products' rows can slip in
+                self.sync()
+                db = self._session_factory()
+                try:
+                    reservations.verify(db, changes["consume"])
+                finally:
+                    db.close()
+
+            for pid, counter in counters:
+                if pid in effective:
+                    counter.available, counter.reserved = applied[pid]
+
+            now = Products.models.utc_now().replace(tzinfo=None).isoformat()
+            movements = [{**m, "timestamp": now} for m in build_movements(applied)]
+            record = {"deltas": [[pid, d[0], d[1]] for pid, d in effective.items()], "movements": movements}
+            if changes:
+                record["reservations"] = {
+                    "add": [{**row, "expires_at": row["expires_at"].isoformat()} for row in changes.get("add", [])],
+                    "consume": changes.get("consume", [])
+                }
+            if key_row is not None:
+                record["idempotency"] = {**key_row, "created_at": key_row["created_at"].isoformat()}
+            with self._pending_lock:
+                for pid, (d_available, d_reserved) in effective.items():
+                    pending = self._pending.setdefault(pid, [0, 0])
+                    pending[0] += d_available
+                    pending[1] += d_reserved
+                seq = self.journal.append(record)
+                self._unapplied.append(record)
+                if key_row is not None:
+                    self._remember_key(key_row)
+        finally:
+            self._unlock(counters)
+
+        self.journal.wait_durable(seq)
+        return applied
+
+    def _remember_key(self, row: Dict[str, Any]) -> None:
+        """Called with _pending_lock held, right after the record carrying `row` was journaled"""
+        now = time.monotonic()
+        key = (row["scope"], row["key"])
+        self._keys[key] = now
+        self._keys.move_to_end(key)
+        self._unflushed_keys[key] = row
+        while self._keys:
+            oldest, recorded = next(iter(self._keys.items()))
+            if now - recorded < KEY_TTL:
+                break
+            del self._keys[oldest]
+
+    def recorded_key(self, scope: str, key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Whether an Idempotency-Key may already be recorded, and its row while it is only in the journal.
+
+        The engine is the only writer of stock since it started, so a key it has not
+        journaled can only be in idempotency_keys if it is older than the process.
+        """
+        self.start()
+        with self._pending_lock:
+            if (scope, key) in self._keys:
+                return True, self._unflushed_keys.get((scope, key))
+        older = self._older_keys_until is not None and Products.models.utc_now().replace(tzinfo=None) < self._older_keys_until
+        return older, None
+
+    def counters(self, product_ids: Iterable[int]) -> Deltas:
+        """Current (available, reserved) per product as the engine sees it"""
+        self.start()
+        counters = self._lock_counters(product_ids)
+        try:
+            return {pid: (c.available, c.reserved) for pid, c in counters if not c.stale}
+        finally:
+            self._unlock(counters)
+
+    # ---------------------------------------------------------
+    # Write-behind
+    # ---------------------------------------------------------
+
+    def _write_behind_loop(self) -> None:
+        while not self._stop.wait(self.write_behind_ms / 1000):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Reservation write-behind failed, will retry: {e}")
+
+    def sync(self) -> None:
+        """Wait until everything journaled so far is durable and written to the database"""
+        self.journal.wait_durable(self.journal.appended_seq)
+        self.flush()
+
+    def flush(self) -> int:
+        """Write every durable journal record to the database; returns how many were written"""
+        written = 0
+        with self._persist_lock:
+            while True:
+                durable = self.journal.durable_seq
+                with self._pending_lock:
+                    batch = []
+                    for record in self._unapplied:
+                        if record["seq"] > durable or len(batch) >= WRITE_BEHIND_BATCH:
+                            break
+                        batch.append(record)
+                if not batch:
+                    break
+                self._persist(batch)
+                with self._pending_lock:
+                    for _ in batch:
+                        record = self._unapplied.popleft()
+                        if "idempotency" in record:
+                            self._unflushed_keys.pop((record["idempotency"]["scope"], record["idempotency"]["key"]), None)
+                        for pid, d_available, d_reserved in record["deltas"]:
+                            pending = self._pending[pid]
+                            pending[0] -= d_available
+                            pending[1] -= d_reserved
+                            if pending == [0, 0]:
+                                del self._pending[pid]
+                written += len(batch)
+            if written:
+                self.journal.truncate_if_applied(self._applied_seq)
+        return written
+
+    def _persist(self, records: List[dict]) -> None:
+        """One transaction: net inventory deltas, the movement, reservation and idempotency rows and the new applied seq"""
+        net: Dict[int, List[int]] = {}
+        movements = []
+        reservation_changes = {"add": [], "consume": []}
+        keys = {}
+        for record in records:
+            for pid, d_available, d_reserved in record["deltas"]:
+                totals = net.setdefault(pid, [0, 0])
+                totals[0] += d_available
+                totals[1] += d_reserved
+            movements.extend({**m, "timestamp": datetime.fromisoformat(m["timestamp"])} for m in record["movements"])
+            changes = record.get("reservations", {})
+            reservation_changes["add"].extend(
+                {**row, "expires_at": datetime.fromisoformat(row["expires_at"])} for row in changes.get("add", [])
+            )
+            reservation_changes["consume"].extend(changes.get("consume", []))
+            if "idempotency" in record:
+                key_row = record["idempotency"]
+                keys[(key_row["scope"], key_row["key"])] = {**key_row, "created_at": datetime.fromisoformat(key_row["created_at"])}
+        last_seq = records[-1]["seq"]
+
+        Inventory = Products.models.Inventory
+        db = self._session_factory()
+        self._persisting.active = True
+        try:
+            sharded = set(db.execute(
+                select(Inventory.product_id).where(Inventory.product_id.in_(list(net)), Inventory.shard_count > 0)
+            ).scalars())
+            plain = [
+                {"p_id": pid, "p_available": d[0], "p_reserved": d[1]}
+                for pid, d in net.items() if pid not in sharded and d != [0, 0]
+            ]
+            if plain:
+                db.execute(
+                    update(Inventory.__table__)
+                    .where(Inventory.__table__.c.product_id == bindparam("p_id"))
+                    .values(
+                        quantity_available=Inventory.__table__.c.quantity_available + bindparam("p_available"),
+                        quantity_reserve=Inventory.__table__.c.quantity_reserve + bindparam("p_reserved"),
+                        version=Inventory.__table__.c.version + 1
+                    ),
+                    plain
+                )
+            if sharded:
+                shards = inventory_shards.read_shards(db, sharded)
+                moves = []
+                for pid in sorted(sharded):
+                    planned = inventory_shards.plan_moves(shards.get(pid, []), *net[pid]) if shards.get(pid) else None
+                    if planned is None:
+                        # Never advance applied_seq past a delta that was not written: retried
+                        # by the write-behind loop until the shards can take it
+                        raise InventoryConflictError(f"Inventory shards of product {pid} cannot absorb {tuple(net[pid])}")
+                    moves.extend(planned)
+                if not inventory_shards.apply_moves(db, moves):
+                    raise InventoryConflictError("Inventory shards changed while writing reservations behind")
+            if movements:
+                db.execute(insert(Products.models.StockMovement), movements)
+            # Checked when journaled; a row deleted since (product removed) must not wedge the write-behind
+            reservations.write(db, reservation_changes, strict=False)
+            if keys:
+                # A record replayed after a crash may find its key already written
+                IdempotencyKey = Products.models.IdempotencyKey
+                existing = set(db.execute(
+                    select(IdempotencyKey.scope, IdempotencyKey.key)
+                    .where(tuple_(IdempotencyKey.scope, IdempotencyKey.key).in_(list(keys)))
+                ).tuples())
+                rows = [row for key, row in keys.items() if key not in existing]
+                if rows:
+                    db.execute(insert(IdempotencyKey), rows)
+
+            state = db.get(Products.models.ReservationJournalState, STATE_NAME)
+            if state is None:
+                db.add(Products.models.ReservationJournalState(name=STATE_NAME, applied_seq=last_seq))
+            else:
+                state.applied_seq = last_seq
+            Products.cache.mark_changed(db, inventory_product_ids=list(net))
+            db.commit()
+            self._applied_seq = last_seq
+            self.persisted_batches += 1
+            self.persisted_records += len(records)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            self._persisting.active = False
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            unapplied = len(self._unapplied)
+        fsyncs = self.journal.fsyncs
+        return {
+            "enabled": self.enabled,
+            "started": self._started,
+            "products": len(self._counters),
+            "durable_seq": self.journal.durable_seq,
+            "applied_seq": self._applied_seq,
+            "unapplied_records": unapplied,
+            "fsyncs": fsyncs,
+            "records_per_fsync": round(self.journal.records_synced / fsyncs, 2) if fsyncs else 0.0,
+            "write_behind_batches": self.persisted_batches,
+            "write_behind_records": self.persisted_records
+        }
+
+
+reservation_engine = ReservationEngine()
+
+
+@Products.cache.on_commit
+def _invalidate_engine_counters(changes: Products.cache.ChangeSet) -> None:
+    # Stock written by anything but the engine's own write-behind makes its counters stale
+    if not reservation_engine.enabled or getattr(reservation_engine._persisting, "active", False):
+        return
+    if changes.inventory_product_ids:
+        reservation_engine.invalidate(changes.inventory_product_ids)
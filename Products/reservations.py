@@ -0,0 +1,342 @@
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.orm import Session
+import Products.models
+from Products.exceptions import ReservationConflictError
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+SWEEP_BATCH_SIZE = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "1000"))
+# Longest the sweeper sleeps without a known deadline (picks up other processes' reservations)
+SWEEP_MAX_IDLE = float(os.getenv("RESERVATION_SWEEP_MAX_IDLE", "30"))
+
+# (cart_id, product_id)
+Key = Tuple[Optional[int], int]
+
+_reservations = Products.models.Reservation.__table__
+_consume_whole = _reservations.delete().where(
+    _reservations.c.id == bindparam("r_id"),
+    _reservations.c.quantity == bindparam("r_take")
+)
+_consume_part = _reservations.update()\
+    .where(_reservations.c.id == bindparam("r_id"), _reservations.c.quantity > bindparam("r_take"))\
+    .values(quantity=_reservations.c.quantity - bindparam("r_take"))
+
+
+def utc_naive() -> datetime:
+    return Products.models.utc_now().replace(tzinfo=None)
+
+
+def cart_key(value: Any) -> Optional[int]:
+    return int(value) if value not in (None, "") else None
+
+
+def new_rows(quantities: Dict[Key, int], ttl: Optional[int] = None) -> List[Dict[str, Any]]:
+    """One reservation row per (cart, product), all expiring together, ready for write()"""
+    expires_at = utc_naive() + timedelta(seconds=ttl or RESERVATION_TTL)
+    return [
+        {"cart_id": cart_id, "product_id": product_id, "quantity": quantity, "expires_at": expires_at}
+        for (cart_id, product_id), quantity in quantities.items()
+    ]
+
+
+def write(db: Session, changes: Dict[str, List[Dict[str, Any]]], strict: bool = True) -> None:
+    """Insert the rows in changes["add"] and consume() the takes in changes["consume"] (no commit)"""
+    if changes.get("add"):
+        db.execute(insert(Products.models.Reservation), changes["add"])
+        expiry_sweeper.schedule(min(row["expires_at"] for row in changes["add"]))
+    if changes.get("consume"):
+        consume(db, changes["consume"], strict)
+
+
+def claim(db: Session, wanted: Dict[Key, int]) -> Tuple[Dict[Key, int], List[Dict[str, int]]]:
+    """How much of each wanted (cart, product) quantity is still held, and the row takes that consume it.
+
+    Rows are taken soonest-expiring first. A None cart takes from any cart's reservations
+    of that product; a cart whose own rows fall short also takes from rows without a cart
+    (such as the ones backfill() creates). Nothing is written here; pass the takes to consume().
+    """
+    Reservation = Products.models.Reservation
+    columns = (Reservation.id, Reservation.cart_id, Reservation.product_id, Reservation.quantity)
+    remaining = dict(wanted)
+    held: Dict[Key, int] = {key: 0 for key in wanted}
+    takes: Dict[int, Dict[str, int]] = {}
+
+    def take(row, key: Key) -> None:
+        row_id, _, product_id, quantity = row
+        taken = takes[row_id]["r_take"] if row_id in takes else 0
+        amount = min(quantity - taken, remaining[key])
+        if amount <= 0:
+            return
+        remaining[key] -= amount
+        held[key] += amount
+        takes[row_id] = {"r_id": row_id, "r_take": taken + amount, "r_whole": taken + amount == quantity, "r_product_id": product_id}
+
+    by_cart = [key for key in wanted if key[0] is not None]
+    if by_cart:
+        for row in db.execute(
+            select(*columns)
+            .where(
+                Reservation.cart_id.in_({cart_id for cart_id, _ in by_cart}),
+                Reservation.product_id.in_({product_id for _, product_id in by_cart})
+            )
+            .order_by(Reservation.expires_at, Reservation.id)
+        ):
+            if (row[1], row[2]) in remaining:
+                take(row, (row[1], row[2]))
+    for key in wanted:
+        if key[0] is None:
+            # Every row holds at least one unit, so `quantity` rows always cover the request
+            for row in db.execute(
+                select(*columns)
+                .where(Reservation.product_id == key[1])
+                .order_by(Reservation.expires_at, Reservation.id)
+                .limit(wanted[key])
+            ):
+                take(row, key)
+
+    short = [key for key in by_cart if remaining[key] > 0]
+    if short:
+        for row in db.execute(
+            select(*columns)
+            .where(Reservation.cart_id.is_(None), Reservation.product_id.in_({product_id for _, product_id in short}))
+            .order_by(Reservation.expires_at, Reservation.id)
+        ):
+            for key in short:
+                if key[1] == row[2]:
+                    take(row, key)
+    return held, list(takes.values())
+
+
+def verify(db: Session, takes: List[Dict[str, int]]) -> None:
+    """Raise ReservationConflictError unless every take still matches the row it consumes"""
+    if not takes:
+        return
+    Reservation = Products.models.Reservation
+    quantities = dict(db.execute(
+        select(Reservation.id, Reservation.quantity).where(Reservation.id.in_([t["r_id"] for t in takes]))
+    ).all())
+    moved = [
+        t for t in takes
+        if t["r_id"] not in quantities or quantities[t["r_id"]] < t["r_take"] or (quantities[t["r_id"]] == t["r_take"]) != t["r_whole"]
+    ]
+    if moved:
+        raise ReservationConflictError(f"{len(moved)} reservation(s) changed concurrently")
+
+
+def consume(db: Session, takes: List[Dict[str, int]], strict: bool = True) -> int:
+    """Delete fully taken rows and shrink partly taken ones; returns how many rows matched.
+
+    When strict, raises if any row moved meanwhile; otherwise that take is only logged.
+    """
+    whole = [{"r_id": t["r_id"], "r_take": t["r_take"]} for t in takes if t["r_whole"]]
+    part = [{"r_id": t["r_id"], "r_take": t["r_take"]} for t in takes if not t["r_whole"]]
+    sane = db.get_bind().dialect.supports_sane_multi_rowcount
+    matched = 0
+    for stmt, params in ((_consume_whole, whole), (_consume_part, part)):
+        if not params:
+            continue
+        if sane:
+            matched += db.execute(stmt, params).rowcount
+        else:
+            matched += sum(db.execute(stmt, row).rowcount for row in params)
+    if matched != len(takes):
+        if strict:
+            raise ReservationConflictError(f"{len(takes) - matched} reservation(s) changed concurrently")
+        log.warning(f"{len(takes) - matched} reservation(s) were already gone when consumed")
+    return matched
+
+
+def backfill(db: Session, ttl: Optional[int] = None) -> int:
+    """Cover reserved stock that no reservation row accounts for with rows without a cart (no commit).
+
+    Stock reserved before reservations were tracked would otherwise never be released nor
+    expire. The rows can be claimed by any cart and expire after ttl like any other.
+    Returns the units covered.
+    """
+    Inventory = Products.models.Inventory
+    Shard = Products.models.InventoryShard
+    Reservation = Products.models.Reservation
+    # Row locks keep two workers starting together from covering the same stock twice
+    reserved = dict(db.execute(
+        select(Inventory.product_id, Inventory.quantity_reserve)
+        .where(Inventory.shard_count == 0, Inventory.quantity_reserve > 0)
+        .with_for_update()
+    ).all())
+    reserved.update(db.execute(
+        select(Shard.product_id, func.sum(Shard.quantity_reserve))
+        .group_by(Shard.product_id)
+        .having(func.sum(Shard.quantity_reserve) > 0)
+    ).all())
+    if not reserved:
+        return 0
+    covered = dict(db.execute(
+        select(Reservation.product_id, func.sum(Reservation.quantity)).group_by(Reservation.product_id)
+    ).all())
+    missing = {
+        (None, product_id): int(quantity) - int(covered.get(product_id) or 0)
+        for product_id, quantity in reserved.items() if int(quantity) > int(covered.get(product_id) or 0)
+    }
+    if missing:
+        write(db, {"add": new_rows(missing, ttl)})
+    return sum(missing.values())
+
+
+def extend(db: Session, cart_id: int, ttl: Optional[int] = None) -> int:
+    """Push the expiry of every reservation of a cart out to now + ttl (no commit)"""
+    expires_at = utc_naive() + timedelta(seconds=ttl or RESERVATION_TTL)
+    Reservation = Products.models.Reservation
+    extended = db.execute(
+        update(Reservation).where(Reservation.cart_id == cart_id).values(expires_at=expires_at)
+    ).rowcount
+    if extended:
+        expiry_sweeper.schedule(expires_at)
+    return extended
+
+
+def due_batch(db: Session, batch_size: int = SWEEP_BATCH_SIZE, now: Optional[datetime] = None) -> List[Tuple[int, int, Optional[int], int]]:
+    """(id, product_id, cart_id, quantity) of up to batch_size expired reservations, row-locked.
+
+    The expires_at index keeps this a short range scan however many reservations are
+    outstanding; SKIP LOCKED lets several sweepers split the backlog.
+    """
+    Reservation = Products.models.Reservation
+    return db.execute(
+        select(Reservation.id, Reservation.product_id, Reservation.cart_id, Reservation.quantity)
+        .where(Reservation.expires_at <= (now or utc_naive()))
+        .order_by(Reservation.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+
+def next_expiry(db: Session) -> Optional[datetime]:
+    return db.execute(select(func.min(Products.models.Reservation.expires_at))).scalar()
+
+
+class ExpirySweeper:
+    """Background thread that hands expired reservations back to available stock.
+
+    Deadlines sit in a min-heap rounded up to whole seconds, so however many reservations
+    are outstanding the heap holds at most one entry per second of TTL. The thread sleeps
+    until the earliest deadline (or SWEEP_MAX_IDLE) and then releases everything due in
+    batches of batch_size rows: one bulk inventory update and one bulk movement insert
+    per batch.
+    """
+
+    def __init__(self, batch_size: int = SWEEP_BATCH_SIZE, max_idle: float = SWEEP_MAX_IDLE):
+        self.batch_size = batch_size
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        self._deadlines: List[datetime] = []
+        self._queued = set()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._session_factory = None
+        self.sweeps = 0
+        self.released_rows = 0
+        self.released_units = 0
+        self.last_sweep_ms = 0.0
+
+    def schedule(self, expires_at: Optional[datetime]) -> None:
+        if expires_at is None:
+            return
+        deadline = expires_at.replace(microsecond=0) + (timedelta(seconds=1) if expires_at.microsecond else timedelta())
+        with self._cond:
+            if deadline in self._queued:
+                return
+            self._queued.add(deadline)
+            heapq.heappush(self._deadlines, deadline)
+            if self._deadlines[0] == deadline:
+                self._cond.notify()
+
+    def start(self, session_factory) -> None:
+        if self._thread is not None:
+            return
+        self._session_factory = session_factory
+        self._stopping = False
+        db = session_factory()
+        try:
+            self.schedule(next_expiry(db))
+        finally:
+            db.close()
+        self._thread = threading.Thread(target=self._run, name="reservation-expiry", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _wait_for_deadline(self) -> bool:
+        with self._cond:
+            while not self._stopping:
+                now = utc_naive()
+                if self._deadlines and self._deadlines[0] <= now:
+                    while self._deadlines and self._deadlines[0] <= now:
+                        self._queued.discard(heapq.heappop(self._deadlines))
+                    return True
+                timeout = (self._deadlines[0] - now).total_seconds() if self._deadlines else self.max_idle
+                if not self._cond.wait(min(timeout, self.max_idle)) and not self._deadlines:
+                    return True
+            return False
+
+    def _run(self) -> None:
+        while self._wait_for_deadline():
+            db = self._session_factory()
+            try:
+                self.sweep(db)
+                self.schedule(next_expiry(db))
+            except Exception as e:
+                log.error(f"Reservation expiry sweep failed: {e}")
+            finally:
+                db.close()
+
+    def sweep(self, db: Session, now: Optional[datetime] = None) -> int:
+        """Release every reservation due by now; returns the number of reservation rows released"""
+        import Products.crud
+        started = time.perf_counter()
+        released = 0
+        while True:
+            try:
+                rows, units = Products.crud.expire_reservations(db, self.batch_size, now)
+            except ReservationConflictError:
+                continue  # a cart released or checked out part of the batch; read it again
+            released += rows
+            self.released_rows += rows
+            self.released_units += units
+            if rows < self.batch_size:
+                break
+        self.sweeps += 1
+        self.last_sweep_ms = round((time.perf_counter() - started) * 1000, 3)
+        if released:
+            log.info(f"Released {released} expired reservation(s) in {self.last_sweep_ms}ms")
+        return released
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            next_deadline = self._deadlines[0].isoformat() if self._deadlines else None
+            queued = len(self._deadlines)
+        return {
+            "running": self._thread is not None,
+            "queued_deadlines": queued,
+            "next_deadline": next_deadline,
+            "sweeps": self.sweeps,
+            "released_rows": self.released_rows,
+            "released_units": self.released_units,
+            "last_sweep_ms": self.last_sweep_ms
+        }
+
+
+expiry_sweeper = ExpirySweeper()
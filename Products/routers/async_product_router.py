@@ -0,0 +1,202 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Union
+import Products.schemas, Products.async_crud
+from Products.async_database import get_async_db
+from Products.exceptions import InventoryConflictError
+from Products.idempotency import idempotent_async, fingerprint
+from Products.routers.product_router import IDEMPOTENCY_KEY
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Mounted ahead of product_router when DB_MODE=async; same paths and responses, served on
+# the event loop. Ids are matched as {product_id:int} so static paths such as /facets
+# still fall through to the sync router.
+router = APIRouter(prefix="/products", tags=["Products"])
+
+@router.get("/", response_model=Products.schemas.ProductListResponse)
+async def get_all_products(
+    db: AsyncSession = Depends(get_async_db),
+    page: int = Query(1, ge=1, description="Page number"),
+    per_page: int = Query(10, ge=1, le=100, description="Items per page"),
+    search: Optional[str] = Query(None, description="Search products"),
+    sort_by: str = Query("created_at", description="Sort by field ('relevance' ranks search matches)"),
+    sort_dir: str = Query("desc", regex="^(asc|desc)$", description="Sort direction"),
+    min_price: Optional[float] = Query(None, ge=0, description="Minimum price"),
+    max_price: Optional[float] = Query(None, ge=0, description="Maximum price"),
+    category_id: Optional[int] = Query(None, description="Filter by category (includes its subcategories)"),
+    in_stock_only: bool = Query(False, description="Show only in-stock items"),
+    pagination: str = Query("offset", regex="^(offset|cursor)$", description="Paging mode; 'cursor' seeks instead of using OFFSET"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from the previous page (implies cursor pagination)"),
+    include_total: bool = Query(False, description="Also compute the filtered total in cursor mode"),
+    total_mode: str = Query("exact", regex="^(exact|estimated)$", description="'estimated' answers large totals from table statistics or sampling")
+):
+    filters = {
+        'min_price': min_price,
+        'max_price': max_price,
+        'category_id': category_id,
+        'in_stock_only': in_stock_only
+    }
+
+    if pagination == "cursor" or cursor:
+        try:
+            products, next_cursor = await Products.async_crud.list_products_keyset(
+                db, per_page, cursor, search, sort_by, sort_dir, filters
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        total, total_is_estimate = None, False
+        if include_total:
+            total, total_is_estimate = await Products.async_crud.count_products(
+                db, search, filters, estimated=total_mode == "estimated"
+            )
+        return {
+            "total": total,
+            "page": None,
+            "per_page": per_page,
+            "total_pages": (total + per_page - 1) // per_page if total is not None else None,
+            "total_is_estimate": total_is_estimate,
+            "next_cursor": next_cursor,
+            "products": products
+        }
+
+    products, (total, total_is_estimate) = await Products.async_crud.list_products(
+        db, (page - 1) * per_page, per_page, search, sort_by, sort_dir, filters,
+        estimated=total_mode == "estimated"
+    )
+    return {
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "total_pages": (total + per_page - 1) // per_page,
+        "total_is_estimate": total_is_estimate,
+        "products": products
+    }
+
+@router.get("/{product_id:int}", response_model=Products.schemas.Product)
+async def get_product_by_id(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    payload = await Products.async_crud.get_product_detail(db, product_id)
+    if payload is None:
+        log.warning(f"Product not found: ID {product_id}")
+        raise HTTPException(status_code=404, detail="Product not found")
+    return Response(content=payload, media_type="application/json")
+
+@router.get("/{product_id:int}/inventory", response_model=Products.schemas.Inventory)
+async def get_product_inventory(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    inventory = await Products.async_crud.get_inventory_by_product_id(db, product_id)
+    if not inventory:
+        raise HTTPException(status_code=404, detail="Inventory not found")
+    return inventory
+
+async def _inventory_call(call):
+    try:
+        return await call
+    except InventoryConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/reserve", response_model=dict)
+async def reserve_products(
+    reservations: Union[List[dict], dict],
+    cart_id: Optional[str] = None,
+    ttl_seconds: Optional[int] = Query(None, ge=1, description="Release the reservation after this long (default RESERVATION_TTL_SECONDS)"),
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Reserve single or multiple products for an order (atomic operation)"""
+    if isinstance(reservations, dict):
+        reservations = [reservations]
+
+    async def run():
+        return await _inventory_call(Products.async_crud.reserve_items(db, reservations, cart_id, ttl=ttl_seconds))
+
+    def respond(reserved_items):
+        return {
+            "success": True,
+            "reserved_items": reserved_items,
+            "total_items": len(reserved_items),
+            "cart_id": cart_id,
+            "message": f"Successfully reserved {len(reserved_items)} product(s)"
+        }
+
+    return await idempotent_async("reserve", idempotency_key, fingerprint(reservations, cart_id, ttl_seconds), run, respond=respond)
+
+@router.post("/release", response_model=dict)
+async def release_products(
+    reservations: Union[List[dict], dict],
+    cart_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Release single or multiple reserved products (e.g., if user cancels checkout)"""
+    if isinstance(reservations, dict):
+        reservations = [reservations]
+
+    async def run():
+        return await _inventory_call(Products.async_crud.release_items(db, reservations, cart_id))
+
+    def respond(released_items):
+        return {
+            "success": True,
+            "released_items": released_items,
+            "total_items": len(released_items),
+            "order_id": cart_id,
+            "message": f"Successfully released {len(released_items)} product(s)"
+        }
+
+    return await idempotent_async("release", idempotency_key, fingerprint(reservations, cart_id), run, respond=respond)
+
+@router.post("/finalize", response_model=dict)
+async def finalize_products(
+    reservations: Union[List[dict], dict],
+    order_id: Optional[str] = None,
+    cart_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Finalize single or multiple reserved products (convert reserves to sold)"""
+    if isinstance(reservations, dict):
+        reservations = [reservations]
+
+    async def run():
+        return await _inventory_call(Products.async_crud.finalize_items(db, reservations, order_id, cart_id))
+
+    def respond(finalized_items):
+        return {
+            "success": True,
+            "finalized_items": finalized_items,
+            "total_items": len(finalized_items),
+            "order_id": order_id,
+            "message": f"Successfully finalized {len(finalized_items)} product(s)"
+        }
+
+    return await idempotent_async("finalize", idempotency_key, fingerprint(reservations, order_id, cart_id), run, respond=respond)
+
+@router.post("/restock", response_model=dict)
+async def restock_products(
+    reservations: Union[List[dict], dict],
+    order_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Put sold products back on sale (e.g., a finalized order was cancelled)"""
+    if isinstance(reservations, dict):
+        reservations = [reservations]
+
+    async def run():
+        return await _inventory_call(Products.async_crud.restock_items(db, reservations, order_id))
+
+    def respond(restocked_items):
+        return {
+            "success": True,
+            "restocked_items": restocked_items,
+            "total_items": len(restocked_items),
+            "order_id": order_id,
+            "message": f"Successfully restocked {len(restocked_items)} product(s)"
+        }
+
+    return await idempotent_async("restock", idempotency_key, fingerprint(reservations, order_id), run, respond=respond)
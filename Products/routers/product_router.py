@@ -1,11 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy import desc, func
 from sqlalchemy.orm import Session
 from typing import List, Optional, Union
-import Products.schemas, Products.crud
-from Products.database import get_db
+import Products.schemas, Products.crud, Products.facets, Products.counts, Products.export
+from Products.database import get_db, SessionLocal
 from Products.data_generator import DataGenerator
 from Products.logger import log
+from Products.category_tree import category_tree
+from Products.metrics import inventory_contention
+from Products import inventory_shards
+from Products.reservation_engine import reservation_engine
+from Products import reservations as product_reservations
+from Products.ledger import ledger_writer
+from Products.idempotency import idempotency_store, idempotent, fingerprint
 import Products.models
 import sys
 import os
@@ -17,50 +25,74 @@ generator = DataGenerator()
 @router.post("/", response_model=Products.schemas.Product)
 def create_product(product: Products.schemas.ProductCreate, db: Session = Depends(get_db)):
     log.info(f"Creating product: {product.name}")
+    if not category_tree.contains(db, product.category_id):
+        raise HTTPException(status_code=400, detail="Invalid category_id")
     return Products.crud.create_product_manual(db, product)
 
+@router.post("/bulk", response_model=Products.schemas.ProductBulkResult)
+def create_products_bulk(payload: Products.schemas.ProductBulkCreate, db: Session = Depends(get_db)):
+    """Create up to 10,000 products with their inventory using batched multi-row inserts"""
+    log.info(f"Bulk creating {len(payload.products)} product(s)")
+    return Products.crud.bulk_create_products(db, payload.products)
+
 @router.get("/", response_model=Products.schemas.ProductListResponse)
 def get_all_products(
     db: Session = Depends(get_db),
     page: int = Query(1, ge=1, description="Page number"),
     per_page: int = Query(10, ge=1, le=100, description="Items per page"),
     search: Optional[str] = Query(None, description="Search products"),
-    sort_by: str = Query("created_at", description="Sort by field"),
+    sort_by: str = Query("created_at", description="Sort by field ('relevance' ranks search matches)"),
     sort_dir: str = Query("desc", regex="^(asc|desc)$", description="Sort direction"),
     min_price: Optional[float] = Query(None, ge=0, description="Minimum price"),
     max_price: Optional[float] = Query(None, ge=0, description="Maximum price"),
-    category_id: Optional[int] = Query(None, description="Filter by category"),
-    in_stock_only: bool = Query(False, description="Show only in-stock items")
+    category_id: Optional[int] = Query(None, description="Filter by category (includes its subcategories)"),
+    in_stock_only: bool = Query(False, description="Show only in-stock items"),
+    pagination: str = Query("offset", regex="^(offset|cursor)$", description="Paging mode; 'cursor' seeks instead of using OFFSET"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from the previous page (implies cursor pagination)"),
+    include_total: bool = Query(False, description="Also compute the filtered total in cursor mode"),
+    total_mode: str = Query("exact", regex="^(exact|estimated)$", description="'estimated' answers large totals from table statistics or sampling")
 ):
-    log.info(f"Fetching products | page={page}, per_page={per_page}, search='{search}', sort_by='{sort_by}', sort_dir='{sort_dir}'")
+    log.info(f"Fetching products | page={page}, per_page={per_page}, search='{search}', sort_by='{sort_by}', sort_dir='{sort_dir}', pagination='{pagination}'")
     
-    skip = (page - 1) * per_page
     filters = {
         'min_price': min_price,
         'max_price': max_price,
         'category_id': category_id,
         'in_stock_only': in_stock_only
     }
-    
-    total, products = Products.crud.get_paginated_products(
+
+    if pagination == "cursor" or cursor:
+        try:
+            products, next_cursor = Products.crud.list_product_summaries_keyset(
+                db, per_page, cursor, search, sort_by, sort_dir, filters
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        total, total_is_estimate = None, False
+        if include_total:
+            total, total_is_estimate = Products.crud.count_products(
+                db, search, filters, estimated=total_mode == "estimated"
+            )
+
+        log.info(f"Found {len(products)} products (Total: {total}, Next cursor: {next_cursor is not None})")
+        return {
+            "total": total,
+            "page": None,
+            "per_page": per_page,
+            "total_pages": (total + per_page - 1) // per_page if total is not None else None,
+            "total_is_estimate": total_is_estimate,
+            "next_cursor": next_cursor,
+            "products": products
+        }
+
+    skip = (page - 1) * per_page
+    products = Products.crud.list_product_summaries(
         db, skip, per_page, search, sort_by, sort_dir, filters
     )
-    
-    clean_products = []
-    for product in products:
-        rating = None
-        if product.attributes and 'rating' in product.attributes:
-            rating = product.attributes['rating']
-        
-        clean_products.append({
-            "id": product.id,
-            "name": product.name,
-            "price": product.price,
-            "brand": product.brand,
-            "stock_quantity": product.inventory.quantity_available if product.inventory else 0,
-            "category_name": product.category.name if product.category else "Unknown",
-            "rating": rating
-        })
+    total, total_is_estimate = Products.crud.count_products(
+        db, search, filters, estimated=total_mode == "estimated"
+    )
     
     total_pages = (total + per_page - 1) // per_page
     log.info(f"Found {len(products)} products (Total: {total}, Total Pages: {total_pages})")
@@ -70,17 +102,98 @@ def get_all_products(
         "page": page,
         "per_page": per_page,
         "total_pages": total_pages,
-        "products": clean_products
+        "total_is_estimate": total_is_estimate,
+        "products": products
+    }
+
+@router.get("/facets", response_model=Products.schemas.ProductFacetsResponse)
+def get_product_facets(
+    db: Session = Depends(get_db),
+    search: Optional[str] = Query(None, description="Search products"),
+    min_price: Optional[float] = Query(None, ge=0, description="Minimum price"),
+    max_price: Optional[float] = Query(None, ge=0, description="Maximum price"),
+    category_id: Optional[int] = Query(None, description="Filter by category (includes its subcategories)"),
+    in_stock_only: bool = Query(False, description="Show only in-stock items")
+):
+    """Category, brand, price-range and stock counts for the listing with the same filters"""
+    log.info(f"Computing facets | search='{search}', min_price={min_price}, max_price={max_price}, category_id={category_id}, in_stock_only={in_stock_only}")
+    filters = {
+        'min_price': min_price,
+        'max_price': max_price,
+        'category_id': category_id,
+        'in_stock_only': in_stock_only
     }
+    return Products.facets.compute_facets(db, search, filters)
+
+@router.get("/export")
+def export_catalog(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    category_id: Optional[int] = None,
+    in_stock_only: bool = False
+):
+    """Stream the whole catalog (product, category and inventory columns) as NDJSON or CSV"""
+    log.info(f"Exporting catalog as {format}")
+    filters = {"category_id": category_id, "in_stock_only": in_stock_only}
+    # The generator opens its own session: request dependencies are closed before the body streams
+    return StreamingResponse(
+        Products.export.stream_catalog(SessionLocal, format, filters),
+        media_type=Products.export.EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="catalog.{format}"'}
+    )
+
+@router.get("/cache/stats", response_model=dict)
+def get_cache_stats():
+    return {
+        "product_detail": Products.crud.product_detail_cache.stats(),
+        "product_counts": Products.counts.count_cache.stats()
+    }
+
+@router.get("/concurrency/stats", response_model=dict)
+def get_concurrency_stats():
+    """Attempts, conflicts and retries of optimistic inventory writes, per endpoint"""
+    return {
+        "mode": Products.crud.INVENTORY_CONCURRENCY,
+        "endpoints": inventory_contention.stats(),
+        "reservation_engine": reservation_engine.stats()
+    }
+
+@router.get("/ledger/stats", response_model=dict)
+def get_ledger_stats():
+    """Stock movement writer: durability mode, queue depth, batch sizes and flush latency"""
+    return ledger_writer.stats()
+
+@router.get("/idempotency/stats", response_model=dict)
+def get_idempotency_stats():
+    """Stored Idempotency-Keys, replays served and requests still running"""
+    return idempotency_store.stats()
+
+@router.post("/reservations/extend", response_model=dict)
+def extend_reservations(
+    cart_id: int,
+    ttl_seconds: Optional[int] = Query(None, ge=1, description="New lifetime from now (default RESERVATION_TTL_SECONDS)"),
+    db: Session = Depends(get_db)
+):
+    """Keep an active cart's reservations from expiring"""
+    if reservation_engine.enabled:
+        # Reservations made through the engine reach the table with its write-behind
+        reservation_engine.sync()
+    extended = product_reservations.extend(db, cart_id, ttl_seconds)
+    db.commit()
+    return {"cart_id": cart_id, "extended": extended}
+
+@router.get("/reservations/stats", response_model=dict)
+def get_reservation_stats():
+    """Expiry sweeper state: queued deadlines and what it has released so far"""
+    return product_reservations.expiry_sweeper.stats()
 
 @router.get("/{product_id}", response_model=Products.schemas.Product)
 def get_product_by_id(product_id: int, db: Session = Depends(get_db)):
     log.info(f"Fetching product by ID: {product_id}")
-    product = Products.crud.get_product_by_id(db, product_id)
-    if not product:
+    payload = Products.crud.get_product_detail(db, product_id)
+    if payload is None:
         log.warning(f"Product not found: ID {product_id}")
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
+    return Response(content=payload, media_type="application/json")
 
 @router.post("/auto-generate", response_model=List[Products.schemas.Product])
 def auto_generate_products(count: int = 1, db: Session = Depends(get_db)):
@@ -96,12 +209,12 @@ def update_all_prices(
     db: Session = Depends(get_db)
 ):
     log.info(f"Updating prices for {count} product(s)")
-    products = Products.crud.get_all_products(db)
+    products = Products.crud.get_random_products(db, count)
     if not products:
         log.warning("No products found to update prices")
         return {"message": "No products found to update"}
     generator.randomly_update_prices(db, products, batch_size=count)
-    return {"message": f"Price updated for {min(count, len(products))} products"}
+    return {"message": f"Price updated for {len(products)} products"}
 
 
 @router.patch("/{product_id}", response_model=Products.schemas.Product)
@@ -122,8 +235,7 @@ def update_product(
         raise HTTPException(status_code=404, detail="Product not found")
 
     if product_update.category_id is not None:
-        valid_category_ids = [cat.id for cat in Products.crud.get_all_categories(db)]
-        if product_update.category_id not in valid_category_ids:
+        if not category_tree.contains(db, product_update.category_id):
             raise HTTPException(status_code=400, detail="Invalid category_id")
 
     updated_product = Products.crud.update_product(db, product.id, product_update)
@@ -153,8 +265,37 @@ def adjust_inventory(
             "message": f"Inventory updated for Product ID {product_id}",
             "new_quantity": updated_inventory.quantity_available
         }
+    except Products.crud.InventoryConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/{product_id}/inventory/shards", response_model=Products.schemas.Inventory)
+def shard_inventory(
+    product_id: int,
+    count: int = Query(inventory_shards.DEFAULT_SHARD_COUNT, ge=2, le=256, description="Number of stock sub-counters"),
+    db: Session = Depends(get_db)
+):
+    """Split a hot product's stock across several counters (or re-split an already sharded one)"""
+    try:
+        # Written-behind reservations must land before the stock is split up
+        reservation_engine.flush()
+        inventory_shards.enable_sharding(db, product_id, count)
+        db.commit()
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    return Products.crud.get_inventory_by_product_id(db, product_id)
+
+@router.delete("/{product_id}/inventory/shards", response_model=Products.schemas.Inventory)
+def unshard_inventory(product_id: int, db: Session = Depends(get_db)):
+    """Merge a product's stock counters back into its inventory row"""
+    reservation_engine.flush()
+    inventory = inventory_shards.disable_sharding(db, product_id)
+    if not inventory:
+        raise HTTPException(status_code=404, detail="Inventory not found")
+    db.commit()
+    return Products.crud.get_inventory_by_product_id(db, product_id)
 
 @router.get("/{product_id}/stock-movements", response_model=List[Products.schemas.StockMovement])
 def get_stock_movements(product_id: int, db: Session = Depends(get_db)):
@@ -176,47 +317,29 @@ def update_inventory_settings(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+IDEMPOTENCY_KEY = Header(None, alias="Idempotency-Key", description="Retries with the same key replay the first response")
+
 @router.post("/reserve", response_model=dict)
 def reserve_products(
     reservations: Union[List[dict], dict],
     cart_id: Optional[str] = None,
+    ttl_seconds: Optional[int] = Query(None, ge=1, description="Release the reservation after this long (default RESERVATION_TTL_SECONDS)"),
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
     db: Session = Depends(get_db)
 ):
     """Reserve single or multiple products for an order (atomic operation)"""
     if isinstance(reservations, dict):
         reservations = [reservations]
-    
-    try:
-        reserved_items = []
-        
-        for item in reservations:
-            inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
-            if not inventory or inventory.quantity_available < item["quantity"]:
-                db.rollback()
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Insufficient stock for product {item['product_id']} (requested: {item['quantity']}, available: {inventory.quantity_available if inventory else 0})"
-                )
-        
-        for item in reservations:
-            inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
-            inventory.quantity_available -= item["quantity"]
-            inventory.quantity_reserve += item["quantity"]
-            
-            movement = Products.models.StockMovement(
-                product_id=item["product_id"],
-                cart_id=item["cart_id"],
-                change=-item["quantity"],
-                reason=f"reserve_order_{cart_id}" if cart_id else "reserve"
-            )
-            db.add(movement)
-            reserved_items.append({
-                **item,
-                "remaining_available": inventory.quantity_available
-            })
-        
-        db.commit()
-        
+
+    def run():
+        try:
+            return Products.crud.reserve_items(db, reservations, cart_id, ttl=ttl_seconds)
+        except Products.crud.InventoryConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def respond(reserved_items):
         return {
             "success": True,
             "reserved_items": reserved_items,
@@ -224,42 +347,29 @@ def reserve_products(
             "cart_id": cart_id,
             "message": f"Successfully reserved {len(reserved_items)} product(s)"
         }
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
+
+    return idempotent("reserve", idempotency_key, fingerprint(reservations, cart_id, ttl_seconds), run, respond=respond)
 
 @router.post("/release", response_model=dict)
 def release_products(
     reservations: Union[List[dict], dict],
     cart_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
     db: Session = Depends(get_db)
 ):
     """Release single or multiple reserved products (e.g., if user cancels checkout)"""
     if isinstance(reservations, dict):
         reservations = [reservations]
-    
-    try:
-        released_items = []
-        
-        for item in reservations:
-            inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
-            if inventory and inventory.quantity_reserve >= item["quantity"]:
-                inventory.quantity_reserve -= item["quantity"]
-                inventory.quantity_available += item["quantity"]
-                
-                movement = Products.models.StockMovement(
-                    product_id=item["product_id"],
-                    cart_id=item["cart_id"],
-                    change=item["quantity"],
-                    reason=f"release_order_{cart_id}" if cart_id else "release"
-                )
-                db.add(movement)
-                released_items.append({
-                    **item,
-                    "new_available": inventory.quantity_available
-                })
-        
-        db.commit()
+
+    def run():
+        try:
+            return Products.crud.release_items(db, reservations, cart_id)
+        except Products.crud.InventoryConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def respond(released_items):
         return {
             "success": True,
             "released_items": released_items,
@@ -267,41 +377,30 @@ def release_products(
             "order_id": cart_id,
             "message": f"Successfully released {len(released_items)} product(s)"
         }
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
+
+    return idempotent("release", idempotency_key, fingerprint(reservations, cart_id), run, respond=respond)
 
 @router.post("/finalize", response_model=dict)
 def finalize_products(
     reservations: Union[List[dict], dict],
     order_id: Optional[str] = None,
+    cart_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
     db: Session = Depends(get_db)
 ):
     """Finalize single or multiple reserved products (convert reserves to sold)"""
     if isinstance(reservations, dict):
         reservations = [reservations]
-    
-    try:
-        finalized_items = []
-        
-        for item in reservations:
-            inventory = Products.crud.get_inventory_by_product_id(db, item["product_id"])
-            if inventory and inventory.quantity_reserve >= item["quantity"]:
-                inventory.quantity_reserve -= item["quantity"]
-                
-                movement = Products.models.StockMovement(
-                    product_id=item["product_id"],
-                    order_id=item["order_id"],
-                    change=-item["quantity"],
-                    reason=f"finalize_order_{order_id}" if order_id else "finalize"
-                )
-                db.add(movement)
-                finalized_items.append({
-                    **item,
-                    "remaining_reserved": inventory.quantity_reserve
-                })
-        
-        db.commit()
+
+    def run():
+        try:
+            return Products.crud.finalize_items(db, reservations, order_id, cart_id)
+        except Products.crud.InventoryConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def respond(finalized_items):
         return {
             "success": True,
             "finalized_items": finalized_items,
@@ -309,9 +408,38 @@ def finalize_products(
             "order_id": order_id,
             "message": f"Successfully finalized {len(finalized_items)} product(s)"
         }
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
+
+    return idempotent("finalize", idempotency_key, fingerprint(reservations, order_id, cart_id), run, respond=respond)
+
+@router.post("/restock", response_model=dict)
+def restock_products(
+    reservations: Union[List[dict], dict],
+    order_id: Optional[str] = None,
+    idempotency_key: Optional[str] = IDEMPOTENCY_KEY,
+    db: Session = Depends(get_db)
+):
+    """Put sold products back on sale (e.g., a finalized order was cancelled)"""
+    if isinstance(reservations, dict):
+        reservations = [reservations]
+
+    def run():
+        try:
+            return Products.crud.restock_items(db, reservations, order_id)
+        except Products.crud.InventoryConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def respond(restocked_items):
+        return {
+            "success": True,
+            "restocked_items": restocked_items,
+            "total_items": len(restocked_items),
+            "order_id": order_id,
+            "message": f"Successfully restocked {len(restocked_items)} product(s)"
+        }
+
+    return idempotent("restock", idempotency_key, fingerprint(reservations, order_id), run, respond=respond)
 
 @router.get("/featured", response_model=List[dict])
 def get_featured_products(
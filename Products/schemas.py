@@ -84,6 +84,7 @@ class ProductSummary(BaseModel):
     price: float
     brand: Optional[str] = None
     category_name: str
+    stock_quantity: int = 0
     rating: Optional[float] = None
 
     class Config:
@@ -99,17 +100,64 @@ class Product(ProductBase):
     class Config:
         from_attributes = True
 
+# ---------- Bulk Creation ----------
+
+class ProductBulkItem(ProductCreate):
+    inventory: Optional['InventoryBase'] = None
+
+class ProductBulkCreate(BaseModel):
+    # Rows are validated one by one so a bad row is reported instead of rejecting the request
+    products: List[Dict[str, Any]] = Field(..., min_length=1, max_length=10000)
+
+class BulkRowError(BaseModel):
+    index: int
+    error: str
+
+class ProductBulkResult(BaseModel):
+    created: int
+    failed: int
+    product_ids: List[int]
+    errors: List[BulkRowError]
+    elapsed_ms: float
+
 # =========================================================
 # 📋 PAGINATED RESPONSE SCHEMAS
 # =========================================================
 
 class ProductListResponse(BaseModel):
-    total: int
-    page: int
+    total: Optional[int] = None
+    page: Optional[int] = None
     per_page: int
-    total_pages: int
+    total_pages: Optional[int] = None
+    total_is_estimate: bool = False
+    next_cursor: Optional[str] = None
     products: List[ProductSummary]
 
+# =========================================================
+# 🔎 FACET SCHEMAS
+# =========================================================
+
+class FacetValue(BaseModel):
+    id: Optional[int] = None
+    value: str
+    count: int
+
+class PriceRangeFacet(BaseModel):
+    min: float
+    max: Optional[float] = None
+    count: int
+
+class StockFacet(BaseModel):
+    in_stock: int
+    out_of_stock: int
+
+class ProductFacetsResponse(BaseModel):
+    total: int
+    categories: List[FacetValue]
+    brands: List[FacetValue]
+    price_ranges: List[PriceRangeFacet]
+    stock: StockFacet
+
 # =========================================================
 # 🧮 INVENTORY SCHEMAS
 # =========================================================
@@ -129,6 +177,7 @@ class Inventory(InventoryBase):
     id: int
     product_id: int
     last_updated: Optional[datetime] = None
+    shard_count: int = 0
 
     class Config:
         from_attributes = True
@@ -162,3 +211,5 @@ class StockMovement(StockMovementBase):
 
     class Config:
         from_attributes = True
+
+ProductBulkItem.model_rebuild()
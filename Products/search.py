@@ -0,0 +1,314 @@
+import argparse
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, case, delete, desc, event, false, insert, select
+from sqlalchemy.orm import Session
+import Products.models
+from Products.logger import log
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SEARCHABLE_ATTRIBUTES = ("color", "material")
+# Matches ranked one by one in the fallback ORDER BY; the rest follow by id (all still match)
+MAX_RANKED_HITS = int(os.getenv("SEARCH_MAX_RANKED_HITS", "10000"))
+REFRESH_INTERVAL_SECONDS = float(os.getenv("SEARCH_REFRESH_INTERVAL", "5"))
+INDEX_BATCH_SIZE = 1000
+_INFO_KEY = "search_documents"
+
+_TOKEN_RE = re.compile(r"[0-9a-z]+")
+_STOPWORDS = frozenset({"a", "an", "and", "the", "of", "for", "with", "in", "on", "to", "or"})
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def build_document(name: Optional[str], brand: Optional[str], attributes: Optional[dict]) -> str:
+    """Flatten the searchable fields of a product into one normalized text body"""
+    parts = [name, brand]
+    if attributes:
+        parts.extend(str(attributes[key]) for key in SEARCHABLE_ATTRIBUTES if attributes.get(key) is not None)
+    return " ".join(tokenize(" ".join(p for p in parts if p)))
+
+
+class InvertedIndex:
+    """In-process token -> {product_id: term frequency} index ranked with BM25.
+
+    Used on databases without a full-text facility (SQLite in development and tests).
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_lengths: Dict[int, int] = {}
+        self._doc_terms: Dict[int, List[str]] = {}
+        self._total_length = 0
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+
+    def __len__(self):
+        return len(self._doc_lengths)
+
+    def add(self, product_id: int, body: str) -> None:
+        terms = Counter(body.split())
+        with self._lock:
+            self._remove(product_id)
+            for term, tf in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    self._vocabulary_dirty = True
+                postings[product_id] = tf
+            length = sum(terms.values())
+            self._doc_lengths[product_id] = length
+            self._doc_terms[product_id] = list(terms)
+            self._total_length += length
+
+    def remove(self, product_id: int) -> None:
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id: int) -> None:
+        length = self._doc_lengths.pop(product_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._doc_terms.pop(product_id):
+            postings = self._postings[term]
+            del postings[product_id]
+            if not postings:
+                del self._postings[term]
+                self._vocabulary_dirty = True
+
+    def _expand_prefix(self, prefix: str) -> List[str]:
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        start = bisect_left(self._vocabulary, prefix)
+        matches = []
+        for term in self._vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Return (product_id, score) pairs matching every query token, best first.
+        The last token also matches as a prefix so results update while typing."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            n_docs = len(self._doc_lengths) or 1
+            avg_length = (self._total_length / n_docs) or 1
+            scores: Optional[Dict[int, float]] = None
+
+            for position, token in enumerate(tokens):
+                terms = self._expand_prefix(token) if position == len(tokens) - 1 else [token]
+                token_scores: Dict[int, float] = {}
+                for term in terms:
+                    postings = self._postings.get(term, {})
+                    idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for product_id, tf in postings.items():
+                        norm = tf + self.K1 * (1 - self.B + self.B * self._doc_lengths[product_id] / avg_length)
+                        token_scores[product_id] = token_scores.get(product_id, 0.0) + idf * tf * (self.K1 + 1) / norm
+
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {pid: score + token_scores[pid] for pid, score in scores.items() if pid in token_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked if limit is None else ranked[:limit]
+
+
+class ProductSearch:
+    """Keeps product_search_documents in sync and answers search queries.
+
+    MySQL answers queries from its FULLTEXT index on the document table; every other
+    backend uses an InvertedIndex loaded from the same table and refreshed by watermark.
+    """
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self._loaded = False
+        self._watermark: Optional[datetime] = None
+        self._last_refresh = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def uses_fulltext(db: Session) -> bool:
+        return db.get_bind().dialect.name == "mysql"
+
+    def index_products(self, db: Session, products: Iterable[Products.models.Product]) -> None:
+        """Write search documents for the given (flushed) products inside the caller's transaction"""
+        self.index_rows(db, ((p.id, p.name, p.brand, p.attributes) for p in products if p.id is not None))
+
+    def index_rows(self, db: Session, products: Iterable[Tuple[int, Optional[str], Optional[str], Optional[dict]]]) -> None:
+        """Same as index_products for (id, name, brand, attributes) tuples written with Core inserts"""
+        indexed_at = Products.models.utc_now().replace(tzinfo=None)
+        rows = [
+            {"product_id": product_id, "body": build_document(name, brand, attributes), "indexed_at": indexed_at}
+            for product_id, name, brand, attributes in products
+        ]
+        if not rows:
+            return
+
+        Document = Products.models.ProductSearchDocument
+        db.execute(delete(Document).where(Document.product_id.in_([r["product_id"] for r in rows])))
+        db.execute(insert(Document), rows)
+
+        # Applied to the in-process index once the transaction commits (see _apply_documents)
+        db.info.setdefault(_INFO_KEY, []).extend((row["product_id"], row["body"]) for row in rows)
+        log.debug(f"Indexed {len(rows)} product(s) for search")
+
+    def add_committed(self, documents: Iterable[Tuple[int, str]]) -> None:
+        """Apply committed documents to the in-process index (loaded later otherwise)"""
+        if not self._loaded:
+            return
+        for product_id, body in documents:
+            self.index.add(product_id, body)
+
+    def sync_missing(self, db: Session) -> int:
+        """Index products that have no search document yet (first deploy or rows written out of band)"""
+        Product = Products.models.Product
+        Document = Products.models.ProductSearchDocument
+        indexed = 0
+        while True:
+            batch = db.query(Product)\
+                .outerjoin(Document, Document.product_id == Product.id)\
+                .filter(Document.product_id.is_(None))\
+                .order_by(Product.id)\
+                .limit(INDEX_BATCH_SIZE).all()
+            if not batch:
+                break
+            self.index_products(db, batch)
+            db.commit()
+            db.expunge_all()
+            indexed += len(batch)
+        if indexed:
+            log.info(f"Indexed {indexed} product(s) missing from the search index")
+        return indexed
+
+    def rebuild(self, db: Session) -> int:
+        db.execute(delete(Products.models.ProductSearchDocument))
+        db.commit()
+        self.index = InvertedIndex()
+        self._loaded = False
+        self._watermark = None
+        return self.sync_missing(db)
+
+    def _refresh(self, db: Session) -> None:
+        """Load (first call) or catch up (later calls) the in-process index from the document table"""
+        now = time.monotonic()
+        if self._loaded and now - self._last_refresh < REFRESH_INTERVAL_SECONDS:
+            return
+
+        # Never hold the lock across a fetch: under AsyncSession.run_sync every fetch yields
+        # to the event loop, and another request on the same thread would block on it
+        with self._lock:
+            if self._loaded and (self._refreshing or now - self._last_refresh < REFRESH_INTERVAL_SECONDS):
+                return  # another request is catching up; serve what is loaded
+            self._refreshing = True
+            watermark = self._watermark
+        try:
+            Document = Products.models.ProductSearchDocument
+            stmt = select(Document.product_id, Document.body, Document.indexed_at)
+            if watermark is not None:
+                stmt = stmt.where(Document.indexed_at >= watermark)
+
+            loaded = 0
+            for partition in db.execute(stmt.execution_options(yield_per=INDEX_BATCH_SIZE)).partitions():
+                for product_id, body, indexed_at in partition:
+                    self.index.add(product_id, body)
+                    if indexed_at and (watermark is None or indexed_at > watermark):
+                        watermark = indexed_at
+                loaded += len(partition)
+
+            with self._lock:
+                if watermark is not None and (self._watermark is None or watermark > self._watermark):
+                    self._watermark = watermark
+                if not self._loaded:
+                    log.info(f"Loaded {loaded} search document(s) into the in-process index")
+                self._loaded = True
+                self._last_refresh = now
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def apply(self, db: Session, query, text: str, id_column=None):
+        """Restrict a query to products matching `text`; `id_column` defaults to Product.id.
+        Returns the query and an ORDER BY expression ranking the best matches first."""
+        tokens = tokenize(text)
+        if not tokens:
+            return query, None
+
+        if id_column is None:
+            id_column = Products.models.Product.id
+        if self.uses_fulltext(db):
+            Document = Products.models.ProductSearchDocument
+            boolean_query = " ".join(f"+{token}*" for token in tokens)
+            score = Document.body.match(boolean_query)
+            query = query.join(Document, Document.product_id == id_column).filter(score)
+            return query, desc(score)
+
+        self._refresh(db)
+        ranked_ids = [product_id for product_id, _ in self.index.search(text)]
+        if not ranked_ids:
+            return query.filter(false()), None
+        # Every match filters (rendered inline: no bound-parameter limit), so totals and deep
+        # pages stay exact; only the best MAX_RANKED_HITS get an individual rank.
+        query = query.filter(id_column.in_(bindparam("search_ids", ranked_ids, expanding=True, literal_execute=True)))
+        ranks = {product_id: rank for rank, product_id in enumerate(ranked_ids[:MAX_RANKED_HITS])}
+        return query, case(ranks, value=id_column, else_=len(ranks))
+
+
+product_search = ProductSearch()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_documents(session: Session) -> None:
+    if session.in_nested_transaction():
+        return
+    documents = session.info.pop(_INFO_KEY, None)
+    if documents:
+        product_search.add_committed(documents)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_documents(session: Session, previous_transaction) -> None:
+    # Documents written inside a rolled-back SAVEPOINT stay pending; they only reach the
+    # index if the outer transaction commits, and then match no product row.
+    if previous_transaction.parent is None:
+        session.info.pop(_INFO_KEY, None)
+
+
+if __name__ == "__main__":
+    from Products.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Maintain the product search index")
+    parser.add_argument("--rebuild", action="store_true", help="Drop and re-create every search document")
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        count = product_search.rebuild(session) if args.rebuild else product_search.sync_missing(session)
+        log.info(f"Search index up to date ({count} document(s) written)")
+    finally:
+        session.close()
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+# Before anything imports Products.database: the engines are created from these at import
+_DB_DIR = tempfile.mkdtemp(prefix="products-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'products.db')}"
+os.environ["DB_MODE"] = "async"
+os.environ["RESERVATION_ENGINE"] = "false"
+os.environ["LEDGER_MODE"] = "inline"
+
+import pytest
+from sqlalchemy import insert
+import Products.crud, Products.models
+from Products.database import Base, SessionLocal, engine
+from Orders.app.models import Base as OrdersBase
+
+PRODUCTS = 10
+STOCK = 20
+
+
+@pytest.fixture(scope="session")
+def catalog():
+    """Ten products, 1-5 named "Widget n" and 6-10 "Gadget n", with STOCK units each"""
+    OrdersBase.metadata.create_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        db.execute(insert(Products.models.Category), [{"id": 1, "name": "Tools", "parent_id": 0}])
+        ids = Products.crud.insert_products_with_inventory(
+            db,
+            [
+                {"name": f"{'Widget' if i <= 5 else 'Gadget'} {i}", "price": 10.0 * i, "brand": "Acme",
+                 "category_id": 1, "attributes": {"color": "red"}}
+                for i in range(1, PRODUCTS + 1)
+            ],
+            [{"quantity_available": STOCK, "quantity_reserve": 0}] * PRODUCTS
+        )
+        db.commit()
+    finally:
+        db.close()
+    return ids
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+
+import pytest
+import Products.async_crud
+from Products.async_database import AsyncSessionLocal, dispose_async_engine
+from Products.exceptions import InsufficientStockError
+from Products.search import InvertedIndex, product_search
+from Products.tests.conftest import STOCK
+
+
+def run(coro_fn, timeout: float = 30):
+    """asyncio.run on a thread of its own, so a deadlocked event loop fails the test instead of hanging it"""
+    outcome = {}
+
+    def target():
+        async def main():
+            try:
+                return await coro_fn()
+            finally:
+                await dispose_async_engine()
+        try:
+            outcome["result"] = asyncio.run(main())
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"event loop still blocked after {timeout}s"
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+async def with_session(fn, *args, **kwargs):
+    session = AsyncSessionLocal()
+    try:
+        return await fn(session, *args, **kwargs)
+    finally:
+        await session.close()
+
+
+def test_concurrent_searches_load_the_index_without_blocking_the_loop(catalog):
+    # Every search has to load the in-process index itself
+    product_search.index = InvertedIndex()
+    product_search._loaded = False
+    product_search._watermark = None
+
+    async def searches():
+        return await asyncio.gather(*(
+            with_session(Products.async_crud.list_products, 0, 10, search="widget") for _ in range(3)
+        ))
+
+    for rows, (total, is_estimate) in run(searches):
+        assert total == 5 and not is_estimate
+        assert sorted(row["name"] for row in rows) == [f"Widget {i}" for i in range(1, 6)]
+
+
+def test_list_products_pages(catalog):
+    rows, (total, _) = run(lambda: with_session(
+        Products.async_crud.list_products, 2, 3, sort_by="price", sort_dir="asc"
+    ))
+    assert total == len(catalog)
+    assert [row["name"] for row in rows] == ["Widget 3", "Widget 4", "Widget 5"]
+
+
+def test_product_detail(catalog):
+    payload = run(lambda: with_session(Products.async_crud.get_product_detail, catalog[6]))
+    assert json.loads(payload)["name"] == "Gadget 7"
+    assert run(lambda: with_session(Products.async_crud.get_product_detail, 10 ** 6)) is None
+
+
+def test_reserve_release_finalize(catalog):
+    product_id = catalog[7]
+
+    async def stock():
+        inventory = await with_session(Products.async_crud.get_inventory_by_product_id, product_id)
+        return inventory.quantity_available, inventory.quantity_reserve
+
+    reserved = run(lambda: with_session(Products.async_crud.reserve_items, [{"product_id": product_id, "quantity": 5}], "41"))
+    assert reserved[0]["remaining_available"] == STOCK - 5
+    assert run(stock) == (STOCK - 5, 5)
+
+    released = run(lambda: with_session(Products.async_crud.release_items, [{"product_id": product_id, "quantity": 2}], "41"))
+    assert released[0]["quantity"] == 2
+    assert run(stock) == (STOCK - 3, 3)
+
+    finalized = run(lambda: with_session(
+        Products.async_crud.finalize_items, [{"product_id": product_id, "quantity": 3}], "9", "41"
+    ))
+    assert finalized[0]["remaining_reserved"] == 0
+    assert run(stock) == (STOCK - 3, 0)
+
+    # Nothing left to release for that cart
+    assert run(lambda: with_session(Products.async_crud.release_items, [{"product_id": product_id, "quantity": 1}], "41")) == []
+
+    # The order is cancelled: the sold units go back on sale
+    restocked = run(lambda: with_session(Products.async_crud.restock_items, [{"product_id": product_id, "quantity": 3}], "9"))
+    assert restocked[0]["new_available"] == STOCK
+    assert run(stock) == (STOCK, 0)
+
+
+def test_reserve_more_than_available_changes_nothing(catalog):
+    product_id = catalog[8]
+    with pytest.raises(InsufficientStockError):
+        run(lambda: with_session(
+            Products.async_crud.reserve_items,
+            [{"product_id": product_id, "quantity": 1}, {"product_id": catalog[9], "quantity": STOCK + 1}],
+            "42"
+        ))
+    inventory = run(lambda: with_session(Products.async_crud.get_inventory_by_product_id, product_id))
+    assert (inventory.quantity_available, inventory.quantity_reserve) == (STOCK, 0)
@@ -0,0 +1,23 @@
+import pytest
+import Products.crud
+from Products.database import SessionLocal
+from Products.tests.conftest import PRODUCTS
+
+
+@pytest.mark.parametrize("sort_by", ["created_at", "id", "price"])
+@pytest.mark.parametrize("sort_dir", ["desc", "asc"])
+def test_cursor_pages_walk_the_whole_catalog_once(catalog, sort_by, sort_dir):
+    db = SessionLocal()
+    try:
+        seen, cursor, pages = [], None, 0
+        while True:
+            rows, cursor = Products.crud.list_product_summaries_keyset(db, 3, cursor, sort_by=sort_by, sort_dir=sort_dir)
+            seen.extend(row["id"] for row in rows)
+            pages += 1
+            assert pages <= PRODUCTS, "cursor keeps returning pages"
+            if cursor is None:
+                break
+    finally:
+        db.close()
+    assert sorted(seen) == sorted(catalog)
+    assert len(seen) == PRODUCTS